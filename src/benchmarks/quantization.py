@@ -0,0 +1,79 @@
+"""Benchmark: recall vs resident memory of the NumPy store vector types, on a synthetic corpus
+
+Clustered, normalized vectors of the size of all-MiniLM-L6-v2 embeddings stand in for the
+chunks of one tenant, queries are perturbed chunks. Recall@k is measured against an exact
+float32 search, memory is what stays resident per vector (the float32 vectors kept for the
+re-score are memory mapped, only the rows of the candidates are read).
+
+Run from the src folder:
+    python -m benchmarks.quantization
+"""
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from werag.db import query_embeddings_with_ids
+from werag.numpy_store import NumpyVectorStore
+
+DIMENSION = 384
+CHUNKS = 20000
+QUERIES = 200
+K = 10
+
+
+class ZeroEmbeddings(Embeddings):
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [[0.0] * DIMENSION for _ in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [0.0] * DIMENSION
+
+
+def synthetic_corpus(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(200, DIMENSION))
+    vectors = centers[rng.integers(0, len(centers), CHUNKS)] + rng.normal(scale=0.6, size=(CHUNKS, DIMENSION))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = vectors[rng.integers(0, CHUNKS, QUERIES)] + rng.normal(scale=0.02, size=(QUERIES, DIMENSION))
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return vectors.astype(np.float32), queries.astype(np.float32)
+
+
+def resident_bytes(store: NumpyVectorStore) -> int:
+    tenant = store._tenants["tenant"]
+    arrays = [tenant.vectors[:tenant.size], tenant.norms[:tenant.size]]
+    if tenant.scales is not None: arrays.append(tenant.scales[:tenant.size])
+    if tenant.full is not None and not isinstance(tenant.full, np.memmap): arrays.append(tenant.full[:tenant.size])
+    return sum(array.nbytes for array in arrays)
+
+
+def bench(persist_directory: str, vectors: np.ndarray, queries: np.ndarray, expected: List[set],
+          dtype: str, rescore_factor: int):
+    store = NumpyVectorStore(collection_name=f"{dtype}_{rescore_factor}", persist_directory=persist_directory,
+                             embedding_function=ZeroEmbeddings(), dtype=dtype, rescore_factor=rescore_factor)
+    store.upsert(ids=[str(index) for index in range(CHUNKS)], embeddings=vectors,
+                 metadatas=[{"user": "tenant"} for _ in range(CHUNKS)], documents=["" for _ in range(CHUNKS)])
+    where = {"user": "tenant"}
+    query_embeddings_with_ids(store, embeddings=queries[:1], k=K, where=where)
+    start = time.perf_counter()
+    results = query_embeddings_with_ids(store, embeddings=queries, k=K, where=where)
+    seconds = (time.perf_counter() - start) / QUERIES
+    recall = np.mean([len(expected_ids & {_id for _id, _ in found}) / K
+                      for expected_ids, found in zip(expected, results)])
+    print(f"{dtype:<8} rescore_factor={rescore_factor:<2} recall@{K}={recall:6.4f}  "
+          f"resident={resident_bytes(store) / CHUNKS:7.1f} bytes/vector  query={seconds * 1000:6.2f}ms")
+
+
+if __name__ == "__main__":
+    vectors, queries = synthetic_corpus()
+    distances = (vectors ** 2).sum(axis=1)[None, :] - 2 * queries @ vectors.T
+    expected = [{str(index) for index in np.argsort(row)[:K]} for row in distances]
+    print(f"{CHUNKS} chunks of dimension {DIMENSION}, {QUERIES} queries")
+    with tempfile.TemporaryDirectory() as persist_directory:
+        for dtype, rescore_factor in (("float32", 1), ("float16", 1), ("float16", 4),
+                                      ("int8", 1), ("int8", 2), ("int8", 4), ("int8", 8)):
+            bench(persist_directory, vectors, queries, expected, dtype, rescore_factor)
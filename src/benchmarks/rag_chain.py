@@ -0,0 +1,63 @@
+"""Micro-benchmark: per-message framework overhead of the RAG chain, with a fake LLM
+
+Compares building the prompt, LLMChain and runnable for every message (the previous
+_get_rag_chain) with the cached chain taking the context as an input variable.
+Retrieval is left out, what remains is the framework work around the LLM call.
+
+Run from the src folder:
+    python -m benchmarks.rag_chain
+"""
+import tempfile
+import timeit
+from typing import List
+
+from langchain.chains import LLMChain
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnablePassthrough
+
+from werag import WeRag
+from werag.client import DEFAULT_PROMPT_TEMPLATE
+from werag.tokens import pack_texts
+from werag.utils import limit_tokens
+
+
+class ZeroEmbeddings(Embeddings):
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [[0.0] * 4 for _ in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [0.0] * 4
+
+
+def legacy_answer(docs: List[Document], llm, question: str) -> str:
+    """The previous per-message chain: context baked in as a partial, everything rebuilt"""
+    context = pack_texts([doc.page_content for doc in docs], max_tokens=1999)
+    prompt = ChatPromptTemplate.from_template(DEFAULT_PROMPT_TEMPLATE, partial_variables={"context": context})
+    llm_chain = LLMChain(llm=llm, prompt=prompt)
+    rag_chain = {"question": RunnablePassthrough()} | llm_chain
+    return rag_chain.invoke(limit_tokens(question, max_token=1000))['text']
+
+
+def cached_answer(client: WeRag, docs: List[Document], llm, question: str) -> str:
+    rag_chain = client._get_rag_chain(llm=llm)
+    return rag_chain.invoke({"context": client._get_context(docs),
+                             "question": limit_tokens(question, max_token=1000)})['text']
+
+
+if __name__ == "__main__":
+    llm = FakeListChatModel(responses=["Your name is zhangwei"])
+    docs = [Document(page_content=f"Fact number {index}: the shop opens at {index} o'clock.") for index in range(4)]
+    question = "When does the shop open?"
+    with tempfile.TemporaryDirectory() as persist_directory:
+        client = WeRag(persist_directory=persist_directory, embedding_function=ZeroEmbeddings())
+        assert legacy_answer(docs, llm, question) == cached_answer(client, docs, llm, question)
+
+        number = 500
+        legacy = timeit.timeit(lambda: legacy_answer(docs, llm, question), number=number) / number
+        cached = timeit.timeit(lambda: cached_answer(client, docs, llm, question), number=number) / number
+        print(f"per message: rebuilt chain={legacy * 1000:7.3f}ms  cached chain={cached * 1000:7.3f}ms  "
+              f"speedup={legacy / cached:5.2f}x")
@@ -0,0 +1,53 @@
+"""Micro-benchmark: single-pass token budget vs the previous slice-and-re-encode loop
+
+Run from the src folder:
+    python -m benchmarks.token_budget
+"""
+import random
+import timeit
+from pathlib import Path
+
+from werag.tokens import pack_texts
+from werag.utils import count_tokens, limit_tokens, split_string_into_slices
+
+ASSETS = Path(__file__).resolve().parent.parent / "tests" / "assets"
+
+
+def legacy_limit_tokens(content: str, max_token: int) -> str:
+    """The previous implementation of werag.utils.limit_tokens"""
+    last_string = ""
+    for sp in split_string_into_slices(content, 10):
+        if count_tokens(last_string + sp) < max_token:
+            last_string += sp
+        else:
+            break
+    return last_string
+
+
+def english_text() -> str:
+    return (ASSETS / "lorem.txt").read_text() * 2
+
+
+def chinese_text(length: int = 12000) -> str:
+    rng = random.Random(0)
+    common = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理府研质"
+    return "".join(rng.choice(common) + ("，" if rng.random() < 0.08 else "") for _ in range(length))
+
+
+def bench(name: str, content: str, max_token: int, number: int = 5):
+    docs = [content[i:i + 1000] for i in range(0, len(content), 1000)]
+    legacy = timeit.timeit(lambda: legacy_limit_tokens(content, max_token), number=number) / number
+    single = timeit.timeit(lambda: limit_tokens(content, max_token), number=number) / number
+    packed = timeit.timeit(lambda: pack_texts(docs, max_token - 1), number=number) / number
+    assert count_tokens(limit_tokens(content, max_token)) < max_token
+    assert count_tokens(pack_texts(docs, max_token - 1)) < max_token
+    print(f"{name:<8} chars={len(content):<6} budget={max_token:<5} "
+          f"legacy={legacy * 1000:9.2f}ms  limit_tokens={single * 1000:7.2f}ms  pack_texts={packed * 1000:7.2f}ms  "
+          f"speedup={legacy / single:6.1f}x")
+
+
+if __name__ == "__main__":
+    count_tokens("warm up the encoder")
+    for budget in (500, 2000):
+        bench("english", english_text(), budget)
+        bench("chinese", chinese_text(), budget)
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import time
+
+from langchain_community.chat_models.fake import FakeListChatModel
+
+from werag import WeRag
+from werag.answer_cache import AnswerCache, MemoryAnswerCacheBackend, SemanticAnswerCache, SQLiteAnswerCacheBackend
+from .utils import collection_name, get_embedding_function, prune_chroma
+
+cache_path = "./answer_cache_pytest.sqlite3"
+
+
+def get_cached_client(answer_cache: AnswerCache) -> WeRag:
+    return WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                 embedding_function=get_embedding_function(), answer_cache=answer_cache)
+
+
+def test_normalize_question():
+    assert AnswerCache.normalize_question("  营业时间？ ") == AnswerCache.normalize_question("营业时间")
+    assert AnswerCache.normalize_question("What is  my NAME?") == "what is my name"
+
+
+def test_memory_backend_ttl_and_size():
+    backend = MemoryAnswerCacheBackend(max_size=2, ttl=0.05)
+    backend.set("a", "1")
+    backend.set("b", "2")
+    backend.set("c", "3")
+    assert backend.get("a") is None
+    assert backend.get("c") == "3"
+    time.sleep(0.1)
+    assert backend.get("c") is None
+
+
+def test_answer_cache_invalidated_by_saves():
+    for get_backend in [MemoryAnswerCacheBackend, lambda: SQLiteAnswerCacheBackend(cache_path)]:
+        try:
+            answer_cache = AnswerCache(get_backend())
+            client = get_cached_client(answer_cache)
+            prune_chroma(client._chroma)
+            client.save_content(user="user", content="营业时间是每天上午九点到晚上十点", content_type="shop")
+
+            llm = FakeListChatModel(responses=["九点到十点", "八点到十点"])
+            assert client._answer(question="营业时间？", llm=llm, user="user", content_type="shop") == "九点到十点"
+            assert client._answer(question="营业时间", llm=llm, user="user", content_type="shop") == "九点到十点"
+            assert answer_cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+            # other users do not share answers
+            assert client._answer(question="营业时间", llm=llm, user="other", content_type="shop") == "八点到十点"
+
+            client.save_content(user="user", content="营业时间是每天上午八点到晚上十点", content_type="shop")
+            assert client._answer(question="营业时间", llm=llm, user="user", content_type="shop") == "九点到十点"
+            assert answer_cache.stats()["misses"] == 3
+        finally:
+            if os.path.exists(cache_path): os.remove(cache_path)
+
+
+def test_semantic_answer_cache():
+    semantic_cache = SemanticAnswerCache(threshold=0.99, near_miss_threshold=0.5, max_entries=2)
+    llm = FakeListChatModel(responses=["answer"])
+    assert semantic_cache.get([1.0, 0.0], user="user", llm=llm) is None
+    semantic_cache.set([1.0, 0.0], "east", user="user", llm=llm)
+    assert semantic_cache.get([2.0, 0.01], user="user", llm=llm) == "east"
+    assert semantic_cache.get([1.0, 0.0], user="other", llm=llm) is None
+    assert semantic_cache.get([1.0, 1.0], user="user", llm=llm) is None  # cosine 0.71, near miss
+
+    # the least recently used answer is replaced
+    semantic_cache.set([0.0, 1.0], "north", user="user", llm=llm)
+    semantic_cache.get([1.0, 0.0], user="user", llm=llm)
+    semantic_cache.set([-1.0, 0.0], "west", user="user", llm=llm)
+    assert semantic_cache.get([0.0, 1.0], user="user", llm=llm) is None
+    assert semantic_cache.get([-1.0, 0.0], user="user", llm=llm) == "west"
+    assert semantic_cache.stats()["near_misses"] == 1
+
+    semantic_cache.bump_version(user="user")
+    assert semantic_cache.get([-1.0, 0.0], user="user", llm=llm) is None
+
+
+def test_semantic_answer_cache_save_during_answer():
+    semantic_cache = SemanticAnswerCache(threshold=0.99)
+    llm = FakeListChatModel(responses=["answer"])
+    generation = semantic_cache.get_generation(user="user")
+    assert semantic_cache.get([1.0, 0.0], user="user", llm=llm) is None
+    # the content is saved while the answer is computed, the stale answer is not stored
+    semantic_cache.bump_version(user="user")
+    semantic_cache.set([1.0, 0.0], "stale", user="user", llm=llm, generation=generation)
+    assert semantic_cache.get([1.0, 0.0], user="user", llm=llm) is None
+    assert semantic_cache.stats()["tenants"] == 0
+
+    semantic_cache.set([1.0, 0.0], "fresh", user="user", llm=llm,
+                       generation=semantic_cache.get_generation(user="user"))
+    assert semantic_cache.get([1.0, 0.0], user="user", llm=llm) == "fresh"
+
+
+def test_semantic_answer_cache_client():
+    semantic_cache = SemanticAnswerCache(threshold=0.9)
+    client = WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                   embedding_function=get_embedding_function(), semantic_answer_cache=semantic_cache)
+    prune_chroma(client._chroma)
+    client.save_content(user="user", content="营业时间是每天上午九点到晚上十点", content_type="shop")
+
+    llm = FakeListChatModel(responses=["九点到十点", "八点到十点"])
+    assert client._answer(question="What are the opening hours?", llm=llm, user="user") == "九点到十点"
+    assert client._answer(question="what are the opening hours", llm=llm, user="user") == "九点到十点"
+    assert semantic_cache.stats()["hits"] == 1
+
+    client.save_content(user="user", content="营业时间是每天上午八点到晚上十点", content_type="shop")
+    assert client._answer(question="What are the opening hours?", llm=llm, user="user") == "八点到十点"
+
+
+def test_answer_caches_async():
+    answer_cache, semantic_cache = AnswerCache(), SemanticAnswerCache(threshold=0.9)
+    client = WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                   embedding_function=get_embedding_function(), answer_cache=answer_cache,
+                   semantic_answer_cache=semantic_cache)
+    prune_chroma(client._chroma)
+    client.save_content(user="user", content="营业时间是每天上午九点到晚上十点", content_type="shop")
+
+    llm = FakeListChatModel(responses=["九点到十点", "八点到十点"])
+    assert asyncio.run(client._aanswer(question="营业时间？", llm=llm, user="user")) == "九点到十点"
+    # the answer stored by the async path is found by both paths
+    assert client._answer(question="营业时间", llm=llm, user="user") == "九点到十点"
+    assert asyncio.run(client._aanswer(question="营业时间", llm=llm, user="user")) == "九点到十点"
+    assert answer_cache.stats()["hits"] == 2
+    assert semantic_cache.stats()["tenants"] == 1
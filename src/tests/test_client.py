@@ -1,11 +1,16 @@
+import asyncio
+
+import pytest
 from langchain.chains import LLMChain
 from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 
+from werag import WeRag
 from werag.crud import CRUDChroma
+from werag.utils import count_tokens
 from .llm import get_llm
-from .utils import prune_chroma, get_client
+from .utils import collection_name, prune_chroma, get_client, get_embedding_function
 
 crud = CRUDChroma(chunk_size=1000)
 client = get_client()
@@ -49,6 +54,21 @@ def test_save_documents():
     assert doc['metadatas'][0]["content_type"] == content_type
 
 
+def test_get_content():
+    prune_chroma(client._chroma)
+    small = WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                  embedding_function=get_embedding_function(), chunk_size=10)
+    content = "\n\n".join(f"paragraph {index}" for index in range(120))
+    small.save_content(user="user1", content=content, content_type="paragraphs")
+
+    # get_content returns everything, one page at a time is get_content_page
+    assert sorted(c.page_content for c in small.get_content(user="user1")) == \
+        sorted(content.split("\n\n"))
+    assert len(small.get_content_page(user="user1", limit=100)) == 100
+    assert len(small.get_content_page(user="user1", limit=100, offset=100)) == 20
+    prune_chroma(client._chroma)
+
+
 def test_import_files():
     prune_chroma(client._chroma)
     with open("assets/lorem.txt", mode="r") as f:
@@ -57,7 +77,8 @@ def test_import_files():
     user = "user_lorem"
 
     content_type = "lorem_content_type"
-    client.import_files(user=user, filepaths=["./assets/lorem.txt"], content_type=content_type)
+    user_content = client.import_files(user=user, filepaths=["./assets/lorem.txt"], content_type=content_type)
+    assert user_content.page_content == content
     doc = client._chroma.get(
         where={
             "user": user
@@ -220,3 +241,123 @@ def test_client_response_wechat_xml():
     assert response[:5].lower() == "<xml>"
     assert response[-6:].lower() == "</xml>"
     assert "zhangwei" in response.lower()
+
+
+def test_client_async():
+    prune_chroma(client._chroma)
+    user = "user"
+    content_type = "personal"
+
+    async def run():
+        await client.asave_content(user=user, content="My name is zhangwei", content_type=content_type)
+        docs = await client.asimilarity_search(query="What is my name?", user=user, content_type=content_type)
+        assert len(docs) == 1
+        assert "zhangwei" in docs[0].page_content
+
+        return await asyncio.gather(*[client.aresponse_wechat_xml(
+            message=f"""<xml>
+                          <ToUserName><![CDATA[toUser]]></ToUserName>
+                          <FromUserName><![CDATA[fromUser{index}]]></FromUserName>
+                          <CreateTime>1348831860</CreateTime>
+                          <MsgType><![CDATA[text]]></MsgType>
+                          <Content><![CDATA[What is my name?]]></Content>
+                          <MsgId>123456789012345{index}</MsgId>
+                        </xml>""",
+            llm=get_llm(),
+            user=user
+        ) for index in range(3)])
+
+    responses = asyncio.run(run())
+    assert len(responses) == 3
+    for response in responses:
+        assert response[:5].lower() == "<xml>"
+        assert "zhangwei" in response.lower()
+
+
+def test_save_contents_bulk():
+    prune_chroma(client._chroma)
+    client.save_content(user="user0", content="old content of user0", content_type="personal")
+    client.save_content(user="user1", content="kept content of user1", content_type="personal")
+
+    records = [(f"user{index}", "personal", f"My name is user{index}") for index in range(20)]
+    records[1] = ("user1", "personal", "kept content of user1")
+    results = client.save_contents_bulk(records=records)
+    assert [result.user for result in results] == [f"user{index}" for index in range(20)]
+    assert (results[0].chunk_diff.added, results[0].chunk_diff.removed) == (1, 1)
+    assert (results[1].chunk_diff.added, results[1].chunk_diff.kept) == (0, 1)
+    assert results[5].chunk_diff.ingest_stats.embed.items == 19
+
+    for index in range(20):
+        docs = client.similarity_search(query="What is my name?", user=f"user{index}", content_type="personal")
+        assert len(docs) == 1
+    assert "user0" in client.similarity_search(query="name", user="user0")[0].page_content
+
+    with pytest.raises(ValueError):
+        client.save_contents_bulk(records=[("user0", None, "a"), ("user0", "personal", "b")])
+
+
+def test_sharded_collections():
+    shared = WeRag(persist_directory="./chroma_persist", collection_name="werag__pytest_shared",
+                   embedding_function=get_embedding_function())
+    prune_chroma(shared._chroma)
+    for index in range(3):
+        shared.save_content(user=f"user{index}", content=f"My name is user{index}", content_type="personal")
+
+    sharded = WeRag(persist_directory="./chroma_persist", collection_name="werag__pytest_shared",
+                    embedding_function=get_embedding_function(), sharding="user", max_open_collections=2)
+    for index in range(3): prune_chroma(sharded._get_chroma(user=f"user{index}"))
+    assert sharded.migrate_to_shards(batch_size=2) == 3
+    assert len(sharded._chroma.get()['ids']) == 0
+    assert len(sharded._router._collections) == 2
+
+    for index in range(3):
+        collection = sharded._get_chroma(user=f"user{index}")
+        assert collection._collection.name != sharded._chroma._collection.name
+        assert len(collection.get()['ids']) == 1
+        docs = sharded.similarity_search(query="What is my name?", user=f"user{index}", content_type="personal")
+        assert [doc.page_content for doc in docs] == [f"My name is user{index}"]
+
+    results = sharded.save_contents_bulk(records=[("user0", "personal", "My name is zhangwei"),
+                                                  ("user3", "personal", "My name is user3")])
+    assert results[0].chunk_diff.removed == 1
+    assert "zhangwei" in sharded.similarity_search(query="name", user="user0")[0].page_content
+
+
+def test_rag_chain_cache():
+    llm = get_llm()
+    chain = client._get_rag_chain(llm=llm)
+    assert client._get_rag_chain(llm=llm) is chain
+    assert client._get_rag_chain(llm=llm, prompt_template="{context} {question}") is not chain
+    assert client._get_rag_chain(llm=get_llm()) is not chain
+    response = chain.invoke({"context": "My name is zhangwei", "question": "What is my name?"})
+    assert "zhangwei" in response['text']
+
+
+def test_similarity_search_batch():
+    client = WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                   embedding_function=get_embedding_function(), chunk_size=10)
+    prune_chroma(client._chroma)
+    user = "user"
+    client.save_content(user=user, content="My name is zhangwei\n\nI live in Beijing\n\nI like tea",
+                        content_type="personal")
+    client.save_content(user="other", content="My name is lisi", content_type="personal")
+
+    queries = ["What is my name?", "Where do I live?", "What do I drink?"]
+    results = client.similarity_search_batch(queries=queries, user=user, limit=1)
+    assert len(results) == 3
+    for query, docs in zip(queries, results):
+        assert [doc.page_content for doc in docs] == \
+               [doc.page_content for doc in client.similarity_search(query=query, user=user, limit=1)]
+        assert docs[0].metadata["user"] == user
+    assert len(set(docs[0].page_content for docs in results)) > 1
+    assert client.similarity_search_batch(queries=[], user=user) == []
+
+
+def test_context_below_context_size():
+    client = WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                   embedding_function=get_embedding_function(), context_size=20)
+    # stored token counts that underestimate the chunks
+    docs = [Document(page_content=text, metadata={"token_count": 1}) for text in ["营业时间是每天上午九点", "退款请拨打客服电话"]]
+    context = client._get_context(docs)
+    assert 0 < count_tokens(context) < 20
+    assert "营业时间是每天上午九点".startswith(context)
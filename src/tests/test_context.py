@@ -0,0 +1,94 @@
+import os
+
+from langchain_core.documents import Document
+
+from werag import WeRag
+from werag.context import ContextAssembler
+from werag.crud import CRUDChroma
+from werag.lexical import LexicalIndex
+from werag.utils import count_tokens
+from .utils import collection_name, get_chroma, get_embedding_function, prune_chroma
+
+index_path = "./context_pytest.sqlite3"
+
+
+def test_select_drops_near_duplicates():
+    assembler = ContextAssembler(duplicate_threshold=0.95, mmr_lambda=0.7)
+    embeddings = [[1.0, 0.1, 0.0], [1.0, 0.1, 0.001], [0.6, 0.0, 0.8], [0.0, 1.0, 0.0]]
+    selected = assembler.select(embeddings=embeddings, query_embedding=[1.0, 0.0, 0.0],
+                                token_counts=[10, 10, 10, 10], max_tokens=100)
+    # the copy of the best chunk is dropped, the unrelated chunk brings nothing
+    assert selected == [0, 2]
+
+
+def test_select_packs_by_relevance_per_token():
+    assembler = ContextAssembler(mmr_lambda=1.0)
+    embeddings = [[1.0, 0.0], [0.9, 0.4], [0.8, -0.5]]
+    # the best chunk alone would fill the budget, the two shorter ones carry more relevance
+    selected = assembler.select(embeddings=embeddings, query_embedding=[1.0, 0.0],
+                                token_counts=[90, 40, 40], max_tokens=100)
+    assert sorted(selected) == [1, 2]
+    assert assembler.select(embeddings=embeddings, query_embedding=[1.0, 0.0],
+                            token_counts=[90, 40, 40], max_tokens=10) == []
+
+
+def test_assemble():
+    assembler = ContextAssembler()
+    docs = [Document(page_content=text) for text in ["营业时间是每天上午九点", "退款请拨打客服电话", "营业时间是每天上午九点"]]
+    embeddings = [[0.5, 1.0], [1.0, 0.0], [0.5, 1.0]]
+    context = assembler.assemble(docs, embeddings=embeddings, query_embedding=[1.0, 0.2], max_tokens=100)
+    assert context == "退款请拨打客服电话\n营业时间是每天上午九点"
+    # nothing fits whole, the head of the most relevant chunk is kept
+    context = assembler.assemble(docs, embeddings=embeddings, query_embedding=[1.0, 0.2], max_tokens=3)
+    assert "退款请拨打客服电话".startswith(context) and 0 < count_tokens(context) <= 3
+    assert assembler.assemble([], embeddings=[], query_embedding=[1.0, 0.0], max_tokens=100) == ""
+
+
+def test_assemble_without_relevant_chunks():
+    assembler = ContextAssembler()
+    footer = "联系我们 | 关于我们"
+    docs = [Document(page_content=text) for text in [footer, "退款请拨打客服电话", footer]]
+    embeddings = [[-1.0, 0.2], [0.0, -1.0], [-1.0, 0.2]]
+    # every gain is negative, the chunks are packed anyway but the repeated footer once
+    context = assembler.assemble(docs, embeddings=embeddings, query_embedding=[1.0, 0.0], max_tokens=100)
+    assert context == f"退款请拨打客服电话\n{footer}"
+    # nothing fits whole, only the head of the most relevant chunk is kept
+    context = assembler.assemble(docs, embeddings=embeddings, query_embedding=[1.0, 0.0], max_tokens=3)
+    assert "退款请拨打客服电话".startswith(context) and 0 < count_tokens(context) <= 3
+
+
+def test_search_candidates():
+    chroma = get_chroma()
+    prune_chroma(chroma)
+    if os.path.exists(index_path): os.remove(index_path)
+    try:
+        content = "营业时间是每天上午九点\n\n退款请拨打客服电话\n\n型号X-200已经停产"
+        for crud in (CRUDChroma(chunk_size=10), CRUDChroma(chunk_size=10, lexical_index=LexicalIndex(index_path))):
+            crud.save_user_content(client=chroma, user="user1", content=content)
+            crud.save_user_content(client=chroma, user="user2", content="门店在人民路一号")
+            embedding = chroma.embeddings.embed_query("X-200")
+            docs, embeddings = crud.search_candidates(chroma, query="X-200", embedding=embedding, limit=10,
+                                                      user="user1")
+            assert sorted(doc.page_content for doc in docs) == sorted(content.split("\n\n"))
+            for doc, vector in zip(docs, embeddings):
+                assert len(vector) == len(embedding)
+                assert doc.metadata["token_count"] == count_tokens(doc.page_content)
+            assert docs[0].page_content == "型号X-200已经停产"
+    finally:
+        prune_chroma(chroma)
+        if os.path.exists(index_path): os.remove(index_path)
+
+
+def test_client_context_assembler():
+    client = WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                   embedding_function=get_embedding_function(), chunk_size=10,
+                   context_assembler=ContextAssembler(fetch_k=10))
+    prune_chroma(client._chroma)
+    footer = "联系我们 | 关于我们 | 隐私政策"
+    for index, page in enumerate(["营业时间是每天上午九点", "退款请拨打客服电话", "型号X-200已经停产"]):
+        client.save_content(content=f"{page}\n\n{footer}", user="user1", content_type=f"page{index}")
+    context = client._retrieve_context(question="营业时间", user="user1")
+    # the footer repeated on every page is packed once
+    assert context.count(footer) <= 1
+    assert "营业时间是每天上午九点" in context
+    prune_chroma(client._chroma)
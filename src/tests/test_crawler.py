@@ -0,0 +1,178 @@
+import hashlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from werag import WeRag
+from werag.crawler import Crawler
+from .utils import collection_name, get_client, get_embedding_function, prune_chroma
+
+site = {
+    "/": '<html lang="en"><head><title>Home</title><meta name="description" content="The home page"></head>'
+         '<body><h1>Home page</h1><a href="/a">a</a><a href="/b">b</a><a href="/c">c</a></body></html>',
+    "/a": '<html><body><p>Page a</p><a href="/b">b</a><a href="/d">d</a></body></html>',
+    "/b": '<html><body><p>Page b</p><a href="/">home</a></body></html>',
+    "/c": '<html><body><p>Page c</p></body></html>',
+    "/d": '<html><body><p>Page d</p></body></html>',
+}
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    site = dict(site)
+    requests = []
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append(self.path)
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(0.05)
+        body = cls.site.get(self.path)
+        etag = f'"{hashlib.md5(body.encode("utf-8")).hexdigest()}"' if body is not None else None
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200 if body is not None else 404)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            if etag is not None: self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write((body or "not found").encode("utf-8"))
+        with cls.lock:
+            cls.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_site():
+    SiteHandler.site = dict(site)
+    SiteHandler.requests = []
+    SiteHandler.max_active = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_crawl_depth():
+    server, base = serve_site()
+    try:
+        docs = list(Crawler(max_depth=1).crawl([base + "/"]))
+        assert len(docs) == 1
+        assert "Home page" in docs[0].page_content
+        assert "<h1>" not in docs[0].page_content
+
+        docs = list(Crawler(max_depth=2).crawl([base + "/"]))
+        assert sorted(doc.metadata["source"] for doc in docs) == [base + p for p in ["/", "/a", "/b", "/c"]]
+    finally:
+        server.shutdown()
+
+
+def test_crawl_visits_shared_pages_once():
+    server, base = serve_site()
+    try:
+        docs = list(Crawler(max_depth=3, max_workers=8, max_per_host=2).crawl([base + "/", base + "/a"]))
+        assert sorted(doc.metadata["source"] for doc in docs) == [base + p for p in sorted(site.keys())]
+        assert sorted(SiteHandler.requests) == sorted(site.keys())
+        assert SiteHandler.max_active <= 2
+    finally:
+        server.shutdown()
+
+
+def test_crawl_extractors():
+    server, base = serve_site()
+    try:
+        doc = list(Crawler().crawl([base + "/"]))[0]
+        assert doc.metadata["title"] == "Home" and doc.metadata["description"] == "The home page"
+        assert doc.metadata["language"] == "en" and doc.metadata["content_type"].startswith("text/html")
+
+        crawler = Crawler(max_depth=2, use_async=True, base_url=base + "/",
+                          extractor=lambda raw_html: raw_html.replace("Page", "Extracted page"),
+                          metadata_extractor=lambda raw_html, url: {"source": url, "size": len(raw_html)})
+        docs = sorted(crawler.crawl([base + "/a"]), key=lambda doc: doc.metadata["source"])
+        # the links of /a are outside of /a but inside base_url
+        assert [doc.metadata["source"] for doc in docs] == [base + p for p in ["/a", "/b", "/d"]]
+        assert all(doc.page_content.startswith("Extracted page") for doc in docs)
+        assert docs[0].metadata == {"source": base + "/a", "size": len(site["/a"])}
+    finally:
+        server.shutdown()
+
+
+def test_crawl_failure():
+    docs = list(Crawler(timeout=1).crawl(["http://127.0.0.1:1/"]))
+    assert docs == []
+
+
+def test_client_save_urls_local_site():
+    client = get_client()
+    prune_chroma(client._chroma)
+    server, base = serve_site()
+    try:
+        client.save_urls(user="user_site", urls=[base + "/"], max_depth=2, content_type="site")
+    finally:
+        server.shutdown()
+    doc = client._chroma.get(where={"user": "user_site"})
+    content = "\n".join(doc['documents'])
+    for phrase in ["Home page", "Page a", "Page b", "Page c"]:
+        assert phrase in content
+    assert "Page d" not in content
+
+
+def test_client_crawl_state_opened_lazily():
+    state_path = "./crawl_state_pytest.sqlite3"
+    if os.path.exists(state_path): os.remove(state_path)
+    client = WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                   embedding_function=get_embedding_function(), crawl_state_path=state_path)
+    assert not os.path.exists(state_path)
+    server, base = serve_site()
+    try:
+        client.save_urls(user="user_lazy", urls=[base + "/"], content_type="site")
+        assert os.path.exists(state_path)
+    finally:
+        server.shutdown()
+        prune_chroma(client._chroma)
+        os.remove(state_path)
+
+
+def test_client_save_urls_conditional():
+    client = get_client()
+    prune_chroma(client._chroma)
+    server, base = serve_site()
+    user, content_type = "user_conditional", "site"
+    try:
+        first = client.save_urls(user=user, urls=[base + "/"], max_depth=2, content_type=content_type)
+        assert first.crawl_stats.changed == 4
+        assert first.crawl_stats.fetched == 4
+        assert first.chunk_diff.added > 0
+
+        # nothing changed: every page answers 304 and nothing is embedded
+        second = client.save_urls(user=user, urls=[base + "/"], max_depth=2, content_type=content_type)
+        assert second.crawl_stats.not_modified == 4
+        assert second.crawl_stats.fetched == 0
+        assert second.chunk_diff.added == 0
+        assert second.chunk_diff.removed == 0
+        # the pages that were not downloaded again are part of the returned content
+        assert "".join(second.page_content.split()) == "".join(first.page_content.split())
+
+        # one page changed, one page is not linked any more
+        SiteHandler.site["/c"] = '<html><body><p>Page c, edited</p></body></html>'
+        SiteHandler.site["/"] = '<html><body><h1>Home page</h1><a href="/a">a</a><a href="/c">c</a></body></html>'
+        third = client.save_urls(user=user, urls=[base + "/"], max_depth=2, content_type=content_type)
+        assert third.crawl_stats.changed == 2
+        assert third.crawl_stats.not_modified == 1
+        assert third.crawl_stats.removed == 1
+        assert "Page a" in third.page_content and "Page c, edited" in third.page_content
+        assert "Page b" not in third.page_content
+    finally:
+        server.shutdown()
+
+    doc = client._chroma.get(where={"user": user})
+    content = "\n".join(doc['documents'])
+    assert "Page c, edited" in content
+    assert "Page b" not in content
+    assert "Page a" in content
@@ -1,4 +1,7 @@
+from langchain_core.documents import Document
+
 from werag.crud import CRUDChroma
+from werag.utils import count_tokens
 from .utils import get_chroma, prune_chroma
 
 crud = CRUDChroma(chunk_size=1000)
@@ -119,4 +122,97 @@ def test_search_user_content():
     assert len(docs) == 1
     assert docs[0].page_content == content
     assert docs[0].metadata['user'] == user
-    assert docs[0].metadata['content_type'] == content_type
\ No newline at end of file
+    assert docs[0].metadata['content_type'] == content_type
+
+def test_save_user_content_incremental():
+    prune_chroma(chroma)
+    with open("assets/lorem.txt", mode="r") as f:
+        content = f.read()
+
+    user = "user1"
+    content_type = "lorem"
+    first = crud.save_user_content(client=chroma, user=user, content=content, content_type=content_type)
+    assert first.chunk_diff.added > 1
+    assert first.chunk_diff.kept == 0
+
+    # saving the same content again writes nothing
+    same = crud.save_user_content(client=chroma, user=user, content=content, content_type=content_type)
+    assert same.chunk_diff.added == 0
+    assert same.chunk_diff.removed == 0
+    assert same.chunk_diff.kept == first.chunk_diff.added
+
+    # only the edited chunk is replaced
+    edited_content = content.replace("Lorem ipsum", "Edited ipsum", 1)
+    edited = crud.save_user_content(client=chroma, user=user, content=edited_content, content_type=content_type)
+    assert edited.chunk_diff.added == 1
+    assert edited.chunk_diff.removed == 1
+    assert edited.chunk_diff.kept == first.chunk_diff.added - 1
+
+    doc = chroma.get(where={"user": user})
+    assert len(doc['ids']) == first.chunk_diff.added
+    for c in doc['documents']:
+        assert c in edited_content
+
+
+def test_save_user_documents_stream():
+    prune_chroma(chroma)
+    with open("assets/lorem.txt", mode="r") as f:
+        paragraphs = [p for p in f.read().split("\n\n") if p.strip()]
+
+    user = "user1"
+    documents = (Document(page_content=p, metadata={"source": f"p{index}"}) for index, p in enumerate(paragraphs))
+    user_content = crud.save_user_documents(client=chroma, user=user, documents=documents, batch_size=2,
+                                            stream=True)
+    assert user_content.chunk_diff.added >= len(paragraphs)
+    assert user_content.page_content == ""
+
+    doc = chroma.get(where={"user": user})
+    assert len(doc['ids']) == user_content.chunk_diff.added
+    for c in doc['documents']:
+        assert any(c in p for p in paragraphs)
+
+    assert crud.save_user_documents(client=chroma, user=user, documents=iter([])) is None
+
+    # without stream the saved text is returned, nothing changed so nothing is written
+    documents = (Document(page_content=p, metadata={"source": f"p{index}"}) for index, p in enumerate(paragraphs))
+    user_content = crud.save_user_documents(client=chroma, user=user, documents=documents, batch_size=2)
+    assert user_content.page_content == "\n".join(paragraphs)
+    assert user_content.chunk_diff.added == 0 and user_content.chunk_diff.removed == 0
+
+
+def test_iter_user_content():
+    prune_chroma(chroma)
+    small_crud = CRUDChroma(chunk_size=10)
+    content = "\n\n".join(f"paragraph {index}" for index in range(25))
+    small_crud.save_user_content(client=chroma, user="user1", content=content, content_type="paragraphs")
+    small_crud.save_user_content(client=chroma, user="user2", content="other user", content_type="paragraphs")
+
+    first_page = crud.get_user_content_page(client=chroma, user="user1", content_type="paragraphs", limit=10)
+    assert len(first_page) == 10
+    assert all(c.page_content.startswith("paragraph") for c in first_page)
+
+    contents = list(crud.iter_user_content(client=chroma, user="user1", page_size=10))
+    assert len(contents) == 25
+    assert [c.id for c in contents[:10]] == [c.id for c in first_page]
+    assert sorted(c.page_content for c in contents) == sorted(f"paragraph {index}" for index in range(25))
+
+    ids_only = list(crud.iter_user_content(client=chroma, user="user1", page_size=7, include_documents=False))
+    assert [c.id for c in ids_only] == [c.id for c in contents]
+    assert all(c.page_content == "" and c.user == "user1" for c in ids_only)
+
+
+def test_save_user_content_split_by_token():
+    prune_chroma(chroma)
+    with open("assets/lorem.txt", mode="r") as f:
+        content = f.read()
+    token_crud = CRUDChroma(chunk_size=200, split_by="token")
+    token_crud.save_user_content(client=chroma, user="user1", content=content)
+
+    doc = chroma.get(where={"user": "user1"})
+    assert len(doc['ids']) > 1
+    for document, metadata in zip(doc['documents'], doc['metadatas']):
+        assert metadata['token_count'] == count_tokens(document)
+        assert metadata['token_count'] <= 200
+    # the character splitter records the token counts too
+    crud.save_user_content(client=chroma, user="user2", content="content1")
+    assert chroma.get(where={"user": "user2"})['metadatas'][0]['token_count'] == count_tokens("content1")
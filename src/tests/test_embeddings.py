@@ -0,0 +1,120 @@
+import os
+import time
+
+import pytest
+
+from langchain_community.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+
+from werag.crud import CRUDChroma
+from werag.embeddings import CachedEmbeddings, ParallelSentenceTransformerEmbeddings, embed_queries
+from werag.numpy_store import NumpyVectorStore
+from .utils import CountingEmbeddings
+
+cache_path = "./embedding_cache_pytest.sqlite3"
+
+
+def remove_cache_file():
+    if os.path.exists(cache_path): os.remove(cache_path)
+
+
+def test_cached_embeddings_only_embed_misses():
+    base = CountingEmbeddings()
+    cached = CachedEmbeddings(base)
+
+    assert cached.embed_documents(["a", "bb", "a"]) == [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0]]
+    assert base.embedded == ["a", "bb"]
+
+    assert cached.embed_documents(["bb", "ccc"]) == [[2.0, 1.0], [3.0, 1.0]]
+    assert base.embedded == ["a", "bb", "ccc"]
+
+    # queries are cached separately from documents
+    assert cached.embed_query("a") == [1.0, 2.0]
+    assert cached.embed_query("a") == [1.0, 2.0]
+    assert base.embedded == ["a", "bb", "ccc", "a"]
+
+    stats = cached.stats()
+    assert stats["misses"] == 4
+    assert stats["hits"] == 3
+
+
+def test_cached_embeddings_persist():
+    remove_cache_file()
+    base = CountingEmbeddings()
+    CachedEmbeddings(base, cache_path=cache_path).embed_documents(["a", "bb"])
+
+    # a new wrapper (new process) reads the vectors from disk
+    new_base = CountingEmbeddings()
+    cached = CachedEmbeddings(new_base, cache_path=cache_path)
+    assert cached.embed_documents(["bb", "a"]) == [[2.0, 1.0], [1.0, 1.0]]
+    assert new_base.embedded == []
+    assert cached.stats()["hits"] == 2
+
+    # a different model does not share vectors
+    other = CountingEmbeddings()
+    CachedEmbeddings(other, cache_path=cache_path, model_id="other").embed_documents(["a"])
+    assert other.embedded == ["a"]
+    remove_cache_file()
+
+
+class ThirdsEmbeddings(CountingEmbeddings):
+
+    def embed_documents(self, texts):
+        return [[len(text) / 3, 0.1] for text in texts]
+
+
+def test_cached_embeddings_same_vector_from_every_level():
+    remove_cache_file()
+    try:
+        fresh = CachedEmbeddings(ThirdsEmbeddings(), cache_path=cache_path).embed_documents(["a", "bb"])
+        cached = CachedEmbeddings(ThirdsEmbeddings(), cache_path=cache_path)
+        # read from the file, then from memory
+        assert cached.embed_documents(["a", "bb"]) == fresh
+        assert cached.embed_documents(["a", "bb"]) == fresh
+        assert cached.stats()["hits"] == 4
+    finally:
+        remove_cache_file()
+
+
+def test_parallel_sentence_transformer_embeddings():
+    embeddings = ParallelSentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2", num_workers=2,
+                                                       shard_size=4, min_parallel_size=8)
+    local = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+    try:
+        # every worker answers the warm up, not the first one ready twice
+        assert len(set(embeddings.warm_up())) == 2
+        texts = [f"document number {index} " * (index % 5 + 1) for index in range(30)]
+        assert embeddings.embed_documents(texts) == local.embed_documents(texts)
+        # small batches and queries stay in process
+        assert embeddings.embed_documents(texts[:3]) == local.embed_documents(texts[:3])
+        assert embeddings.embed_query("hello") == local.embed_query("hello")
+    finally:
+        embeddings.close()
+
+
+def test_parallel_embeddings_warm_up_timeout():
+    embeddings = ParallelSentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2", num_workers=2,
+                                                       warm_up=False)
+    try:
+        # one worker is busy, the other one gives up waiting for it
+        busy = embeddings._executor.submit(time.sleep, 2)
+        with pytest.raises(RuntimeError, match="within 0.5 seconds"):
+            embeddings.warm_up(timeout=0.5)
+        busy.result()
+        assert len(set(embeddings.warm_up(timeout=10))) == 2
+    finally:
+        embeddings.close()
+
+
+def test_embed_queries():
+    base = CountingEmbeddings()
+    assert embed_queries(base, ["a", "bb"]) == [[1.0, 2.0], [2.0, 2.0]]
+
+    # batched searches embed queries, sharing the query cache of similarity_search
+    cached = CachedEmbeddings(base)
+    store = NumpyVectorStore(embedding_function=cached)
+    store.add_texts(["a", "bbb"], metadatas=[{"user": "user"}, {"user": "user"}])
+    crud = CRUDChroma()
+    results = crud.search_documents_batch(store, queries=["a", "bb", "a"], limit=1, user="user")
+    assert [docs[0].page_content for docs in results] == ["a", "a", "a"]
+    assert cached.embed_queries(["bb", "a"]) == [[2.0, 2.0], [1.0, 2.0]]
+    assert cached.stats()["misses"] == 4  # two documents and two queries
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+from langchain_core.documents import Document
+
+from werag.ingest import IngestPipeline, read_text_blocks, stream_documents
+from .utils import CountingEmbeddings
+
+chinese_path = "./ingest_pytest.txt"
+
+
+def test_read_text_blocks():
+    with open("assets/lorem.txt", mode="r") as f:
+        content = f.read()
+    blocks = list(read_text_blocks("assets/lorem.txt", block_size=100))
+    assert len(blocks) > 1
+    assert "".join(blocks) == content
+
+    # multi-byte characters cut by a block boundary
+    chinese = "营业时间是每天上午九点到晚上十点。\n\n如需退款请联系客服。\n\n" * 20
+    with open(chinese_path, mode="w", encoding="utf-8") as f:
+        f.write(chinese)
+    try:
+        assert "".join(read_text_blocks(chinese_path, block_size=7)) == chinese
+    finally:
+        os.remove(chinese_path)
+
+
+def test_stream_documents():
+    paragraphs = [f"paragraph {index} " * 5 for index in range(50)]
+    content = "\n\n".join(paragraphs)
+    blocks = [content[i:i + 64] for i in range(0, len(content), 64)]
+    docs = list(stream_documents(blocks, metadata={"source": "memory"}, max_size=300))
+    assert len(docs) > 1
+    assert "".join(doc.page_content for doc in docs) == content
+    for doc in docs[:-1]:
+        assert len(doc.page_content) <= 300
+        assert doc.page_content.endswith("\n\n")
+        assert doc.metadata == {"source": "memory"}
+
+    # no separator at all
+    docs = list(stream_documents(["x" * 250], metadata={}, max_size=100))
+    assert [len(doc.page_content) for doc in docs] == [100, 100, 50]
+
+
+def test_ingest_pipeline():
+    embeddings = CountingEmbeddings()
+    writes = []
+
+    def writer(*, ids, embeddings, metadatas, documents):
+        writes.append((ids, embeddings, metadatas, documents))
+
+    chunks = [(str(index), Document(page_content="x" * index, metadata={"index": index, "source": None}))
+              for index in range(1, 101)]
+    pipeline = IngestPipeline(embedding_function=embeddings, writer=writer,
+                              batch_size=8, write_batch_size=32, queue_size=2)
+    stats = pipeline.run(iter(chunks))
+
+    assert embeddings.calls == [8] * 12 + [4]
+    assert [len(ids) for ids, _, _, _ in writes] == [32, 32, 32, 4]
+    assert sum((ids for ids, _, _, _ in writes), []) == [_id for _id, _ in chunks]
+    assert sum((vectors for _, vectors, _, _ in writes), []) == [[float(index), 1.0] for index in range(1, 101)]
+    assert writes[0][2][0] == {"index": 1}
+    assert stats.split.items == stats.embed.items == stats.write.items == 100
+    assert (stats.split.batches, stats.embed.batches, stats.write.batches) == (13, 13, 4)
+
+    assert pipeline.run(iter([])).write.items == 0
+
+
+def test_ingest_pipeline_failure():
+    def writer(**kwargs):
+        raise RuntimeError("storage is down")
+
+    chunks = ((str(index), Document(page_content="chunk")) for index in range(10000))
+    pipeline = IngestPipeline(embedding_function=CountingEmbeddings(), writer=writer,
+                              batch_size=4, write_batch_size=4, queue_size=1)
+    with pytest.raises(RuntimeError, match="storage is down"):
+        pipeline.run(chunks)
@@ -0,0 +1,80 @@
+import os
+
+from werag import WeRag
+from werag.crud import CRUDChroma
+from werag.lexical import LexicalIndex, reciprocal_rank_fusion, tokenize
+from .utils import collection_name, get_chroma, get_embedding_function, prune_chroma
+
+index_path = "./lexical_pytest.sqlite3"
+chroma = get_chroma()
+
+
+def remove_index_file():
+    if os.path.exists(index_path): os.remove(index_path)
+
+
+def test_tokenize():
+    terms = tokenize("退款请拨打138-0013-8000，型号X-200")
+    assert "退款" in terms and "拨打" in terms and "退" in terms
+    assert "138-0013-8000" in terms and "13800138000" in terms
+    assert "x-200" in terms and "x200" in terms
+    assert tokenize("Ｘ－２００") == tokenize("x-200")
+
+
+def test_reciprocal_rank_fusion():
+    assert reciprocal_rank_fusion([["a", "b", "c"], ["c", "b"]]) == ["c", "b", "a"]
+    assert reciprocal_rank_fusion([["a", "b"], []]) == ["a", "b"]
+
+
+def test_lexical_index_follows_writes():
+    remove_index_file()
+    prune_chroma(chroma)
+    try:
+        crud = CRUDChroma(chunk_size=10, lexical_index=LexicalIndex(index_path))
+        faq = "营业时间是每天上午九点\n\n退款请拨打138-0013-8000\n\n型号X-200已经停产"
+        crud.save_user_content(client=chroma, user="user1", content=faq, content_type="faq")
+        crud.save_user_content(client=chroma, user="user2", content="退款请拨打400-800-8888", content_type="faq")
+
+        results = crud.lexical_index.search(chroma, query="X-200还有吗", user="user1")
+        assert chroma.get(ids=[results[0][0]])['documents'] == ["型号X-200已经停产"]
+        results = crud.lexical_index.search(chroma, query="退款电话", user="user2", content_type="faq")
+        assert len(results) == 1
+        assert chroma.get(ids=[results[0][0]])['metadatas'][0]['user'] == "user2"
+
+        # removed chunks leave the index, and the index survives a restart
+        crud.save_user_content(client=chroma, user="user1", content="营业时间是每天上午九点", content_type="faq")
+        reopened = LexicalIndex(index_path)
+        assert reopened.search(chroma, query="X-200", user="user1") == []
+        assert len(reopened.search(chroma, query="营业时间", user="user1")) == 1
+    finally:
+        remove_index_file()
+
+
+def test_hybrid_search():
+    remove_index_file()
+    try:
+        client = WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                       embedding_function=get_embedding_function(), chunk_size=10,
+                       hybrid_search=True, lexical_index_path=index_path)
+        prune_chroma(client._chroma)
+        client._crud.lexical_index.clear()
+        paragraphs = [f"常见问题{index}的答案是{index}" for index in range(20)] + ["客服电话138-0013-8000"]
+        client.save_content(user="user", content="\n\n".join(paragraphs), content_type="faq")
+
+        docs = client.similarity_search(query="13800138000", user="user", limit=2)
+        assert "客服电话138-0013-8000" in [doc.page_content for doc in docs]
+        assert all(doc.metadata["user"] == "user" for doc in docs)
+
+        # batched searches are fused the same way
+        lexical_search, searched = client._crud.lexical_index.search, []
+        client._crud.lexical_index.search = lambda *args, **kwargs: \
+            searched.append(kwargs["query"]) or lexical_search(*args, **kwargs)
+        queries = ["13800138000", "常见问题3"]
+        results = client.similarity_search_batch(queries=queries, user="user", limit=2)
+        assert searched == queries
+        for query, docs in zip(queries, results):
+            assert [doc.page_content for doc in docs] == \
+                   [doc.page_content for doc in client.similarity_search(query=query, user="user", limit=2)]
+        assert "客服电话138-0013-8000" in [doc.page_content for doc in results[0]]
+    finally:
+        remove_index_file()
@@ -0,0 +1,74 @@
+import os
+
+from werag import WeRag
+from werag.crud import CRUDChroma
+from werag.manifest import ChunkManifest
+from .utils import get_chroma, get_embedding_function, prune_chroma
+
+manifest_path = "./manifest_pytest.sqlite3"
+chroma = get_chroma()
+
+
+def remove_manifest_file():
+    if os.path.exists(manifest_path): os.remove(manifest_path)
+
+
+def test_manifest_follows_writes():
+    remove_manifest_file()
+    prune_chroma(chroma)
+    crud_without_manifest = CRUDChroma(chunk_size=1000)
+    crud_without_manifest.save_user_content(client=chroma, user="user1", content="saved before the manifest")
+
+    manifest = ChunkManifest(manifest_path)
+    crud = CRUDChroma(chunk_size=1000, manifest=manifest)
+    try:
+        # the collection is built from chroma on first use
+        assert crud.has_user_content(chroma, user="user1")
+        assert not crud.has_user_content(chroma, user="user2")
+
+        with open("assets/lorem.txt", mode="r") as f:
+            content = f.read()
+        crud.save_user_content(client=chroma, user="user1", content=content, content_type="lorem")
+        crud.save_user_content(client=chroma, user="user2", content="content of user2", content_type="personal")
+        for user, content_type in [("user1", "lorem"), ("user1", None), ("user2", "personal")]:
+            stored = set(chroma.get(where=crud.get_user_content_filter(user=user, content_type=content_type))['ids'])
+            assert manifest.get_ids(chroma, user=user, content_type=content_type) == stored
+
+        contents = crud.get_user_content(client=chroma, user="user1", content_type="lorem")
+        assert len(contents) > 1
+        assert all(c.content_type == "lorem" and c.page_content in content for c in contents)
+        paged = list(crud.iter_user_content(client=chroma, user="user1", content_type="lorem", page_size=2))
+        assert sorted(c.id for c in paged) == sorted(c.id for c in contents)
+
+        diff = crud.save_user_content(client=chroma, user="user1", content="short now", content_type="lorem").chunk_diff
+        assert diff.removed == len(contents)
+        assert len(crud.get_user_content(client=chroma, user="user1", content_type="lorem")) == 1
+        assert manifest.check(chroma) == {"missing": 0, "extra": 0, "repaired": False}
+
+        # a write behind its back is repaired by the checker
+        crud_without_manifest.save_user_content(client=chroma, user="user3", content="content of user3")
+        assert not crud.has_user_content(chroma, user="user3")
+        assert manifest.check(chroma) == {"missing": 1, "extra": 0, "repaired": True}
+        assert crud.has_user_content(chroma, user="user3")
+    finally:
+        remove_manifest_file()
+
+
+def test_check_manifest_of_shards():
+    remove_manifest_file()
+    client = WeRag(persist_directory="./chroma_persist", collection_name="werag__pytest_shared",
+                   embedding_function=get_embedding_function(), sharding="bucket", num_buckets=2,
+                   chunk_manifest_path=manifest_path)
+    try:
+        users = ["user0", "user1", "user2", "user3"]
+        for user in users: prune_chroma(client._get_chroma(user=user))
+        for user in users: client.save_content(user=user, content=f"My name is {user}", content_type="personal")
+        assert client.check_manifest() == {"missing": 0, "extra": 0, "repaired": False}
+
+        # a write behind its back, in a shard, is found without naming the user
+        CRUDChroma(chunk_size=1000).save_user_content(client=client._get_chroma(user="user3"), user="user4",
+                                                      content="content of user4")
+        assert client.check_manifest() == {"missing": 1, "extra": 0, "repaired": True}
+        assert client._crud.has_user_content(client._get_chroma(user="user3"), user="user4")
+    finally:
+        remove_manifest_file()
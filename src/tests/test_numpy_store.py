@@ -0,0 +1,238 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from werag import WeRag
+from werag.crud import CRUDChroma
+from werag.db import query_embeddings
+from werag.numpy_store import NumpyVectorStore
+from .utils import collection_name, get_chroma, get_embedding_function, prune_chroma
+
+persist_directory = "./numpy_persist"
+
+
+def remove_persist_directory():
+    shutil.rmtree(persist_directory, ignore_errors=True)
+
+
+def test_numpy_store_matches_chroma():
+    chroma = get_chroma()
+    prune_chroma(chroma)
+    store = NumpyVectorStore(collection_name=collection_name, embedding_function=get_embedding_function())
+    crud = CRUDChroma(chunk_size=10)
+    content = "营业时间是每天上午九点\n\n退款请拨打客服电话\n\n型号X-200已经停产\n\n门店在人民路一号"
+    for client in (chroma, store):
+        crud.save_user_content(client=client, user="user1", content=content, content_type="faq")
+        crud.save_user_content(client=client, user="user2", content="退款请拨打400-800-8888", content_type="faq")
+
+    for user, content_type in (("user1", "faq"), ("user1", None), ("user2", "faq"), ("user3", None)):
+        assert crud.get_user_chunk_ids(store, user=user, content_type=content_type) == \
+            crud.get_user_chunk_ids(chroma, user=user, content_type=content_type)
+        for query in ("退款", "X-200", "门店地址"):
+            expected = crud.search_documents(chroma, query=query, limit=3, user=user, content_type=content_type)
+            found = crud.search_documents(store, query=query, limit=3, user=user, content_type=content_type)
+            assert [document.page_content for document in found] == \
+                [document.page_content for document in expected]
+    assert sorted(content.id for content in crud.get_user_content(store, user="user1", content_type="faq")) == \
+        sorted(content.id for content in crud.get_user_content(chroma, user="user1", content_type="faq"))
+
+    # a chunk moving to another user leaves the first tenant
+    crud.save_user_content(client=store, user="user1", content="门店在人民路一号", content_type="faq")
+    assert store.get(where={"user": "user1"})['documents'] == ["门店在人民路一号"]
+    assert store.get(where={"$and": [{"user": "user1"}, {"content_type": {"$ne": "faq"}}]})['ids'] == []
+    prune_chroma(chroma)
+
+
+def test_numpy_store_search():
+    store = NumpyVectorStore(embedding_function=get_embedding_function(), dtype="float16")
+    vectors = np.random.default_rng(0).normal(size=(50, 8)).astype(np.float32)
+    store.upsert(ids=[str(index) for index in range(50)], embeddings=vectors.tolist(),
+                 metadatas=[{"user": f"user{index % 2}", "index": index} for index in range(50)],
+                 documents=[str(index) for index in range(50)])
+    store.delete(ids=["0", "2", "3"])
+
+    results = query_embeddings(store, embeddings=vectors[:3].tolist(), k=3, where={"user": "user0"})
+    for vector, documents in zip(vectors[:3], results):
+        rows = [int(document.page_content) for document in documents]
+        assert all(row % 2 == 0 and row not in (0, 2) for row in rows)
+        distances = [float(np.sum((vectors[row] - vector) ** 2)) for row in rows]
+        assert distances == sorted(distances)
+    documents = store.similarity_search_by_vector(vectors[4].tolist(), k=1, filter={"index": {"$gte": 40}})
+    assert int(documents[0].page_content) >= 40
+    assert len(store.get(where={"user": {"$in": ["user0", "user1"]}})['ids']) == 47
+
+
+def test_numpy_store_quantization():
+    remove_persist_directory()
+    try:
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(500, 32)).astype(np.float32)
+        queries = vectors[:20] + rng.normal(scale=0.1, size=(20, 32)).astype(np.float32)
+        metadatas = [{"user": "user1"} for _ in range(500)]
+        stores = {}
+        for dtype in ("float32", "int8"):
+            stores[dtype] = NumpyVectorStore(collection_name=dtype, persist_directory=persist_directory,
+                                             embedding_function=get_embedding_function(), dtype=dtype)
+            stores[dtype].upsert(ids=[str(index) for index in range(500)], embeddings=vectors.tolist(),
+                                 metadatas=metadatas, documents=[str(index) for index in range(500)])
+        exact = query_embeddings(stores["float32"], embeddings=queries.tolist(), k=5)
+        quantized = query_embeddings(stores["int8"], embeddings=queries.tolist(), k=5)
+        assert [[document.page_content for document in documents] for documents in quantized] == \
+            [[document.page_content for document in documents] for documents in exact]
+
+        # the int8 matrix is resident, the float32 vectors stay on disk for the re-score
+        tenant = stores["int8"]._tenants["user1"]
+        assert tenant.vectors.dtype == np.int8 and isinstance(tenant.full, np.memmap)
+        assert np.array_equal(stores["int8"].get(ids=["7"], include=["embeddings"])['embeddings'][0], vectors[7])
+
+        # a store opened with another dtype converts the stored vectors once
+        reopened = NumpyVectorStore(collection_name="float32", persist_directory=persist_directory,
+                                    embedding_function=get_embedding_function(), dtype="float16", rescore_factor=1)
+        assert reopened._tenants["user1"].vectors.dtype == np.float16
+        assert reopened._tenants["user1"].full is None
+        approximate = query_embeddings(reopened, embeddings=queries.tolist(), k=1)
+        assert [documents[0].page_content for documents in approximate] == \
+            [documents[0].page_content for documents in exact]
+    finally:
+        remove_persist_directory()
+
+
+def test_numpy_store_persistence():
+    remove_persist_directory()
+    try:
+        store = NumpyVectorStore(persist_directory=persist_directory, embedding_function=get_embedding_function())
+        store.add_texts(["营业时间是每天上午九点", "退款请拨打客服电话"], metadatas=[{"user": "user1"}] * 2,
+                        ids=["a", "b"])
+        reopened = NumpyVectorStore(persist_directory=persist_directory, embedding_function=get_embedding_function())
+        assert reopened.similarity_search("退款", k=1, filter={"user": "user1"})[0].page_content == "退款请拨打客服电话"
+
+        # the memory mapped matrix is copied before it is written
+        reopened.delete(ids=["a"])
+        reopened.add_texts(["门店在人民路一号"], metadatas=[{"user": "user1"}], ids=["c"])
+        reopened = NumpyVectorStore(persist_directory=persist_directory, embedding_function=get_embedding_function())
+        assert sorted(reopened.get(include=["documents"])['documents']) == ["退款请拨打客服电话", "门店在人民路一号"]
+        assert len(reopened.get(ids=["c"], include=["embeddings"])['embeddings'][0]) > 0
+    finally:
+        remove_persist_directory()
+
+
+def test_numpy_store_saves_once_per_save():
+    remove_persist_directory()
+    try:
+        store = NumpyVectorStore(persist_directory=persist_directory, embedding_function=get_embedding_function())
+        saved = []
+        save_tenant = store._save_tenant
+        store._save_tenant = lambda tenant: saved.append(tenant.user) or save_tenant(tenant)
+        crud = CRUDChroma(chunk_size=10, batch_size=2, write_batch_size=2)
+        content = "\n\n".join(f"paragraph {index}" for index in range(20))
+        diff = crud.save_user_content(client=store, user="user1", content=content).chunk_diff
+        # ten write batches, one save
+        assert diff.ingest_stats.write.batches == 10
+        assert saved == ["user1"]
+        crud.save_user_contents(client=store, records=[("user1", None, "paragraph 0"), ("user2", None, "other")])
+        assert sorted(saved[1:]) == ["user1", "user2"]
+        reopened = NumpyVectorStore(persist_directory=persist_directory, embedding_function=get_embedding_function())
+        assert sorted(reopened.get(include=["documents"])['documents']) == ["other", "paragraph 0"]
+    finally:
+        remove_persist_directory()
+
+
+def test_numpy_store_crash_during_save():
+    remove_persist_directory()
+    try:
+        store = NumpyVectorStore(persist_directory=persist_directory, embedding_function=get_embedding_function(),
+                                 dtype="int8")
+        store.add_texts(["营业时间是每天上午九点", "退款请拨打客服电话"], metadatas=[{"user": "user1"}] * 2,
+                        ids=["a", "b"])
+        directory = store.directory
+        files = sorted(os.listdir(directory))
+
+        # the matrices of the next version are written, the process dies before the .json file is replaced
+        def crash(*args):
+            raise KeyboardInterrupt
+
+        replace, os.replace = os.replace, crash
+        try:
+            with pytest.raises(KeyboardInterrupt):
+                store.add_texts(["门店在人民路一号"], metadatas=[{"user": "user1"}], ids=["c"])
+        finally:
+            os.replace = replace
+        assert len(os.listdir(directory)) > len(files)
+
+        reopened = NumpyVectorStore(persist_directory=persist_directory, embedding_function=get_embedding_function(),
+                                    dtype="int8")
+        assert sorted(reopened.get(include=["documents"])['documents']) == ["营业时间是每天上午九点", "退款请拨打客服电话"]
+        assert reopened.similarity_search("退款", k=1, filter={"user": "user1"})[0].page_content == "退款请拨打客服电话"
+        # the orphan files are removed
+        assert sorted(os.listdir(directory)) == files
+
+        # ids and matrices of different lengths are refused
+        name = [name for name in files if name.endswith(".json")][0]
+        with open(os.path.join(directory, name), mode="r", encoding="utf-8") as f:
+            data = json.load(f)
+        data["ids"].append("c")
+        with open(os.path.join(directory, name), mode="w", encoding="utf-8") as f:
+            json.dump(data, f)
+        with pytest.raises(ValueError, match="2 stored vectors for 3 ids"):
+            NumpyVectorStore(persist_directory=persist_directory, embedding_function=get_embedding_function(),
+                             dtype="int8")
+    finally:
+        remove_persist_directory()
+
+
+def test_numpy_client():
+    remove_persist_directory()
+    try:
+        client = WeRag(persist_directory=persist_directory, collection_name=collection_name,
+                       embedding_function=get_embedding_function(), chunk_size=10,
+                       vector_store="numpy", sharding="bucket", num_buckets=2)
+        client.save_content(content="营业时间是每天上午九点\n\n退款请拨打客服电话", user="user1", content_type="faq")
+        client.save_content(content="门店在人民路一号", user="user2", content_type="faq")
+        assert client.similarity_search(query="退款", user="user1", limit=1)[0].page_content == "退款请拨打客服电话"
+        assert [document.page_content for document in client.similarity_search(query="退款", user="user2")] == \
+            ["门店在人民路一号"]
+        assert client.has_content(user="user2", content_type="faq")
+    finally:
+        remove_persist_directory()
+
+
+def test_numpy_client_evicted_collection():
+    remove_persist_directory()
+    try:
+        client = WeRag(persist_directory=persist_directory, collection_name=collection_name,
+                       embedding_function=get_embedding_function(), chunk_size=10,
+                       vector_store="numpy", sharding="user", max_open_collections=1)
+        store = client._get_chroma(user="user1")
+        client.save_content(content="门店在人民路一号", user="user2", content_type="faq")
+        # user1 was evicted from the router, the handle held above must still see its saves
+        assert client._get_chroma(user="user1") is store
+        client.save_content(content="退款请拨打客服电话", user="user1", content_type="faq")
+        assert store.get(where={"user": "user1"})["documents"] == ["退款请拨打客服电话"]
+    finally:
+        remove_persist_directory()
+
+
+def test_numpy_store_retrievers_match_chroma():
+    remove_persist_directory()
+    try:
+        clients = [WeRag(persist_directory="./chroma_persist", collection_name=collection_name,
+                         embedding_function=get_embedding_function(), chunk_size=10),
+                   WeRag(persist_directory=persist_directory, collection_name=collection_name,
+                         embedding_function=get_embedding_function(), chunk_size=10, vector_store="numpy")]
+        prune_chroma(clients[0]._chroma)
+        content = "营业时间是每天上午九点\n\n退款请拨打客服电话\n\n退款请拨打客服电话400\n\n门店在人民路一号"
+        for client in clients: client.save_content(content=content, user="user1", content_type="faq")
+
+        for search_type, kwargs in (("similarity", {"k": 2}), ("mmr", {"k": 2, "fetch_k": 4}),
+                                    ("similarity_score_threshold", {"k": 3, "score_threshold": 0.2})):
+            found = [[document.page_content for document in client.as_retriever(
+                user="user1", search_type=search_type, **kwargs).invoke("退款")] for client in clients]
+            assert found[1] == found[0]
+            assert 0 < len(found[1]) <= kwargs["k"]
+        scores = [score for _, score in clients[1]._chroma.similarity_search_with_score("退款", k=4)]
+        assert scores == sorted(scores)
+    finally:
+        remove_persist_directory()
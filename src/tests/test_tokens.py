@@ -0,0 +1,80 @@
+from werag.tokens import get_encoding, pack_chunks, pack_texts, split_tokens, truncate_tokens
+from werag.utils import count_tokens, count_tokens_many, limit_tokens
+
+with open("assets/lorem.txt", mode="r") as f:
+    lorem = f.read()
+chinese = "营业时间是每天上午九点到晚上十点，节假日照常营业。如需退款请联系客服。" * 50
+
+
+def test_truncate_tokens_within_budget():
+    for content in [lorem, chinese]:
+        for max_tokens in [1, 7, 100, 500]:
+            truncated = truncate_tokens(content, max_tokens)
+            assert content.startswith(truncated)
+            assert count_tokens(truncated) <= max_tokens
+
+
+def test_truncate_tokens_short_content():
+    assert truncate_tokens("content1", 100) == "content1"
+    assert truncate_tokens("content1", 0) == ""
+    assert truncate_tokens("", 10) == ""
+
+
+def test_limit_tokens_is_strict():
+    limited = limit_tokens(chinese, 100)
+    assert chinese.startswith(limited)
+    assert 0 < count_tokens(limited) < 100
+
+
+def test_pack_texts():
+    texts = [lorem[i:i + 1000] for i in range(0, len(lorem), 1000)]
+    packed = pack_texts(texts, 300)
+    assert "\n".join(texts).startswith(packed)
+    assert count_tokens(packed) <= 300
+
+    # everything fits
+    assert pack_texts(["a", "b"], 100) == "a\nb"
+    assert pack_texts([], 100) == ""
+
+
+def test_split_tokens():
+    content = "\n\n".join([lorem[:300], chinese, "content1", lorem])
+    for max_tokens, overlap_tokens in [(50, 0), (200, 0), (200, 60)]:
+        chunks = split_tokens(content, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+        for text, token_count in chunks:
+            assert token_count == count_tokens(text)
+            assert 0 < token_count <= max_tokens
+            assert text in content
+        if overlap_tokens == 0:
+            # nothing is lost but whitespace around the pieces
+            assert "".join("".join(text.split()) for text, _ in chunks) == "".join(content.split())
+    assert split_tokens("", max_tokens=10) == []
+
+    # a paragraph cut inside a run of spaces gives no blank chunk
+    chunks = split_tokens("a" * 20 + " " * 30 + "b" * 20, max_tokens=10)
+    assert [text for text, _ in chunks] == ["a" * 10, "a" * 10, "b" * 10, "b" * 10]
+
+
+def test_pack_chunks():
+    texts = [chinese[:400], chinese[:100], "content1", chinese[:30]]
+    token_counts = count_tokens_many(texts)
+    packed = pack_chunks(texts, token_counts, 160)
+    assert count_tokens(packed) <= 160
+    # whole texts only, one that does not fit is skipped
+    assert all(text in texts for text in packed.split("\n"))
+    assert texts[0] not in packed.split("\n") and "content1" in packed.split("\n")
+
+    assert pack_chunks(["a", "b"], [1, 1], 100) == "a\nb"
+    assert pack_chunks([], [], 100) == ""
+    # nothing fits whole, the head of the first text is kept
+    assert pack_chunks([lorem], [count_tokens(lorem)], 10) == truncate_tokens(lorem, 10)
+
+
+def test_count_tokens_many():
+    strings = [lorem, chinese, "", "content1"]
+    assert count_tokens_many(strings) == [count_tokens(s) for s in strings]
+    assert count_tokens_many([]) == []
+
+
+def test_get_encoding_is_shared():
+    assert get_encoding() is get_encoding("cl100k_base")
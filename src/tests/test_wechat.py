@@ -0,0 +1,230 @@
+import asyncio
+import threading
+import time
+from typing import List, Tuple
+
+from langchain_core.language_models import FakeListChatModel
+
+from werag import WeRag
+from werag.client import ERROR_REPLY
+from werag.wechat import DeferredReplier, MessageSender, SingleFlightCache
+from .llm import get_llm
+from .utils import collection_name, get_embedding_function, prune_chroma
+
+message = """<xml>
+              <ToUserName><![CDATA[toUser]]></ToUserName>
+              <FromUserName><![CDATA[fromUser]]></FromUserName>
+              <CreateTime>1348831860</CreateTime>
+              <MsgType><![CDATA[text]]></MsgType>
+              <Content><![CDATA[What is my name?]]></Content>
+              <MsgId>1234567890123456</MsgId>
+            </xml>"""
+
+
+class StubSender(MessageSender):
+    def __init__(self):
+        self.sent: List[Tuple[str, str]] = []
+
+    def send_text(self, *, openid: str, content: str):
+        self.sent.append((openid, content))
+
+
+def test_deferred_replier_backpressure():
+    sender = StubSender()
+    replier = DeferredReplier(sender=sender, max_workers=1, max_queue_size=1)
+    release = threading.Event()
+
+    def slow_answer():
+        release.wait(timeout=10)
+        return "answer"
+
+    assert replier.submit(openid="a", answer=slow_answer) is True
+    assert replier.submit(openid="b", answer=slow_answer) is True
+    # one running, one queued, the third one is refused
+    assert replier.submit(openid="c", answer=slow_answer) is False
+    stats = replier.stats()
+    assert stats["rejected"] == 1
+    assert stats["max_pending"] == 2
+
+    release.set()
+    replier.shutdown(wait=True)
+    assert sorted(sender.sent) == [("a", "answer"), ("b", "answer")]
+    stats = replier.stats()
+    assert stats["completed"] == 2
+    assert stats["running"] == 0
+    assert stats["queued"] == 0
+
+
+def test_deferred_replier_failure():
+    def broken_answer():
+        raise ValueError("broken")
+
+    sender = StubSender()
+    replier = DeferredReplier(sender=sender, error_reply="error")
+    replier.submit(openid="a", answer=broken_answer)
+    replier.shutdown(wait=True)
+    assert replier.stats()["failed"] == 1
+    assert sender.sent == [("a", "error")]
+
+    # a replier that is shut down refuses jobs without taking a slot
+    assert replier.submit(openid="b", answer=lambda: "answer") is False
+    stats = replier.stats()
+    assert stats["rejected"] == 1 and stats["queued"] == 0 and replier.pending == 0
+
+
+class BrokenChatModel(FakeListChatModel):
+    def _call(self, *args, **kwargs) -> str:
+        raise ValueError("broken")
+
+
+def test_client_deferred_reply_failure():
+    sender = StubSender()
+    replier = DeferredReplier(sender=sender)
+    client = WeRag(
+        persist_directory="./chroma_persist",
+        collection_name=collection_name,
+        embedding_function=get_embedding_function(),
+        deferred_replier=replier
+    )
+    client.response_wechat_xml(message=message, llm=BrokenChatModel(responses=[]), user="user")
+    replier.shutdown(wait=True)
+    # the llm error reaches the replier, it counts the failure and sends the error reply
+    assert replier.stats()["failed"] == 1
+    assert sender.sent == [("fromUser", replier.error_reply)]
+
+
+def test_client_deferred_reply():
+    sender = StubSender()
+    replier = DeferredReplier(sender=sender, thinking_reply="thinking")
+    client = WeRag(
+        persist_directory="./chroma_persist",
+        collection_name=collection_name,
+        embedding_function=get_embedding_function(),
+        deferred_replier=replier
+    )
+    prune_chroma(client._chroma)
+    client.save_content(user="user", content="My name is zhangwei", content_type="personal")
+
+    response = client.response_wechat_xml(message=message, llm=get_llm(), user="user")
+    assert "thinking" in response
+
+    replier.shutdown(wait=True)
+    assert len(sender.sent) == 1
+    assert sender.sent[0][0] == "fromUser"
+    assert "zhangwei" in sender.sent[0][1].lower()
+
+
+def test_single_flight_cache_shares_computation():
+    cache = SingleFlightCache(ttl=30)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(timeout=10)
+        return "reply"
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute)))
+    first.start()
+    started.wait(timeout=10)
+    # a retry while the first computation is in flight waits for it
+    retry = threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute)))
+    retry.start()
+    release.set()
+    first.join()
+    retry.join()
+    assert results == ["reply", "reply"]
+    assert len(calls) == 1
+
+    # a late retry gets the stored result
+    assert cache.get_or_compute("key", compute) == "reply"
+    assert len(calls) == 1
+    assert cache.stats()["hits"] == 2
+
+
+def test_single_flight_cache_expiry_and_failure():
+    cache = SingleFlightCache(ttl=0)
+    assert cache.get_or_compute("key", lambda: 1) == 1
+    time.sleep(0.01)
+    assert cache.get_or_compute("key", lambda: 2) == 2
+
+    def broken():
+        raise ValueError("broken")
+
+    cache = SingleFlightCache(ttl=30)
+    try:
+        cache.get_or_compute("key", broken)
+    except ValueError:
+        pass
+    # failures are not kept
+    assert cache.get_or_compute("key", lambda: 3) == 3
+
+
+def test_single_flight_cache_owner_cancelled():
+    cache = SingleFlightCache(ttl=30)
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def never():
+            started.set()
+            await asyncio.sleep(3600)
+
+        async def answer():
+            return "answer"
+
+        owner = asyncio.create_task(cache.aget_or_compute("key", never))
+        await started.wait()
+        waiter = asyncio.create_task(cache.aget_or_compute("key", answer))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        # the retry waiting for the cancelled call computes the answer itself
+        assert await waiter == "answer"
+        assert owner.cancelled()
+        assert await cache.aget_or_compute("key", never) == "answer"
+
+    asyncio.run(scenario())
+
+
+def test_client_message_dedup():
+    client = WeRag(
+        persist_directory="./chroma_persist",
+        collection_name=collection_name,
+        embedding_function=get_embedding_function()
+    )
+    prune_chroma(client._chroma)
+    llm = FakeListChatModel(responses=["first answer", "second answer"])
+    first = client.response_wechat_xml(message=message, llm=llm, user="user")
+    retry = client.response_wechat_xml(message=message, llm=llm, user="user")
+    assert "first answer" in first
+    assert retry == first
+
+    async def aretry():
+        return await client.aresponse_wechat_xml(message=message, llm=llm, user="user")
+
+    assert asyncio.run(aretry()) == first
+
+
+def test_client_message_dedup_failure():
+    client = WeRag(
+        persist_directory="./chroma_persist",
+        collection_name=collection_name,
+        embedding_function=get_embedding_function()
+    )
+    prune_chroma(client._chroma)
+    failed = client.response_wechat_xml(message=message.replace("1234567890123456", "42"),
+                                        llm=BrokenChatModel(responses=[]), user="user")
+    assert ERROR_REPLY in failed
+    # the error reply is not kept, the retry of the message is answered again
+    retry = client.response_wechat_xml(message=message.replace("1234567890123456", "42"),
+                                       llm=FakeListChatModel(responses=["answer"]), user="user")
+    assert "answer" in retry and ERROR_REPLY not in retry
+
+    async def afail():
+        return await client.aresponse_wechat_xml(message=message.replace("1234567890123456", "43"),
+                                                 llm=BrokenChatModel(responses=[]), user="user")
+
+    assert ERROR_REPLY in asyncio.run(afail())
@@ -1,3 +1,5 @@
+from typing import List
+
 from langchain_chroma import Chroma
 from langchain_community.embeddings.sentence_transformer import (
     SentenceTransformerEmbeddings,
@@ -11,6 +13,24 @@ def get_embedding_function() -> Embeddings:
     return SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
 
 
+class CountingEmbeddings(Embeddings):
+    """Records what is embedded, a text is embedded as its length"""
+    model_name = "counting"
+
+    def __init__(self):
+        self.embedded: List[str] = []
+        self.calls: List[int] = []  # number of texts of every embed_documents call
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded += texts
+        self.calls.append(len(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.embedded.append(text)
+        return [float(len(text)), 2.0]
+
+
 collection_name = "werag__pytest"
 
 
@@ -27,6 +47,7 @@ def get_client() -> WeRag:
     return WeRag(
         persist_directory="./chroma_persist",
         collection_name=collection_name,
+        embedding_function=get_embedding_function(),
         chunk_size=1000,
         chunk_overlap=0
     )
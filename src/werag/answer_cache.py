@@ -0,0 +1,290 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.language_models import BaseChatModel
+
+from .embeddings import CachedEmbeddings
+
+
+class AnswerCacheBackend(ABC):
+    """Storage of cached answers and of the content version of every user"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, answer: str):
+        ...
+
+    @abstractmethod
+    def get_version(self, user: str) -> int:
+        ...
+
+    @abstractmethod
+    def bump_version(self, user: str):
+        ...
+
+
+class MemoryAnswerCacheBackend(AnswerCacheBackend):
+    """In-memory LRU of at most max_size answers, each kept ttl seconds"""
+
+    def __init__(self, *, max_size: int = 10000, ttl: Optional[float] = 24 * 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._answers: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._answers.get(key)
+            if entry is None: return None
+            answer, created_at = entry
+            if self.ttl is not None and time.monotonic() - created_at > self.ttl:
+                del self._answers[key]
+                return None
+            self._answers.move_to_end(key)
+            return answer
+
+    def set(self, key: str, answer: str):
+        with self._lock:
+            self._answers[key] = (answer, time.monotonic())
+            self._answers.move_to_end(key)
+            while len(self._answers) > self.max_size: self._answers.popitem(last=False)
+
+    def get_version(self, user: str) -> int:
+        with self._lock:
+            return self._versions.get(user, 0)
+
+    def bump_version(self, user: str):
+        with self._lock:
+            self._versions[user] = self._versions.get(user, 0) + 1
+
+
+class SQLiteAnswerCacheBackend(AnswerCacheBackend):
+    """Answers and versions in a SQLite file, shared between processes and kept over restarts"""
+
+    def __init__(self, path: str, *, ttl: Optional[float] = 24 * 3600):
+        self.ttl = ttl
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    answer TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS content_versions (user TEXT PRIMARY KEY, version INTEGER)")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT answer, created_at FROM answers WHERE key = ?", (key,)).fetchone()
+        if row is None: return None
+        answer, created_at = row
+        if self.ttl is not None and time.time() - created_at > self.ttl: return None
+        return answer
+
+    def set(self, key: str, answer: str):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?)", (key, answer, now))
+            if self.ttl is not None:
+                self._conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl,))
+
+    def get_version(self, user: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM content_versions WHERE user = ?", (user,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def bump_version(self, user: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO content_versions VALUES (?, 1) ON CONFLICT(user) DO UPDATE SET version = version + 1",
+                (user,)
+            )
+
+
+class AnswerCache:
+    """Answers of questions already asked, until the content of the user changes
+
+    The key holds the user, content type, normalized question, prompt template, llm
+    and the content version of the user. Saving content bumps the version, so the answers
+    given on the previous content are never returned again (and expire from the backend).
+    """
+
+    def __init__(self, backend: Optional[AnswerCacheBackend] = None):
+        self.backend = backend if backend is not None else MemoryAnswerCacheBackend()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, *, user: str, content_type: Optional[str] = None, question: str,
+                llm: BaseChatModel, prompt_template: Optional[str] = None) -> str:
+        key = json.dumps([user, content_type, self.normalize_question(question), prompt_template,
+                          CachedEmbeddings.get_model_id(llm), self.backend.get_version(user)], ensure_ascii=False)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        answer = self.backend.get(key)
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer
+
+    def set(self, key: str, answer: str):
+        self.backend.set(key, answer)
+
+    def bump_version(self, *, user: str):
+        """Invalidate the answers given on the content of user"""
+        self.backend.bump_version(user)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total > 0 else 0.0}
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        """Fold width and case, collapse spaces and drop the punctuation around the question"""
+        question = unicodedata.normalize("NFKC", question).lower()
+        question = re.sub(r"\s+", " ", question)
+        return question.strip(" ?？!！.。,，~～、")
+
+
+class _TenantAnswers:
+    """Question vectors (normalized, one per row) and answers of one tenant, grown on demand"""
+
+    def __init__(self, *, dimension: int):
+        self.vectors = np.zeros((16, dimension), dtype=np.float32)
+        self.answers: List[Optional[str]] = []
+        self.last_used = np.zeros(16, dtype=np.float64)
+
+    @property
+    def size(self) -> int:
+        return len(self.answers)
+
+    def put(self, vector: np.ndarray, answer: str, *, max_entries: int):
+        """Add an answer, replacing the least recently used one when max_entries are kept"""
+        if self.size >= max_entries:
+            index = int(np.argmin(self.last_used[:self.size]))
+            self.answers[index] = answer
+        else:
+            index = self.size
+            if index == len(self.vectors):
+                capacity = min(len(self.vectors) * 2, max_entries)
+                self.vectors = np.resize(self.vectors, (capacity, self.vectors.shape[1]))
+                self.last_used = np.resize(self.last_used, capacity)
+            self.answers.append(answer)
+        self.vectors[index] = vector
+        self.last_used[index] = time.monotonic()
+
+
+class SemanticAnswerCache:
+    """Answers of questions similar enough to a question already asked
+
+    Questions are compared by the cosine similarity of their query embeddings, within a
+    tenant (user, content type, prompt template and llm). A similarity of at least threshold
+    is a hit, at least near_miss_threshold is counted as a near miss (to tune the threshold).
+    Each tenant keeps max_entries answers, the least recently used is replaced when full,
+    and at most max_tenants tenants are kept. Saving content of a user drops its answers and
+    bumps its generation: an answer computed on the previous content is not stored when set
+    is given the generation read before the answer was computed.
+    """
+
+    def __init__(self, *, threshold: float = 0.95,
+                 near_miss_threshold: float = 0.85,
+                 max_entries: int = 1000,
+                 max_tenants: int = 10000):
+        self.threshold = threshold
+        self.near_miss_threshold = near_miss_threshold
+        self.max_entries = max_entries
+        self.max_tenants = max_tenants
+        self.hits = 0
+        self.misses = 0
+        self.near_misses = 0
+        self._tenants: "OrderedDict[tuple, _TenantAnswers]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get_generation(self, *, user: str) -> int:
+        """Number of times the content of user changed, to pass to set"""
+        with self._lock:
+            return self._generations.get(user, 0)
+
+    def get(self, embedding: List[float], *, user: str, content_type: Optional[str] = None,
+            llm: BaseChatModel, prompt_template: Optional[str] = None) -> Optional[str]:
+        vector = self._normalize(embedding)
+        tenant_key = self._tenant_key(user=user, content_type=content_type, llm=llm, prompt_template=prompt_template)
+        with self._lock:
+            tenant = self._tenants.get(tenant_key)
+            similarity, index = -1.0, -1
+            if tenant is not None and tenant.size > 0 and tenant.vectors.shape[1] == len(vector):
+                similarities = tenant.vectors[:tenant.size] @ vector
+                index = int(np.argmax(similarities))
+                similarity = float(similarities[index])
+            if similarity >= self.threshold:
+                self.hits += 1
+                tenant.last_used[index] = time.monotonic()
+                self._tenants.move_to_end(tenant_key)
+                return tenant.answers[index]
+            self.misses += 1
+            if similarity >= self.near_miss_threshold: self.near_misses += 1
+            return None
+
+    def set(self, embedding: List[float], answer: str, *, user: str, content_type: Optional[str] = None,
+            llm: BaseChatModel, prompt_template: Optional[str] = None, generation: Optional[int] = None):
+        """Store an answer, unless the content of user changed since generation was read"""
+        vector = self._normalize(embedding)
+        tenant_key = self._tenant_key(user=user, content_type=content_type, llm=llm, prompt_template=prompt_template)
+        with self._lock:
+            if generation is not None and generation != self._generations.get(user, 0): return
+            tenant = self._tenants.get(tenant_key)
+            if tenant is None or tenant.vectors.shape[1] != len(vector):
+                tenant = _TenantAnswers(dimension=len(vector))
+                self._tenants[tenant_key] = tenant
+                while len(self._tenants) > self.max_tenants: self._tenants.popitem(last=False)
+            self._tenants.move_to_end(tenant_key)
+            tenant.put(vector, answer, max_entries=self.max_entries)
+
+    def bump_version(self, *, user: str):
+        """Drop the answers given on the content of user"""
+        with self._lock:
+            self._generations[user] = self._generations.get(user, 0) + 1
+            for tenant_key in [tenant_key for tenant_key in self._tenants if tenant_key[0] == user]:
+                del self._tenants[tenant_key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "near_misses": self.near_misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+                "tenants": len(self._tenants)
+            }
+
+    @staticmethod
+    def _tenant_key(*, user: str, content_type: Optional[str] = None, llm: BaseChatModel,
+                    prompt_template: Optional[str] = None) -> tuple:
+        return user, content_type, CachedEmbeddings.get_model_id(llm), prompt_template
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
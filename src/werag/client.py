@@ -1,26 +1,63 @@
+import asyncio
+import functools
 import logging
+import os
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import List
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Tuple, TypeVar
 from typing import Optional, Literal
 
 from langchain.chains import LLMChain
-from langchain.document_transformers import Html2TextTransformer
-from langchain_community.document_loaders import TextLoader
-from langchain_community.document_loaders.recursive_url_loader import RecursiveUrlLoader
+from langchain_chroma import Chroma
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 from langchain_core.language_models import BaseChatModel
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
 from wechatpy import parse_message, create_reply
 
+from .answer_cache import AnswerCache, SemanticAnswerCache
+from .context import ContextAssembler
+from .crawler import Crawler, CrawlStateStore
 from .crud import CRUDChroma
-from .db import get_chroma
-from .schema import UserContent
+from .db import CollectionRouter, get_chroma, get_collection_name, migrate_to_shards
+from .embeddings import CachedEmbeddings
+from .lexical import LexicalIndex
+from .manifest import ChunkManifest
+from .ingest import read_text_blocks, stream_documents
+from .schema import CrawlStats, UserContent
+from .tokens import pack_chunks, pack_texts
 from .utils import limit_tokens
+from .wechat import DeferredReplier, SingleFlightCache
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+MAX_RAG_CHAINS = 32
+
+ERROR_REPLY = "系统出错了，没有得到任何回复。请联系管理员"
+
+DEFAULT_PROMPT_TEMPLATE = """
+        ### [INST] 
+        Instruction: 回复下述问题，这里是一些数据和资料供你参考：
+        
+        {context}
+        
+        ### QUESTION:
+        {question} 
+        
+        [/INST]
+        """
+
+
+class _AnswerLookup(NamedTuple):
+    """Outcome of looking a question up in the answer caches"""
+    answer: Optional[str] = None  # cached answer, None on a miss
+    cache_key: Optional[str] = None  # key of the exact-match cache
+    embedding: Optional[List[float]] = None  # question vector, computed for the semantic cache
+    generation: Optional[int] = None  # content generation of the user when the question was looked up
+
 
 class WeRag:
     """Core Client for werag service"""
@@ -31,20 +68,67 @@ class WeRag:
                  embedding_function: Embeddings,
                  chunk_size: int = 1000,
                  chunk_overlap: int = 0,
+                 split_by: Literal["character", "token"] = "character",  # chunk_size和chunk_overlap的单位
                  context_size: int = 2000,  # 限制context的token数量
-                 question_size: int = 1000  # 限制question的token数量
+                 question_size: int = 1000,  # 限制question的token数量
+                 embedding_cache_path: Optional[str] = None,  # sqlite文件, 缓存已经embed过的文本
+                 deferred_replier: Optional[DeferredReplier] = None,  # 后台生成回复, 通过客服消息发送
+                 message_dedup_ttl: Optional[float] = 30,  # 相同MsgId的重试共享同一个回复, None则关闭
+                 crawl_state_path: Optional[str] = None,  # 记录已抓取网页的sqlite文件, 默认在persist_directory中
+                 embed_batch_size: int = 256,  # 每次embed的chunk数量
+                 write_batch_size: int = 1024,  # 每次写入chroma的chunk数量
+                 ingest_queue_size: int = 4,  # 切分/embed/写入之间缓冲的batch数量
+                 sharding: Optional[Literal["user", "bucket"]] = None,  # 每个用户(或每个hash桶)使用单独的collection
+                 num_buckets: int = 64,  # sharding="bucket"时的桶数
+                 max_open_collections: int = 128,  # 缓存的collection数量
+                 chunk_manifest_path: Optional[str] = None,  # sqlite文件, 记录每个用户的chunk, 省去chroma的metadata扫描
+                 answer_cache: Optional[AnswerCache] = None,  # 缓存相同问题的回复, 用户内容更新后失效
+                 semantic_answer_cache: Optional[SemanticAnswerCache] = None,  # 缓存相似问题的回复, 用户内容更新后失效
+                 hybrid_search: bool = False,  # 向量检索 + BM25关键词检索, 用RRF融合
+                 lexical_index_path: Optional[str] = None,  # BM25索引的sqlite文件, 默认在persist_directory中
+                 vector_store: Literal["chroma", "numpy"] = "chroma",  # numpy: 内存中按用户精确检索, 适合小租户
+                 vector_dtype: Literal["float32", "float16", "int8"] = "float32",  # numpy向量类型, int8省3/4内存
+                 vector_rescore_factor: int = 4,  # 量化检索取k*factor个候选, 用float32向量重新打分, 1则不保留float32向量
+                 context_assembler: Optional[ContextAssembler] = None  # 多取候选, 去重并用MMR挑选, 按相关度/token装入context
                  ):
-        self._crud = CRUDChroma(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        if embedding_cache_path is not None:
+            embedding_function = CachedEmbeddings(embedding_function, cache_path=embedding_cache_path)
+        self._embedding_function = embedding_function
+        self._deferred_replier = deferred_replier
+        self._answer_cache = answer_cache
+        self._semantic_answer_cache = semantic_answer_cache
+        self._context_assembler = context_assembler
+        self._message_cache = SingleFlightCache(ttl=message_dedup_ttl) if message_dedup_ttl is not None else None
         self._chroma = get_chroma(collection_name=collection_name, persist_directory=persist_directory,
-                                  embedding_function=embedding_function)
+                                  embedding_function=embedding_function, backend=vector_store, dtype=vector_dtype,
+                                  rescore_factor=vector_rescore_factor)
+        self._router = CollectionRouter(self._chroma, sharding=sharding, num_buckets=num_buckets,
+                                        max_open_collections=max_open_collections)
+        # the sqlite files default to the persist directory, created by the vector store
+        if lexical_index_path is None:
+            lexical_index_path = os.path.join(persist_directory, f"{collection_name}_lexical.sqlite3")
+        self._crud = CRUDChroma(chunk_size=chunk_size, chunk_overlap=chunk_overlap, split_by=split_by,
+                                batch_size=embed_batch_size, write_batch_size=write_batch_size,
+                                queue_size=ingest_queue_size,
+                                manifest=ChunkManifest(chunk_manifest_path) if chunk_manifest_path else None,
+                                lexical_index=LexicalIndex(lexical_index_path) if hybrid_search else None)
+        if crawl_state_path is None:
+            crawl_state_path = os.path.join(persist_directory, f"{collection_name}_crawl_state.sqlite3")
+        # opened by the first save_urls, deployments that never crawl get no file
+        self._crawl_state_path = crawl_state_path
+        self._crawl_state: Optional[CrawlStateStore] = None
+        self._crawl_state_lock = threading.Lock()
         self.__question_size = question_size
+        # compiled chains per (prompt_template, llm)
+        self._rag_chains: "OrderedDict[Tuple[str, int], LLMChain]" = OrderedDict()
+        self._rag_chains_lock = threading.Lock()
         self.__context_size = context_size
 
     def as_retriever(self, *, user: str,
                      content_type: Optional[str] = None,
                      search_type: Literal["similarity", "mmr", "similarity_score_threshold"] = "similarity",
                      **kwargs):
-        return self._chroma.as_retriever(search_kwargs={
+        return self._get_chroma(user=user).as_retriever(search_kwargs={
             "filter": self._crud.get_user_content_filter(user=user, content_type=content_type),
             **kwargs
         }, search_type=search_type)
@@ -52,45 +136,205 @@ class WeRag:
     def similarity_search(self, *, query: str, user: str,
                           content_type: Optional[str] = None,
                           limit: int = 4) -> List[Document]:
-        return self._chroma.similarity_search(
+        if self._crud.lexical_index is not None:
+            return self._crud.search_documents_hybrid(self._get_chroma(user=user), query=query, limit=limit,
+                                                      user=user, content_type=content_type)
+        return self._get_chroma(user=user).similarity_search(
+            query=query,
+            filter=self._crud.get_user_content_filter(user=user, content_type=content_type),
+            k=limit
+        )
+
+    async def asimilarity_search(self, *, query: str, user: str,
+                                 content_type: Optional[str] = None,
+                                 limit: int = 4) -> List[Document]:
+        if self._crud.lexical_index is not None:
+            return await self._run_in_executor(self.similarity_search, query=query, user=user,
+                                               content_type=content_type, limit=limit)
+        return await self._get_chroma(user=user).asimilarity_search(
             query=query,
             filter=self._crud.get_user_content_filter(user=user, content_type=content_type),
             k=limit
         )
 
+    def similarity_search_batch(self, *, queries: List[str], user: str,
+                                content_type: Optional[str] = None,
+                                limit: int = 4) -> List[List[Document]]:
+        """Search many queries at once, the result list of each query in the order of queries"""
+        return self._crud.search_documents_batch(self._get_chroma(user=user), queries=queries, limit=limit,
+                                                 user=user, content_type=content_type)
+
+    async def asimilarity_search_batch(self, *, queries: List[str], user: str,
+                                       content_type: Optional[str] = None,
+                                       limit: int = 4) -> List[List[Document]]:
+        """Async version of similarity_search_batch"""
+        return await self._run_in_executor(self.similarity_search_batch, queries=queries, user=user,
+                                           content_type=content_type, limit=limit)
+
     def save_content(self, *, user: str, content: str,
                      content_type: Optional[str] = None) -> UserContent:
         """Save a content base on user id"""
-        return self._crud.save_user_content(client=self._chroma, user=user, content_type=content_type, content=content)
+        user_content = self._crud.save_user_content(client=self._get_chroma(user=user), user=user,
+                                                    content_type=content_type, content=content)
+        self._content_changed(user=user)
+        return user_content
 
-    def save_documents(self, *, user: str, documents: List[Document],
-                       content_type: Optional[str] = None) -> Optional[UserContent]:
-        """Save a docs base on user id"""
+    async def asave_content(self, *, user: str, content: str,
+                            content_type: Optional[str] = None) -> UserContent:
+        """Async version of save_content, chroma writes run on the default executor"""
+        return await self._run_in_executor(self.save_content, user=user, content=content, content_type=content_type)
 
-        return self._crud.save_user_documents(client=self._chroma, user=user, documents=documents,
-                                              content_type=content_type)
+    def save_contents_bulk(self, *, records: Iterable[Tuple[str, Optional[str], str]]) -> List[UserContent]:
+        """Save many (user, content_type, content) records, embedding and writing them in large batches"""
+        records = list(records)
+        if self._router.sharding is None:
+            results = self._crud.save_user_contents(client=self._chroma, records=records)
+        else:
+            # one bulk save per collection, results in the order of the records
+            by_collection = {}
+            for index, record in enumerate(records):
+                by_collection.setdefault(self._router.get_collection_name(user=record[0]), []).append(index)
+            results: List[Optional[UserContent]] = [None] * len(records)
+            for name, indexes in by_collection.items():
+                saved = self._crud.save_user_contents(client=self._router.get_collection(name),
+                                                      records=[records[index] for index in indexes])
+                for index, user_content in zip(indexes, saved): results[index] = user_content
+        for user in set(record[0] for record in records): self._content_changed(user=user)
+        return results
+
+    async def asave_contents_bulk(self, *, records: Iterable[Tuple[str, Optional[str], str]]) -> List[UserContent]:
+        """Async version of save_contents_bulk"""
+        return await self._run_in_executor(self.save_contents_bulk, records=list(records))
+
+    def save_documents(self, *, user: str, documents: Iterable[Document],
+                       content_type: Optional[str] = None,
+                       stream: bool = False) -> Optional[UserContent]:
+        """Save a docs base on user id, documents can be a generator, they are consumed one by one
+
+        With stream=True the returned page_content is left empty instead of holding all the text.
+        """
+
+        user_content = self._crud.save_user_documents(client=self._get_chroma(user=user), user=user,
+                                                      documents=documents, content_type=content_type,
+                                                      stream=stream)
+        self._content_changed(user=user)
+        return user_content
+
+    async def asave_documents(self, *, user: str, documents: Iterable[Document],
+                              content_type: Optional[str] = None,
+                              stream: bool = False) -> Optional[UserContent]:
+        """Async version of save_documents"""
+        return await self._run_in_executor(self.save_documents, user=user, documents=documents,
+                                           content_type=content_type, stream=stream)
 
     def save_urls(self, *, urls: List[str], user: str,
                   max_depth: int = 1,
-                  content_type: Optional[str] = None, **kwargs) -> Optional[UserContent]:
-        docs = []
-        for url in urls:
-            loader = RecursiveUrlLoader(url, max_depth=max_depth, **kwargs)
-            docs += loader.load()
+                  content_type: Optional[str] = None,
+                  max_workers: int = 8,
+                  max_per_host: int = 2, **kwargs) -> Optional[UserContent]:
+        """Crawl urls (and their child links up to max_depth) and save the pages as plain text
+
+        Pages saved by a previous crawl are requested conditionally (ETag/Last-Modified) and
+        compared by content hash, only new or changed pages are split and embedded. The returned
+        page_content holds every saved page, the pages that were not downloaded again are
+        rebuilt from their stored chunks.
+        kwargs are passed to Crawler, e.g. timeout, headers, exclude_dirs, extractor, metadata_extractor
+        """
+        crawler = Crawler(max_depth=max_depth, max_workers=max_workers, max_per_host=max_per_host, **kwargs)
+        remembered = self._get_crawl_state().get_pages(user=user, content_type=content_type)
+        known = {}
+        if len(remembered) > 0:
+            # a page is only skipped if its chunks are still stored
+            stored_ids = self._crud.get_user_chunk_ids(self._get_chroma(user=user), user=user,
+                                                       content_type=content_type)
+            known = {url: page for url, page in remembered.items() if stored_ids.issuperset(page.chunk_ids)}
 
-        # Converts HTML to plain text
-        html2text = Html2TextTransformer()
-        docs_transformed = html2text.transform_documents(docs)
-        return self.save_documents(user=user, documents=docs_transformed, content_type=content_type)
+        # pages arrive in the order they finish, sort them so the saved content is stable
+        pages = sorted(crawler.crawl_pages(urls, known=known), key=lambda page: page.url)
+        stats = CrawlStats(fetched=len([page for page in pages if page.fetched]),
+                           not_modified=len([page for page in pages if page.status == "not_modified"]),
+                           changed=len([page for page in pages if page.status == "changed"]),
+                           failed=len([page for page in pages if page.status == "failed"]))
+        if stats.failed == len(pages): return None
+
+        states, chunks, ids, keep_ids = [], [], [], []
+        contents: List[str | Tuple[str, ...]] = []  # text of every saved page, or the ids of its kept chunks
+        for page in pages:
+            if page.status == "changed":
+                page_chunks, page_ids = [], []
+                if page.document is not None:
+                    page_chunks, page_ids = self._crud.split_user_document(user=user, content_type=content_type,
+                                                                           document=page.document)
+                    contents.append(page.document.page_content)
+                chunks += page_chunks
+                ids += page_ids
+                states.append(page.state._replace(chunk_ids=tuple(page_ids)))
+            elif page.status == "not_modified":
+                keep_ids += page.state.chunk_ids
+                contents.append(page.state.chunk_ids)
+                states.append(page.state)
+            elif page.url in known:
+                # keep what a failed page had, it may be a temporary error
+                keep_ids += known[page.url].chunk_ids
+                contents.append(known[page.url].chunk_ids)
+                states.append(known[page.url])
+        reached = set(page.url for page in pages)
+        stats.removed = len([url for url in remembered if url not in reached])
+
+        # a kept page is rebuilt from its chunks, in the order it was split
+        stored = {}
+        if len(keep_ids) > 0:
+            response = self._get_chroma(user=user).get(ids=list(keep_ids), include=["documents"])
+            stored = dict(zip(response['ids'], response['documents']))
+        user_content = UserContent.new_from_user_content(
+            user=user, content_type=content_type,
+            content="\n".join(content if isinstance(content, str)
+                              else "\n\n".join(stored[_id] for _id in content if _id in stored)
+                              for content in contents)
+        )
+        user_content.chunk_diff = self._crud.save_user_chunks(self._get_chroma(user=user), user=user,
+                                                              content_type=content_type,
+                                                              chunks=chunks, ids=ids, keep_ids=keep_ids)
+        user_content.crawl_stats = stats
+        self._get_crawl_state().replace_pages(user=user, content_type=content_type, pages=states)
+        self._content_changed(user=user)
+        return user_content
+
+    async def asave_urls(self, *, urls: List[str], user: str,
+                         max_depth: int = 1,
+                         content_type: Optional[str] = None,
+                         max_workers: int = 8,
+                         max_per_host: int = 2, **kwargs) -> Optional[UserContent]:
+        """Async version of save_urls"""
+        return await self._run_in_executor(self.save_urls, urls=urls, user=user, max_depth=max_depth,
+                                           content_type=content_type, max_workers=max_workers,
+                                           max_per_host=max_per_host, **kwargs)
 
     def import_files(self, *, filepaths: List[str | Path], user: str,
-                     content_type: Optional[str] = None) -> Optional[UserContent]:
-        """Import content from files"""
-        docs = []
-        for filepath in filepaths:
-            loader = TextLoader(filepath)
-            docs += loader.load()
-        return self.save_documents(user=user, content_type=content_type, documents=docs)
+                     content_type: Optional[str] = None,
+                     encoding: str = "utf-8",
+                     stream: bool = False) -> Optional[UserContent]:
+        """Import content from files, the returned page_content holds the text of the files
+
+        With stream=True files are read block by block and saved as they are read, so large
+        files never have to fit in memory, and the returned page_content is left empty.
+        """
+        if stream:
+            documents = (document for filepath in filepaths
+                         for document in stream_documents(read_text_blocks(filepath, encoding=encoding),
+                                                          metadata={"source": str(filepath)}))
+        else:
+            documents = (Document(page_content="".join(read_text_blocks(filepath, encoding=encoding)),
+                                  metadata={"source": str(filepath)}) for filepath in filepaths)
+        return self.save_documents(user=user, content_type=content_type, documents=documents, stream=stream)
+
+    async def aimport_files(self, *, filepaths: List[str | Path], user: str,
+                            content_type: Optional[str] = None,
+                            encoding: str = "utf-8",
+                            stream: bool = False) -> Optional[UserContent]:
+        """Async version of import_files"""
+        return await self._run_in_executor(self.import_files, filepaths=filepaths, user=user,
+                                           content_type=content_type, encoding=encoding, stream=stream)
 
     def response_wechat_xml(self, *, message: str,
                             llm: BaseChatModel,
@@ -110,50 +354,295 @@ class WeRag:
                           <MsgDataId>xxxx</MsgDataId>
                           <Idx>xxxx</Idx>
                         </xml>
-        :return:
+        :return: reply XML string, with a deferred replier it is the immediate reply (or "success")
+                 and the answer is delivered later by the replier's sender
         """
 
-        default_prompt_template = """
-        ### [INST] 
-        Instruction: 回复下述问题，这里是一些数据和资料供你参考：
-        
-        {context}
-        
-        ### QUESTION:
-        {question} 
-        
-        [/INST]
-        """
-        if prompt_template is None:
-            prompt_template = default_prompt_template
+        parsed_message = parse_message(message)
+        if parsed_message.type != "text": return create_reply("我目前只能响应文字内容", parsed_message, render=True)
 
+        reply = functools.partial(self._reply, parsed_message, llm=llm, user=user, content_type=content_type,
+                                  prompt_template=prompt_template)
+        key = self._get_message_key(parsed_message, user=user)
+        try:
+            if key is None: return reply()
+            # wechat retries a slow message with the same MsgId, retries share the first computation
+            return self._message_cache.get_or_compute(key, reply)
+        except Exception:
+            # mapped outside the cache, a retry after a failure makes a new attempt
+            return create_reply(ERROR_REPLY, parsed_message, render=True)
+
+    async def aresponse_wechat_xml(self, *, message: str,
+                                   llm: BaseChatModel,
+                                   user: str, content_type: Optional[str] = None,
+                                   prompt_template: Optional[str] = None,
+                                   ):
+        """Async version of response_wechat_xml, retrieval and LLM call do not block the event loop"""
         parsed_message = parse_message(message)
         if parsed_message.type != "text": return create_reply("我目前只能响应文字内容", parsed_message, render=True)
 
-        # manually retrieve and limit tokens of RAG
-        docs = self.similarity_search(query=parsed_message.content, user=user, content_type=content_type)
-        context = limit_tokens("\n".join([doc.page_content for doc in docs]), max_token=self.__context_size)
+        reply = functools.partial(self._areply, parsed_message, llm=llm, user=user, content_type=content_type,
+                                  prompt_template=prompt_template)
+        key = self._get_message_key(parsed_message, user=user)
+        try:
+            if key is None: return await reply()
+            return await self._message_cache.aget_or_compute(key, reply)
+        except Exception:
+            return create_reply(ERROR_REPLY, parsed_message, render=True)
 
-        # Abstraction of Prompt
-        prompt = ChatPromptTemplate.from_template(prompt_template, partial_variables={
-            "context": context
-        })
+    def _reply(self, parsed_message, *, llm: BaseChatModel,
+               user: str, content_type: Optional[str] = None,
+               prompt_template: Optional[str] = None) -> str:
+        """Build the reply XML of a text message, raise if the answer failed"""
+        if self._deferred_replier is not None:
+            return self._defer_reply(parsed_message, llm=llm, user=user, content_type=content_type,
+                                     prompt_template=prompt_template)
 
-        # Creating an LLM Chain
-        llm_chain = LLMChain(llm=llm, prompt=prompt)
+        response_text = self._answer(question=parsed_message.content, llm=llm, user=user,
+                                     content_type=content_type, prompt_template=prompt_template)
+        return create_reply(response_text, parsed_message, render=True)
+
+    async def _areply(self, parsed_message, *, llm: BaseChatModel,
+                      user: str, content_type: Optional[str] = None,
+                      prompt_template: Optional[str] = None) -> str:
+        """Async version of _reply"""
+        if self._deferred_replier is not None:
+            return self._defer_reply(parsed_message, llm=llm, user=user, content_type=content_type,
+                                     prompt_template=prompt_template)
+
+        response_text = await self._aanswer(question=parsed_message.content, llm=llm, user=user,
+                                            content_type=content_type, prompt_template=prompt_template)
+        return create_reply(response_text, parsed_message, render=True)
+
+    def migrate_to_shards(self, *, batch_size: int = 1000) -> int:
+        """Move the content of the shared collection to the sharded collections, without embedding again"""
+        moved = migrate_to_shards(self._router, batch_size=batch_size)
+        # chunks changed collection behind the manifest, it is rebuilt on use
+        if self._crud.manifest is not None: self._crud.manifest.clear()
+        if self._crud.lexical_index is not None: self._crud.lexical_index.clear()
+        return moved
+
+    def has_content(self, *, user: str, content_type: Optional[str] = None) -> bool:
+        """Whether anything is saved for user (and content type)"""
+        return self._crud.has_user_content(self._get_chroma(user=user), user=user, content_type=content_type)
+
+    def get_content(self, *, user: str, content_type: Optional[str] = None,
+                    include_documents: bool = True) -> List[UserContent]:
+        """All the chunks saved for user (and content type)"""
+        return list(self.iter_content(user=user, content_type=content_type, include_documents=include_documents))
 
-        # RAG Chain
-        rag_chain = (
-                {  # self.as_retriever(user=user, content_type=content_type),
-                 "question": RunnablePassthrough()}
-                | llm_chain
+    def get_content_page(self, *, user: str, content_type: Optional[str] = None,
+                         limit: int = 100, offset: int = 0,
+                         include_documents: bool = True) -> List[UserContent]:
+        """One page of the chunks saved for user (and content type)"""
+        return self._crud.get_user_content_page(self._get_chroma(user=user), user=user, content_type=content_type,
+                                                limit=limit, offset=offset, include_documents=include_documents)
+
+    def iter_content(self, *, user: str, content_type: Optional[str] = None,
+                     page_size: int = 100,
+                     include_documents: bool = True) -> Iterator[UserContent]:
+        """All the chunks saved for user (and content type), fetched lazily page by page"""
+        return self._crud.iter_user_content(self._get_chroma(user=user), user=user, content_type=content_type,
+                                            page_size=page_size, include_documents=include_documents)
+
+    def check_manifest(self, *, user: Optional[str] = None, repair: bool = True) -> dict:
+        """Compare the chunk manifest with chroma, rebuild the collections that drifted
+
+        Only the collection of user is checked when user is given, otherwise the shared collection
+        and every shard of it the manifest knows. The counts of the collections are summed.
+        """
+        if self._crud.manifest is None: return {}
+        if user is not None: return self._crud.manifest.check(self._get_chroma(user=user), repair=repair)
+        shared_name = get_collection_name(self._chroma)
+        names = {name for name in self._crud.manifest.get_collections() if self._router.is_routed(name)}
+        report = {"missing": 0, "extra": 0, "repaired": False}
+        for name in sorted(names | {shared_name}):
+            client = self._chroma if name == shared_name else self._router.get_collection(name)
+            collection_report = self._crud.manifest.check(client, repair=repair)
+            report["missing"] += collection_report["missing"]
+            report["extra"] += collection_report["extra"]
+            report["repaired"] = report["repaired"] or collection_report["repaired"]
+        return report
+
+    def _search_by_vector(self, *, embedding: List[float], query: str, user: str,
+                          content_type: Optional[str] = None, limit: int = 4) -> List[Document]:
+        """similarity_search with the query already embedded"""
+        if self._crud.lexical_index is not None:
+            return self._crud.search_documents_hybrid(self._get_chroma(user=user), query=query, limit=limit,
+                                                      user=user, content_type=content_type, embedding=embedding)
+        return self._get_chroma(user=user).similarity_search_by_vector(
+            embedding,
+            filter=self._crud.get_user_content_filter(user=user, content_type=content_type),
+            k=limit
         )
+
+    def _content_changed(self, *, user: str):
+        """Invalidate what was derived from the previous content of user"""
+        if self._answer_cache is not None: self._answer_cache.bump_version(user=user)
+        if self._semantic_answer_cache is not None: self._semantic_answer_cache.bump_version(user=user)
+
+    def _get_crawl_state(self) -> CrawlStateStore:
+        """Crawl state of save_urls, opened on first use"""
+        if self._crawl_state is None:
+            with self._crawl_state_lock:
+                if self._crawl_state is None: self._crawl_state = CrawlStateStore(self._crawl_state_path)
+        return self._crawl_state
+
+    def _get_chroma(self, *, user: str) -> Chroma:
+        """Collection holding the content of user"""
+        return self._router.get(user=user)
+
+    def _get_message_key(self, parsed_message, *, user: str) -> Optional[tuple]:
+        """Dedup key of a message, None if dedup is disabled or the message has no MsgId"""
+        if self._message_cache is None or not parsed_message.id: return None
+        return user, parsed_message.source, parsed_message.id
+
+    def _answer(self, *, question: str, llm: BaseChatModel,
+                user: str, content_type: Optional[str] = None,
+                prompt_template: Optional[str] = None) -> str:
+        """Answer a question with RAG, return the text to send back to the user
+
+        Raise if the LLM fails, nothing is cached then and the caller picks the error reply.
+        """
+        scope = dict(llm=llm, user=user, content_type=content_type, prompt_template=prompt_template)
+        lookup = self._lookup_answer(question=question, **scope)
+        if lookup.answer is not None: return lookup.answer
+        # manually retrieve and limit tokens of RAG
+        context = self._retrieve_context(question=question, user=user, content_type=content_type,
+                                         embedding=lookup.embedding)
+        rag_chain = self._get_rag_chain(llm=llm, prompt_template=prompt_template)
         response_text = None
         try:
-            response_text = rag_chain.invoke(
-                limit_tokens(parsed_message.content, max_token=self.__question_size)
-            )
-            return create_reply(response_text['text'], parsed_message, render=True)
+            response_text = rag_chain.invoke(self._get_chain_inputs(context=context, question=question))
+            answer = response_text['text']
         except Exception as e:
             logger.critical(f"Failed to get response from LLM, exception: {e}, response: {response_text}")
-            return create_reply("系统出错了，没有得到任何回复。请联系管理员", parsed_message, render=True)
+            raise
+        self._store_answer(lookup, answer, **scope)
+        return answer
+
+    async def _aanswer(self, *, question: str, llm: BaseChatModel,
+                       user: str, content_type: Optional[str] = None,
+                       prompt_template: Optional[str] = None) -> str:
+        """Async version of _answer, the caches and the retrieval run on the executor"""
+        scope = dict(llm=llm, user=user, content_type=content_type, prompt_template=prompt_template)
+        lookup = await self._run_in_executor(self._lookup_answer, question=question, **scope)
+        if lookup.answer is not None: return lookup.answer
+        context = await self._run_in_executor(self._retrieve_context, question=question, user=user,
+                                              content_type=content_type, embedding=lookup.embedding)
+        rag_chain = self._get_rag_chain(llm=llm, prompt_template=prompt_template)
+        response_text = None
+        try:
+            response_text = await rag_chain.ainvoke(self._get_chain_inputs(context=context, question=question))
+            answer = response_text['text']
+        except Exception as e:
+            logger.critical(f"Failed to get response from LLM, exception: {e}, response: {response_text}")
+            raise
+        await self._run_in_executor(self._store_answer, lookup=lookup, answer=answer, **scope)
+        return answer
+
+    def _lookup_answer(self, *, question: str, llm: BaseChatModel, user: str, content_type: Optional[str] = None,
+                       prompt_template: Optional[str] = None) -> _AnswerLookup:
+        """Look the question up in the answer caches, keeping what is needed to store its answer"""
+        cache_key = None
+        if self._answer_cache is not None:
+            cache_key = self._answer_cache.get_key(user=user, content_type=content_type, question=question,
+                                                   llm=llm, prompt_template=prompt_template)
+            cached = self._answer_cache.get(cache_key)
+            if cached is not None: return _AnswerLookup(answer=cached)
+
+        embedding, generation = None, None
+        if self._semantic_answer_cache is not None:
+            # read before answering, an answer computed while the content changes is not stored
+            generation = self._semantic_answer_cache.get_generation(user=user)
+            # the question is embedded once, for the cache and for the search
+            embedding = self._embedding_function.embed_query(question)
+            cached = self._semantic_answer_cache.get(embedding, user=user, content_type=content_type,
+                                                     llm=llm, prompt_template=prompt_template)
+            if cached is not None: return _AnswerLookup(answer=cached)
+        return _AnswerLookup(cache_key=cache_key, embedding=embedding, generation=generation)
+
+    def _store_answer(self, lookup: _AnswerLookup, answer: str, *, llm: BaseChatModel, user: str,
+                      content_type: Optional[str] = None, prompt_template: Optional[str] = None):
+        """Store a new answer in the caches the question was looked up in"""
+        if lookup.cache_key is not None: self._answer_cache.set(lookup.cache_key, answer)
+        if lookup.embedding is not None:
+            self._semantic_answer_cache.set(lookup.embedding, answer, user=user, content_type=content_type,
+                                            llm=llm, prompt_template=prompt_template, generation=lookup.generation)
+
+    def _get_chain_inputs(self, *, context: str, question: str) -> dict:
+        return {
+            "context": context,
+            "question": limit_tokens(question, max_token=self.__question_size)
+        }
+
+    def _defer_reply(self, parsed_message, **kwargs) -> str:
+        """Hand the message to the deferred replier and build the immediate passive reply"""
+        replier = self._deferred_replier
+        submitted = replier.submit(openid=parsed_message.source,
+                                   answer=functools.partial(self._answer, question=parsed_message.content, **kwargs))
+        if not submitted: return create_reply(replier.busy_reply, parsed_message, render=True)
+        if replier.thinking_reply: return create_reply(replier.thinking_reply, parsed_message, render=True)
+        # an empty "success" reply tells wechat not to retry and not to show anything
+        return "success"
+
+    def _retrieve_context(self, *, question: str, user: str, content_type: Optional[str] = None,
+                          embedding: Optional[List[float]] = None) -> str:
+        """Retrieve the chunks answering question and pack them into the context
+
+        embedding is the query vector when it is already computed.
+        """
+        if self._context_assembler is None:
+            if embedding is None:
+                docs = self.similarity_search(query=question, user=user, content_type=content_type)
+            else:
+                docs = self._search_by_vector(embedding=embedding, query=question, user=user,
+                                              content_type=content_type)
+            return self._get_context(docs)
+        if embedding is None: embedding = self._embedding_function.embed_query(question)
+        docs, embeddings = self._crud.search_candidates(self._get_chroma(user=user), query=question,
+                                                        embedding=embedding, limit=self._context_assembler.fetch_k,
+                                                        user=user, content_type=content_type)
+        # assemble packs with pack_chunks, its result is checked as in _get_context
+        context = self._context_assembler.assemble(docs, embeddings=embeddings, query_embedding=embedding,
+                                                   max_tokens=self.__context_size - 1)
+        return limit_tokens(context, self.__context_size)
+
+    def _get_context(self, docs: List[Document]) -> str:
+        """Join the retrieved docs into the context of the prompt"""
+        texts = [doc.page_content for doc in docs]
+        token_counts = [doc.metadata.get("token_count") for doc in docs]
+        if None in token_counts:
+            # chunks saved before their token count was stored
+            return pack_texts(texts, max_tokens=self.__context_size - 1)
+        # the stored counts only estimate the tokens of the packed string (tokens can merge across
+        # a separator), one encode of the bounded result keeps it strictly below context_size
+        return limit_tokens(pack_chunks(texts, token_counts, max_tokens=self.__context_size - 1),
+                            self.__context_size)
+
+    def _get_rag_chain(self, *, llm: BaseChatModel, prompt_template: Optional[str] = None) -> LLMChain:
+        """Chain answering a question with a context, built once per (prompt_template, llm)"""
+        if prompt_template is None:
+            prompt_template = DEFAULT_PROMPT_TEMPLATE
+
+        # the chain holds a reference to llm, so its id cannot be reused while it is cached
+        key = (prompt_template, id(llm))
+        with self._rag_chains_lock:
+            rag_chain = self._rag_chains.get(key)
+            if rag_chain is not None:
+                self._rag_chains.move_to_end(key)
+                return rag_chain
+
+        # Abstraction of Prompt, context and question are both input variables
+        prompt = ChatPromptTemplate.from_template(prompt_template)
+
+        # Creating an LLM Chain
+        rag_chain = LLMChain(llm=llm, prompt=prompt)
+        with self._rag_chains_lock:
+            self._rag_chains[key] = rag_chain
+            while len(self._rag_chains) > MAX_RAG_CHAINS: self._rag_chains.popitem(last=False)
+        return rag_chain
+
+    async def _run_in_executor(self, func: Callable[..., T], **kwargs) -> T:
+        """Run a blocking method on the default executor"""
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, **kwargs))
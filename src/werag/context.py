@@ -0,0 +1,103 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+from .tokens import pack_chunks
+from .utils import count_tokens_many
+
+
+class ContextAssembler:
+    """Build the context of the prompt from more candidates than fit in it
+
+    fetch_k chunks are retrieved with their stored vectors. A chunk whose cosine similarity to
+    a more relevant one is at least duplicate_threshold is dropped (headers, footers and FAQ
+    repeated over crawled pages), then chunks are picked greedily by maximal marginal relevance
+    per token: mmr_lambda * relevance - (1 - mmr_lambda) * similarity to the chunks already
+    picked, divided by the token count, among the whole chunks that still fit. The picked
+    chunks are joined by relevance. When none is picked (no chunk fits whole, or none is
+    relevant) the chunks left after dropping the near-duplicates are packed by relevance
+    instead, with the head of the most relevant one if none fits. Everything is computed with
+    NumPy on the fetched vectors and the token counts stored in the chunk metadata, no chunk
+    is embedded or encoded again.
+    """
+
+    def __init__(self, *, fetch_k: int = 20,
+                 duplicate_threshold: float = 0.95,
+                 mmr_lambda: float = 0.7,
+                 separator: str = "\n"):
+        self.fetch_k = fetch_k
+        self.duplicate_threshold = duplicate_threshold
+        self.mmr_lambda = mmr_lambda
+        self.separator = separator
+
+    def assemble(self, docs: List[Document], *, embeddings: Sequence[Sequence[float]],
+                 query_embedding: Sequence[float], max_tokens: int) -> str:
+        """Context of at most max_tokens tokens (by the stored counts) from the candidate docs"""
+        if len(docs) == 0: return ""
+        token_counts = self.get_token_counts(docs)
+        relevance = self._relevance(embeddings, query_embedding)
+        selected = self.select(embeddings=embeddings, query_embedding=query_embedding,
+                               token_counts=token_counts, max_tokens=max_tokens)
+        if len(selected) == 0:
+            # pack_chunks keeps the head of the most relevant one if no whole chunk fits
+            vectors = self._normalize(np.asarray(embeddings, dtype=np.float32))
+            deduplicated = self._deduplicate(vectors @ vectors.T, relevance)
+            selected = [int(index) for index in np.flatnonzero(deduplicated)]
+        selected.sort(key=lambda index: -relevance[index])
+        return pack_chunks([docs[index].page_content for index in selected],
+                           [token_counts[index] for index in selected], max_tokens, separator=self.separator)
+
+    def select(self, *, embeddings: Sequence[Sequence[float]], query_embedding: Sequence[float],
+               token_counts: Sequence[int], max_tokens: int) -> List[int]:
+        """Indexes of the candidates to pack, in the order they were picked"""
+        vectors = self._normalize(np.asarray(embeddings, dtype=np.float32))
+        relevance = self._relevance(embeddings, query_embedding)
+        similarities = vectors @ vectors.T
+        costs = np.asarray(token_counts, dtype=np.float32)
+        separator_tokens = count_tokens_many([self.separator])[0] if self.separator else 0
+
+        available = self._deduplicate(similarities, relevance)
+        selected: List[int] = []
+        redundancy = np.zeros(len(relevance), dtype=np.float32)
+        budget = max_tokens
+        while True:
+            cost = costs + (separator_tokens if selected else 0)
+            fits = available & (cost <= budget) & (costs > 0)
+            if not np.any(fits): break
+            gain = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+            density = np.where(fits, gain / np.maximum(cost, 1), -np.inf)
+            best = int(np.argmax(density))
+            if gain[best] <= 0: break
+            selected.append(best)
+            available[best] = False
+            budget -= int(cost[best])
+            redundancy = np.maximum(redundancy, similarities[best])
+        return selected
+
+    def _deduplicate(self, similarities: np.ndarray, relevance: np.ndarray) -> np.ndarray:
+        """Mask of the candidates that are not a near-duplicate of a more relevant one"""
+        available = np.zeros(len(relevance), dtype=bool)
+        for index in np.argsort(-relevance, kind="stable"):
+            if not np.any(similarities[index, available] >= self.duplicate_threshold): available[index] = True
+        return available
+
+    @staticmethod
+    def get_token_counts(docs: List[Document]) -> List[int]:
+        """Token counts stored in the metadata, only chunks saved without one are encoded"""
+        token_counts: List[Optional[int]] = [doc.metadata.get("token_count") for doc in docs]
+        uncounted = [index for index, token_count in enumerate(token_counts) if token_count is None]
+        for index, token_count in zip(uncounted, count_tokens_many(docs[index].page_content for index in uncounted)):
+            token_counts[index] = token_count
+        return token_counts
+
+    @classmethod
+    def _relevance(cls, embeddings: Sequence[Sequence[float]], query_embedding: Sequence[float]) -> np.ndarray:
+        """Cosine similarity of every candidate to the query"""
+        vectors = cls._normalize(np.asarray(embeddings, dtype=np.float32))
+        return vectors @ cls._normalize(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
@@ -0,0 +1,298 @@
+import hashlib
+import inspect
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Literal, NamedTuple, Optional, Sequence, Tuple, Union
+from urllib.parse import urlparse
+
+import html2text
+import requests
+from bs4 import BeautifulSoup
+from langchain_core.documents import Document
+from langchain_core.utils.html import extract_sub_links
+
+logger = logging.getLogger(__name__)
+
+
+class PageState(NamedTuple):
+    """What is remembered of a crawled page until the next crawl"""
+    url: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_hash: Optional[str] = None
+    links: Tuple[str, ...] = ()
+    chunk_ids: Tuple[str, ...] = ()
+
+
+class CrawledPage(NamedTuple):
+    """Outcome of fetching a page"""
+    url: str
+    status: Literal["changed", "not_modified", "failed"]
+    fetched: bool = False  # whether the body was downloaded
+    document: Optional[Document] = None  # text of a changed page
+    state: Optional[PageState] = None  # None for failed pages
+
+
+class _CrawlState:
+    """Bookkeeping of one crawl, only touched by the thread iterating the crawl"""
+
+    def __init__(self):
+        self.pending: Deque[str] = deque()  # urls to fetch
+        self.waiting: Dict[str, List[Tuple[str, int]]] = {}  # url being fetched -> (root, depth) reaching it
+        self.links: Dict[str, List[str]] = {}  # fetched url -> links in the page
+        self.depths: Dict[Tuple[str, str], int] = {}  # (url, root) -> lowest depth reached
+
+
+class Crawler:
+    """Crawl urls and their child links concurrently, yielding plain text documents
+
+    Pages are fetched on a bounded thread pool with at most max_per_host requests
+    to the same host at a time. Fetched pages are shared by all the root urls, so a page
+    reachable from several roots is fetched once. Each page is converted from HTML to
+    text by the worker that fetched it, and yielded as soon as it is ready.
+
+    Depth follows RecursiveUrlLoader: max_depth=1 only loads the root urls. So do extractor
+    (raw HTML -> HTML or text, converted to text afterwards), metadata_extractor (raw HTML, url
+    and optionally the response -> metadata), base_url and encoding. Pages are always fetched
+    concurrently, use_async is accepted for compatibility and has no effect.
+    """
+
+    def __init__(self, *, max_depth: int = 1,
+                 max_workers: int = 8,
+                 max_per_host: int = 2,
+                 timeout: Optional[int] = 10,
+                 headers: Optional[dict] = None,
+                 exclude_dirs: Sequence[str] = (),
+                 prevent_outside: bool = True,
+                 link_regex: Union[str, re.Pattern, None] = None,
+                 check_response_status: bool = False,
+                 continue_on_failure: bool = True,
+                 extractor: Optional[Callable[[str], str]] = None,
+                 metadata_extractor: Optional[Callable[..., dict]] = None,
+                 use_async: Optional[bool] = None,
+                 base_url: Optional[str] = None,
+                 autoset_encoding: bool = True,
+                 encoding: Optional[str] = None):
+        self.max_depth = max_depth
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.headers = headers
+        self.exclude_dirs = exclude_dirs
+        self.prevent_outside = prevent_outside
+        self.link_regex = link_regex
+        self.check_response_status = check_response_status
+        self.continue_on_failure = continue_on_failure
+        self.extractor = extractor if extractor is not None else lambda raw_html: raw_html
+        self.metadata_extractor = metadata_extractor if metadata_extractor is not None else _extract_metadata
+        self.base_url = base_url
+        self.autoset_encoding = autoset_encoding
+        self.encoding = encoding
+        self._local = threading.local()
+
+    def crawl(self, urls: List[str]) -> Iterator[Document]:
+        """Yield a text document per page, in the order the pages finish"""
+        for page in self.crawl_pages(urls):
+            if page.document is not None: yield page.document
+
+    def crawl_pages(self, urls: List[str], *, known: Optional[Dict[str, PageState]] = None) -> Iterator[CrawledPage]:
+        """Yield the outcome of every page, in the order the pages finish
+
+        Pages in known are requested with their validators (ETag/Last-Modified), a page answering
+        304 or with the same content hash is not_modified and is neither converted nor parsed again.
+        """
+        known = known or {}
+        state = _CrawlState()
+        for url in urls: self._visit(state, url, base_url=self.base_url or url, depth=0)
+
+        host_load: Dict[str, int] = {}
+        running: Dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="werag-crawler") as executor:
+            while len(state.pending) > 0 or len(running) > 0:
+                self._schedule(executor, state.pending, running, host_load, known)
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = running.pop(future)
+                    host_load[self._host(url)] -= 1
+                    page: CrawledPage = future.result()
+                    state.links[url] = list(page.state.links) if page.state is not None else []
+                    for base_url, depth in state.waiting.pop(url):
+                        self._expand(state, url, base_url=base_url, depth=depth)
+                    yield page
+
+    def _visit(self, state: _CrawlState, url: str, *, base_url: str, depth: int):
+        """Reach url from the crawl rooted at base_url, fetching it only the first time"""
+        if depth >= self.max_depth: return
+        # the same page can be reached from several roots, or again at a lower depth
+        best = state.depths.get((url, base_url))
+        if best is not None and best <= depth: return
+        state.depths[(url, base_url)] = depth
+
+        if url in state.links:
+            self._expand(state, url, base_url=base_url, depth=depth)
+        elif url in state.waiting:
+            state.waiting[url].append((base_url, depth))
+        else:
+            state.waiting[url] = [(base_url, depth)]
+            state.pending.append(url)
+
+    def _expand(self, state: _CrawlState, url: str, *, base_url: str, depth: int):
+        for link in state.links[url]:
+            if self._is_inside(link, base_url=base_url):
+                self._visit(state, link, base_url=base_url, depth=depth + 1)
+
+    def _is_inside(self, link: str, *, base_url: str) -> bool:
+        """Same rule as extract_sub_links with prevent_outside"""
+        if not self.prevent_outside: return True
+        return self._host(link) == self._host(base_url) and link.startswith(base_url)
+
+    def _schedule(self, executor: ThreadPoolExecutor, pending: Deque[str],
+                  running: Dict[Future, str], host_load: Dict[str, int], known: Dict[str, PageState]):
+        """Submit pending pages while there are free workers, skipping busy hosts"""
+        waiting: Deque[str] = deque()
+        while len(pending) > 0 and len(running) < self.max_workers:
+            url = pending.popleft()
+            host = self._host(url)
+            if host_load.get(host, 0) >= self.max_per_host:
+                waiting.append(url)
+                continue
+            host_load[host] = host_load.get(host, 0) + 1
+            running[executor.submit(self._load, url, known.get(url))] = url
+        pending.extendleft(reversed(waiting))
+
+    def _load(self, url: str, known: Optional[PageState] = None) -> CrawledPage:
+        """Fetch a page, conditionally if it is known"""
+        headers = dict(self.headers or {})
+        if known is not None and known.etag: headers["If-None-Match"] = known.etag
+        if known is not None and known.last_modified: headers["If-Modified-Since"] = known.last_modified
+        try:
+            response = self._session().get(url, timeout=self.timeout, headers=headers)
+            if known is not None and response.status_code == 304:
+                return CrawledPage(url=url, status="not_modified", state=known)
+            if self.check_response_status and 400 <= response.status_code <= 599:
+                raise ValueError(f"Received HTTP status {response.status_code}")
+
+            content_hash = hashlib.sha256(response.content).hexdigest()
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            if known is not None and known.content_hash == content_hash:
+                return CrawledPage(url=url, status="not_modified", fetched=True,
+                                   state=known._replace(etag=etag, last_modified=last_modified))
+
+            if self.encoding is not None:
+                response.encoding = self.encoding
+            elif self.autoset_encoding:
+                response.encoding = response.apparent_encoding
+            raw_html = response.text
+            extracted = self.extractor(raw_html)
+            content = self._to_text(extracted) if extracted else ""
+            # links are filtered by each root later, the page may be reached from several roots
+            links = extract_sub_links(raw_html, url, pattern=self.link_regex, prevent_outside=False,
+                                      exclude_prefixes=self.exclude_dirs,
+                                      continue_on_failure=self.continue_on_failure)
+            return CrawledPage(url=url, status="changed", fetched=True,
+                               document=Document(page_content=content,
+                                                 metadata=self._metadata(raw_html, url, response)) if content else None,
+                               state=PageState(url=url, etag=etag, last_modified=last_modified,
+                                               content_hash=content_hash, links=tuple(links)))
+        except Exception as e:
+            if not self.continue_on_failure: raise e
+            logger.warning(f"Unable to load from {url}. Received error {e} of type {e.__class__.__name__}")
+            return CrawledPage(url=url, status="failed")
+
+    def _metadata(self, raw_html: str, url: str, response: requests.Response) -> dict:
+        # like RecursiveUrlLoader, a metadata_extractor may or may not take the response
+        if len(inspect.signature(self.metadata_extractor).parameters) == 2:
+            return self.metadata_extractor(raw_html, url)
+        return self.metadata_extractor(raw_html, url, response)
+
+    def _session(self) -> requests.Session:
+        """One session per worker thread, to reuse connections"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    @staticmethod
+    def _to_text(raw_html: str) -> str:
+        # same settings as Html2TextTransformer
+        h = html2text.HTML2Text()
+        h.ignore_links = True
+        h.ignore_images = True
+        return h.handle(raw_html)
+
+    @staticmethod
+    def _host(url: str) -> str:
+        return urlparse(url).netloc
+
+
+def _extract_metadata(raw_html: str, url: str, response: requests.Response) -> dict:
+    """Source, content type, title, description and language of a page, as RecursiveUrlLoader"""
+    metadata = {"source": url, "content_type": response.headers.get("Content-Type", "")}
+    soup = BeautifulSoup(raw_html, "html.parser")
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if (description := soup.find("meta", attrs={"name": "description"})) and description.get("content"):
+        metadata["description"] = description.get("content")
+    if (html := soup.find("html")) and html.get("lang"):
+        metadata["language"] = html.get("lang")
+    return metadata
+
+
+class CrawlStateStore:
+    """Validators, content hash, links and chunk ids of the crawled pages, in a SQLite file
+
+    Pages are grouped by (user, content_type), the scope of save_urls.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS crawl_pages (
+                    scope TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_hash TEXT,
+                    links TEXT NOT NULL,
+                    chunk_ids TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (scope, url)
+                )
+            """)
+
+    def get_pages(self, *, user: str, content_type: Optional[str] = None) -> Dict[str, PageState]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT url, etag, last_modified, content_hash, links, chunk_ids FROM crawl_pages WHERE scope = ?",
+                (self._scope(user=user, content_type=content_type),)
+            ).fetchall()
+        return {
+            url: PageState(url=url, etag=etag, last_modified=last_modified, content_hash=content_hash,
+                           links=tuple(json.loads(links)), chunk_ids=tuple(json.loads(chunk_ids)))
+            for url, etag, last_modified, content_hash, links, chunk_ids in rows
+        }
+
+    def replace_pages(self, *, user: str, content_type: Optional[str] = None, pages: Iterable[PageState]):
+        """Make pages the only pages remembered for the scope"""
+        scope = self._scope(user=user, content_type=content_type)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM crawl_pages WHERE scope = ?", (scope,))
+            self._conn.executemany(
+                "INSERT INTO crawl_pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(scope, page.url, page.etag, page.last_modified, page.content_hash,
+                  json.dumps(list(page.links)), json.dumps(list(page.chunk_ids)), now) for page in pages]
+            )
+
+    @staticmethod
+    def _scope(*, user: str, content_type: Optional[str] = None) -> str:
+        return json.dumps([user, content_type], ensure_ascii=False)
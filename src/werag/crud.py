@@ -1,59 +1,315 @@
 # import
-import uuid
-from typing import List
+import functools
+import hashlib
+import itertools
+import json
+from typing import Dict, Iterable, Iterator, List, Literal, Set, Tuple
 from typing import Optional
 
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
 from langchain_text_splitters import CharacterTextSplitter
 
-from .schema import UserContent
-from .utils import remove_none_from_dict
+from .db import (deferred_save, query_embedding_with_vectors, query_embeddings, query_embeddings_with_ids,
+                 upsert_embeddings)
+from .embeddings import embed_queries
+from .ingest import IngestPipeline
+from .lexical import LexicalIndex, reciprocal_rank_fusion
+from .manifest import ChunkManifest
+from .schema import ChunkDiff, UserContent
+from .tokens import split_tokens
+from .utils import count_tokens_many
 
 
 class CRUDChroma:
 
-    def __init__(self, *, chunk_size: int = 1000, chunk_overlap: int = 0):
+    def __init__(self, *, chunk_size: int = 1000, chunk_overlap: int = 0,
+                 split_by: Literal["character", "token"] = "character",
+                 batch_size: int = 256,
+                 write_batch_size: int = 1024,
+                 queue_size: int = 4,
+                 manifest: Optional[ChunkManifest] = None,
+                 lexical_index: Optional[LexicalIndex] = None):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        # unit of chunk_size and chunk_overlap
+        self.split_by = split_by
+        # ingest pipeline: chunks per embedding call, chunks per write, batches buffered between stages
+        self.batch_size = batch_size
+        self.write_batch_size = write_batch_size
+        self.queue_size = queue_size
+        # when given, every write is recorded in it and the stored ids are read from it
+        self.manifest = manifest
+        # when given, every write is indexed in it too, for hybrid search
+        self.lexical_index = lexical_index
 
-    def save_user_documents(self, client: Chroma, *, user: str, documents: List[Document],
-                          content_type: Optional[str] = None) -> Optional[UserContent]:
-        if len(documents) == 0: return None
-        content = "\n".join([doc.page_content for doc in documents])
-        return self.save_user_content(client=client, user=user, content=content,
-                                      content_type=content_type)
+    def save_user_documents(self, client: Chroma, *, user: str, documents: Iterable[Document],
+                          content_type: Optional[str] = None,
+                          batch_size: Optional[int] = None,
+                          stream: bool = False) -> Optional[UserContent]:
+        """Save documents as the only content under the filter of user (and content type)
+
+        Every document is split on its own, so an unchanged document keeps its chunk ids
+        no matter what changed in the other documents. Documents are consumed one by one and
+        new chunks are written batch_size at a time. The returned page_content is the documents
+        joined by newlines, with stream=True it is left empty so memory is bounded by the batch
+        size and not by the documents.
+        batch_size overrides the embedding batch size of the ingest pipeline.
+        """
+        documents = iter(documents)
+        first = next(documents, None)
+        if first is None: return None
+        texts: List[str] = []
+
+        def iter_chunks():
+            for document in itertools.chain([first], documents):
+                if not stream: texts.append(document.page_content)
+                chunks, ids = self.split_user_document(user=user, content_type=content_type, document=document)
+                yield from zip(ids, chunks)
+
+        chunk_diff = self._save_user_chunk_stream(client, user=user, content_type=content_type,
+                                                  chunks=iter_chunks(), batch_size=batch_size)
+        user_content = UserContent.new_from_user_content(user=user, content="\n".join(texts),
+                                                         content_type=content_type)
+        user_content.chunk_diff = chunk_diff
+        return user_content
 
     def save_user_content(self, client: Chroma, *, user: str, content: str,
                           content_type: Optional[str] = None) -> UserContent:
-        # delete any existed old content with the same filter
-        _filter = self.get_user_content_filter(user=user, content_type=content_type)
-        old_ids = client.get(
-            where=_filter
-        )['ids']
-        if len(old_ids) > 0: client.delete(ids=old_ids)
+        """Save content as the only content under the filter of user (and content type)
 
-        # split it into chunks
-        text_splitter = CharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+        Chunk ids are derived from the chunk text, so only chunks that are new are embedded
+        and written, chunks that disappeared are deleted and the rest are kept untouched.
+        """
         user_content = UserContent.new_from_user_content(user=user, content=content, content_type=content_type)
-        docs = text_splitter.split_documents([user_content.to_document()])
+        chunks, ids = self.split_user_document(user=user, content_type=content_type,
+                                               document=user_content.to_document())
+        user_content.chunk_diff = self.save_user_chunks(client, user=user, content_type=content_type,
+                                                        chunks=chunks, ids=ids)
+        return user_content
+
+    def save_user_contents(self, client: Chroma, *,
+                           records: Iterable[Tuple[str, Optional[str], str]]) -> List[UserContent]:
+        """Save many (user, content_type, content) records at once, like save_user_content for each
+
+        The stored ids of all the users are read with one query, the new chunks of all the records
+        go through one ingest pipeline (so they are embedded and written in large cross-user batches)
+        and the stale chunks are deleted with one call. A scope may only appear once: a user saved
+        without content type cannot be saved with a content type in the same call.
+        """
+        user_contents = [UserContent.new_from_user_content(user=user, content=content, content_type=content_type)
+                         for user, content_type, content in records]
+        if len(user_contents) == 0: return []
+        self._check_scopes(user_contents)
+
+        # scope (user, content_type) -> stored ids, the scope (user, None) holds all the ids of the user
+        old_ids = self.get_ids_by_scope(client, users=[user_content.user for user_content in user_contents])
+        for (user, content_type), ids in list(old_ids.items()):
+            old_ids.setdefault((user, None), set()).update(ids)
+
+        diffs = [ChunkDiff() for _ in user_contents]
+        removed_ids = []
+        new_chunks: List[Tuple[str, Document]] = []
+        for user_content, diff in zip(user_contents, diffs):
+            scope_ids = old_ids.get((user_content.user, user_content.content_type), set())
+            chunks, ids = self.split_user_document(user=user_content.user, content_type=user_content.content_type,
+                                                   document=user_content.to_document())
+            wanted_ids = set(ids)
+            for _id, chunk in dict(zip(ids, chunks)).items():
+                if _id not in scope_ids: new_chunks.append((_id, chunk))
+            diff.added = len(wanted_ids.difference(scope_ids))
+            diff.kept = len(scope_ids.intersection(wanted_ids))
+            diff.removed = len(scope_ids.difference(wanted_ids))
+            removed_ids += scope_ids.difference(wanted_ids)
+
+        pipeline = IngestPipeline(embedding_function=client.embeddings,
+                                  writer=functools.partial(self._write_chunks, client),
+                                  batch_size=self.batch_size,
+                                  write_batch_size=self.write_batch_size,
+                                  queue_size=self.queue_size)
+        with deferred_save(client, users=[user_content.user for user_content in user_contents]):
+            ingest_stats = pipeline.run(new_chunks)
+
+            # the new chunks are saved before deleting the stale ones
+            if len(removed_ids) > 0: self._delete_chunks(client, ids=removed_ids)
+        for user_content, diff in zip(user_contents, diffs):
+            diff.ingest_stats = ingest_stats
+            user_content.chunk_diff = diff
+        return user_contents
+
+    @staticmethod
+    def _check_scopes(user_contents: List[UserContent]):
+        scopes, users = set(), set()
+        for user_content in user_contents:
+            user, content_type = user_content.user, user_content.content_type
+            if (user, content_type) in scopes or (user, None) in scopes or (content_type is None and user in users):
+                raise ValueError(f"Content of user {user} is saved more than once")
+            scopes.add((user, content_type))
+            users.add(user)
+
+    def split_user_document(self, *, user: str, content_type: Optional[str] = None,
+                            document: Document) -> Tuple[List[Document], List[str]]:
+        """Split a document into chunks carrying the user metadata, with their ids
+
+        The token count of every chunk is stored in its metadata, so the context can be
+        packed without encoding the chunks again.
+        """
+        metadata = {"user": user, "content_type": content_type}
+        source = document.metadata.get("source")
+        if isinstance(source, str): metadata["source"] = source
+
+        if self.split_by == "token":
+            chunks = [Document(page_content=text, metadata={**metadata, "token_count": token_count})
+                      for text, token_count in split_tokens(document.page_content, max_tokens=self.chunk_size,
+                                                            overlap_tokens=self.chunk_overlap)]
+        else:
+            text_splitter = CharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+            chunks = text_splitter.split_documents([Document(page_content=document.page_content, metadata=metadata)])
+            for chunk, token_count in zip(chunks, count_tokens_many(doc.page_content for doc in chunks)):
+                chunk.metadata["token_count"] = token_count
+        ids = self.get_chunk_ids(user=user, content_type=content_type, texts=[doc.page_content for doc in chunks])
+        return chunks, ids
+
+    def save_user_chunks(self, client: Chroma, *, user: str, content_type: Optional[str] = None,
+                         chunks: List[Document], ids: List[str], keep_ids: Iterable[str] = ()) -> ChunkDiff:
+        """Make chunks (plus the already stored keep_ids) the only chunks under the filter
+
+        Only chunks whose id is not stored yet are embedded and written, then the stored
+        chunks that are neither in ids nor in keep_ids are deleted.
+        """
+        return self._save_user_chunk_stream(client, user=user, content_type=content_type,
+                                            chunks=zip(ids, chunks), keep_ids=keep_ids)
+
+    def _save_user_chunk_stream(self, client: Chroma, *, user: str, content_type: Optional[str] = None,
+                                chunks: Iterable[Tuple[str, Document]], keep_ids: Iterable[str] = (),
+                                batch_size: Optional[int] = None) -> ChunkDiff:
+        """Diff-based upsert of (id, chunk) pairs, embedding and writing new chunks as they come"""
+        old_ids = self.get_user_chunk_ids(client, user=user, content_type=content_type)
+        wanted_ids = set(keep_ids)
+
+        def iter_new_chunks():
+            for _id, chunk in chunks:
+                if _id in wanted_ids: continue
+                wanted_ids.add(_id)
+                if _id not in old_ids: yield _id, chunk
+
+        pipeline = IngestPipeline(embedding_function=client.embeddings,
+                                  writer=functools.partial(self._write_chunks, client),
+                                  batch_size=batch_size or self.batch_size,
+                                  write_batch_size=self.write_batch_size,
+                                  queue_size=self.queue_size)
+        with deferred_save(client, users=[user]):
+            ingest_stats = pipeline.run(iter_new_chunks())
 
-        # save
-        client.add_texts(
-            texts=[doc.page_content for doc in docs],
-            metadatas=[remove_none_from_dict(doc.metadata) for doc in docs],
-            ids=[str(uuid.uuid4()) for _ in docs]
+            # the new chunks are saved before deleting the stale ones
+            removed_ids = list(old_ids.difference(wanted_ids))
+            if len(removed_ids) > 0: self._delete_chunks(client, ids=removed_ids)
+        return ChunkDiff(added=ingest_stats.write.items, removed=len(removed_ids),
+                         kept=len(old_ids.intersection(wanted_ids)), ingest_stats=ingest_stats)
+
+    def _write_chunks(self, client: Chroma, *, ids: List[str], embeddings: Optional[List[List[float]]],
+                      metadatas: List[dict], documents: List[str]):
+        upsert_embeddings(client, ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+        if self.manifest is not None: self.manifest.add_chunks(client, ids=ids, metadatas=metadatas,
+                                                               documents=documents)
+        if self.lexical_index is not None: self.lexical_index.add_chunks(client, ids=ids, metadatas=metadatas,
+                                                                         documents=documents)
+
+    def _delete_chunks(self, client: Chroma, *, ids: List[str]):
+        client.delete(ids=ids)
+        if self.manifest is not None: self.manifest.remove_chunks(client, ids=ids)
+        if self.lexical_index is not None: self.lexical_index.remove_chunks(client, ids=ids)
+
+    def get_user_chunk_ids(self, client: Chroma, *, user: str, content_type: Optional[str] = None) -> Set[str]:
+        """Ids of the chunks stored under the filter of user (and content type)"""
+        if self.manifest is not None: return self.manifest.get_ids(client, user=user, content_type=content_type)
+        return set(client.get(
+            where=self.get_user_content_filter(user=user, content_type=content_type),
+            include=[]
+        )['ids'])
+
+    def get_ids_by_scope(self, client: Chroma, *, users: Iterable[str]) -> Dict[Tuple[str, Optional[str]], Set[str]]:
+        """Ids of the chunks of users, grouped by (user, content_type)"""
+        users = list(set(users))
+        if self.manifest is not None: return self.manifest.get_ids_by_scope(client, users=users)
+        stored = client.get(
+            where={"user": {"$in": users}},
+            include=["metadatas"]
         )
-        return user_content
+        scopes: Dict[Tuple[str, Optional[str]], Set[str]] = {}
+        for _id, metadata in zip(stored['ids'], stored['metadatas']):
+            scopes.setdefault((metadata['user'], metadata.get('content_type')), set()).add(_id)
+        return scopes
+
+    def has_user_content(self, client: Chroma, *, user: str, content_type: Optional[str] = None) -> bool:
+        if self.manifest is not None: return self.manifest.exists(client, user=user, content_type=content_type)
+        return len(client.get(
+            where=self.get_user_content_filter(user=user, content_type=content_type),
+            limit=1,
+            include=[]
+        )['ids']) > 0
+
+    def get_chunk_ids(self, *, user: str, content_type: Optional[str] = None, texts: List[str]) -> List[str]:
+        """Content-addressed ids for the chunks of one content (or document)
+
+        The id is a hash of user, content type and chunk text, a repeated chunk text also
+        hashes its occurrence number so every chunk of the content gets a distinct id.
+        """
+        occurrences: Dict[str, int] = {}
+        ids = []
+        for text in texts:
+            occurrence = occurrences.get(text, 0)
+            occurrences[text] = occurrence + 1
+            key = json.dumps([user, content_type, text, occurrence], ensure_ascii=False)
+            ids.append(hashlib.sha256(key.encode("utf-8")).hexdigest())
+        return ids
 
     def get_user_content(self, client: Chroma, *, user: str, content_type: Optional[str] = None) -> List[UserContent]:
         """Get content for user from chroma"""
-        client_response = client.get(
-            where=self.get_user_content_filter(user=user, content_type=content_type)
-        )
+        if self.manifest is not None:
+            # a lookup by ids instead of a metadata scan
+            ids = self.manifest.get_ids(client, user=user, content_type=content_type)
+            if len(ids) == 0: return []
+            client_response = client.get(ids=sorted(ids))
+        else:
+            client_response = client.get(
+                where=self.get_user_content_filter(user=user, content_type=content_type)
+            )
         parsed = self._parse_client_response_to_user_content(client_response=client_response)
         return parsed
 
+    def get_user_content_page(self, client: Chroma, *, user: str, content_type: Optional[str] = None,
+                              limit: int = 100, offset: int = 0,
+                              include_documents: bool = True) -> List[UserContent]:
+        """Get one page of the content of user, without include_documents page_content is left empty"""
+        include = ["metadatas", "documents"] if include_documents else ["metadatas"]
+        if self.manifest is not None:
+            ids = sorted(self.manifest.get_ids(client, user=user, content_type=content_type))[offset:offset + limit]
+            if len(ids) == 0: return []
+            client_response = client.get(ids=ids, include=include)
+            # get by ids does not keep their order
+            order = {_id: index for index, _id in enumerate(ids)}
+            return sorted(self._parse_client_response_to_user_content(client_response=client_response),
+                          key=lambda user_content: order[user_content.id])
+        client_response = client.get(
+            where=self.get_user_content_filter(user=user, content_type=content_type),
+            limit=limit,
+            offset=offset,
+            include=include
+        )
+        return self._parse_client_response_to_user_content(client_response=client_response)
+
+    def iter_user_content(self, client: Chroma, *, user: str, content_type: Optional[str] = None,
+                          page_size: int = 100, offset: int = 0,
+                          include_documents: bool = True) -> Iterator[UserContent]:
+        """Yield the content of user page by page, a page is only fetched when the previous one is consumed"""
+        while True:
+            page = self.get_user_content_page(client, user=user, content_type=content_type, limit=page_size,
+                                              offset=offset, include_documents=include_documents)
+            yield from page
+            if len(page) < page_size: return
+            offset += page_size
+
     def get_user_content_filter(self, *, user: str, content_type: Optional[str] = None) -> dict:
         """Get content filter base on user and additional content key
 
@@ -81,7 +337,7 @@ class CRUDChroma:
             id=client_response['ids'][index],
             user=client_response['metadatas'][index]['user'],
             content_type=client_response['metadatas'][index].get("content_type"),
-            page_content=client_response['documents'][index]
+            page_content=client_response['documents'][index] if client_response.get('documents') else ""
         ) for index, _ in enumerate(client_response['ids'])]
 
     def search_documents(self, client: Chroma, *, query: str, limit: int = 4, user: str,
@@ -89,3 +345,68 @@ class CRUDChroma:
             List[Document]:
         return client.similarity_search(query, k=limit,
                                         filter=self.get_user_content_filter(user=user, content_type=content_type))
+
+    def search_documents_batch(self, client: Chroma, *, queries: List[str], limit: int = 4, user: str,
+                               content_type: Optional[str] = None) -> List[List[Document]]:
+        """Search many queries, embedded as queries and searched together, one result list per query
+
+        With a lexical index each query is fused with its BM25 results like search_documents_hybrid,
+        the queries are still embedded in one call.
+        """
+        if len(queries) == 0: return []
+        embeddings = embed_queries(client.embeddings, queries)
+        if self.lexical_index is not None:
+            return [self.search_documents_hybrid(client, query=query, limit=limit, user=user,
+                                                 content_type=content_type, embedding=embedding)
+                    for query, embedding in zip(queries, embeddings)]
+        return query_embeddings(client, embeddings=embeddings, k=limit,
+                                where=self.get_user_content_filter(user=user, content_type=content_type))
+
+    def search_documents_hybrid(self, client: Chroma, *, query: str, limit: int = 4, user: str,
+                                content_type: Optional[str] = None,
+                                embedding: Optional[List[float]] = None,
+                                fetch_k: Optional[int] = None) -> List[Document]:
+        """Fuse the vector search and the BM25 search of the lexical index with reciprocal rank fusion
+
+        Each search returns fetch_k candidates (4 times limit by default), an exact term that
+        embeddings miss (a product code, a phone number) still ranks high on the BM25 side.
+        embedding is the query vector when it is already computed.
+        """
+        ids, documents = self._search_ids_hybrid(client, query=query, limit=limit, user=user,
+                                                 content_type=content_type, embedding=embedding, fetch_k=fetch_k)
+        missing = [_id for _id in ids if _id not in documents]
+        if len(missing) > 0:
+            response = client.get(ids=missing, include=["metadatas", "documents"])
+            for _id, document, metadata in zip(response['ids'], response['documents'], response['metadatas']):
+                documents[_id] = Document(page_content=document, metadata=metadata or {})
+        return [documents[_id] for _id in ids if _id in documents]
+
+    def search_candidates(self, client: Chroma, *, query: str, embedding: List[float], limit: int = 20, user: str,
+                          content_type: Optional[str] = None) -> Tuple[List[Document], List[List[float]]]:
+        """The limit best chunks for the query vector with their stored vectors, hybrid with a lexical index"""
+        _filter = self.get_user_content_filter(user=user, content_type=content_type)
+        if self.lexical_index is None:
+            return query_embedding_with_vectors(client, embedding=embedding, k=limit, where=_filter)
+        ids, _ = self._search_ids_hybrid(client, query=query, limit=limit, user=user, content_type=content_type,
+                                         embedding=embedding)
+        if len(ids) == 0: return [], []
+        response = client.get(ids=ids, include=["metadatas", "documents", "embeddings"])
+        found = {_id: (Document(page_content=document, metadata=metadata or {}), list(vector))
+                 for _id, document, metadata, vector in zip(response['ids'], response['documents'],
+                                                            response['metadatas'], response['embeddings'])}
+        ordered = [found[_id] for _id in ids if _id in found]
+        return [document for document, _ in ordered], [vector for _, vector in ordered]
+
+    def _search_ids_hybrid(self, client: Chroma, *, query: str, limit: int, user: str,
+                           content_type: Optional[str] = None, embedding: Optional[List[float]] = None,
+                           fetch_k: Optional[int] = None) -> Tuple[List[str], Dict[str, Document]]:
+        """Fused ids of the hybrid search, with the documents the vector search already returned"""
+        fetch_k = fetch_k or limit * 4
+        if embedding is None: embedding = client.embeddings.embed_query(query)
+        _filter = self.get_user_content_filter(user=user, content_type=content_type)
+        vector_results = query_embeddings_with_ids(client, embeddings=[embedding], k=fetch_k, where=_filter)[0]
+        lexical_results = self.lexical_index.search(client, query=query, user=user, content_type=content_type,
+                                                    limit=fetch_k)
+        ids = reciprocal_rank_fusion([[_id for _id, _ in vector_results],
+                                      [_id for _id, _ in lexical_results]])[:limit]
+        return ids, dict(vector_results)
@@ -1,12 +1,204 @@
+import contextlib
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import ContextManager, Dict, Iterable, List, Literal, Optional, Tuple
+
 from langchain_chroma import Chroma
+from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from .numpy_store import NumpyVectorStore
 
 
 def get_chroma(*, collection_name: str, persist_directory: str,
-               embedding_function: Embeddings) -> Chroma:
+               embedding_function: Embeddings,
+               backend: Literal["chroma", "numpy"] = "chroma",
+               dtype: Literal["float32", "float16", "int8"] = "float32",
+               rescore_factor: int = 4) -> VectorStore:
+    """Open the vector store of a deployment, chroma or the in-memory NumPy store
+
+    dtype and rescore_factor only apply to the NumPy store, see NumpyVectorStore.
+    """
+    if backend == "numpy":
+        return NumpyVectorStore(collection_name=collection_name, persist_directory=persist_directory,
+                                embedding_function=embedding_function, dtype=dtype, rescore_factor=rescore_factor)
     # create the chroma client
     return Chroma(
         collection_name=collection_name,
         persist_directory=persist_directory,
         embedding_function=embedding_function
     )
+
+
+def get_collection_name(client: VectorStore) -> str:
+    if isinstance(client, NumpyVectorStore): return client.collection_name
+    return client._collection.name
+
+
+def upsert_embeddings(client: Chroma, *, ids: List[str], embeddings: Optional[List[List[float]]],
+                      metadatas: List[dict], documents: List[str]):
+    """Write chunks whose vectors are already computed (add_texts would embed them again)"""
+    if isinstance(client, NumpyVectorStore):
+        return client.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+    max_batch_size = getattr(client._client, "max_batch_size", None) or len(ids)
+    for start in range(0, len(ids), max_batch_size):
+        end = start + max_batch_size
+        client._collection.upsert(
+            ids=ids[start:end],
+            embeddings=embeddings[start:end] if embeddings is not None else None,
+            metadatas=metadatas[start:end],
+            documents=documents[start:end]
+        )
+
+
+def deferred_save(client: Chroma, *, users: Iterable[str]) -> ContextManager:
+    """Persist the NumPy store once at the end of the block, not after every write batch (no-op for chroma)"""
+    if isinstance(client, NumpyVectorStore): return client.deferred_save(users=users)
+    return contextlib.nullcontext()
+
+
+def query_embeddings(client: Chroma, *, embeddings: List[List[float]], k: int = 4,
+                     where: Optional[dict] = None, batch_size: int = 256) -> List[List[Document]]:
+    """Search several query vectors with one chroma request per batch_size queries"""
+    return [[document for _, document in results]
+            for results in query_embeddings_with_ids(client, embeddings=embeddings, k=k, where=where,
+                                                     batch_size=batch_size)]
+
+
+def query_embeddings_with_ids(client: Chroma, *, embeddings: List[List[float]], k: int = 4,
+                              where: Optional[dict] = None,
+                              batch_size: int = 256) -> List[List[Tuple[str, Document]]]:
+    """Like query_embeddings, with the chunk id of every document"""
+    if isinstance(client, NumpyVectorStore): return client.query(embeddings=embeddings, k=k, where=where)
+    results: List[List[Tuple[str, Document]]] = []
+    for start in range(0, len(embeddings), batch_size):
+        response = client._collection.query(
+            query_embeddings=embeddings[start:start + batch_size],
+            n_results=k,
+            where=where,
+            include=["documents", "metadatas"]
+        )
+        for ids, documents, metadatas in zip(response['ids'], response['documents'], response['metadatas']):
+            results.append([(_id, Document(page_content=document, metadata=metadata or {}))
+                            for _id, document, metadata in zip(ids, documents, metadatas)])
+    return results
+
+
+def query_embedding_with_vectors(client: Chroma, *, embedding: List[float], k: int = 4,
+                                 where: Optional[dict] = None) -> Tuple[List[Document], List[List[float]]]:
+    """Search one query vector, with the stored vector of every document found"""
+    if isinstance(client, NumpyVectorStore):
+        results = client.query(embeddings=[embedding], k=k, where=where)[0]
+        return [document for _, document in results], get_embeddings(client, ids=[_id for _id, _ in results])
+    response = client._collection.query(
+        query_embeddings=[embedding],
+        n_results=k,
+        where=where,
+        include=["documents", "metadatas", "embeddings"]
+    )
+    documents = [Document(page_content=document, metadata=metadata or {})
+                 for document, metadata in zip(response['documents'][0], response['metadatas'][0])]
+    return documents, [list(vector) for vector in response['embeddings'][0]]
+
+
+def get_embeddings(client: Chroma, *, ids: List[str]) -> List[List[float]]:
+    """Stored vectors of ids, in the order of ids (get by ids does not keep it)"""
+    if len(ids) == 0: return []
+    response = client.get(ids=ids, include=["embeddings"])
+    vectors = dict(zip(response['ids'], response['embeddings']))
+    return [list(vectors[_id]) for _id in ids]
+
+
+class CollectionRouter:
+    """Route every user to the chroma collection holding its content
+
+    Without sharding every user is in the shared collection. With sharding="user" each user
+    has its own collection, with sharding="bucket" users are spread by a stable hash over
+    num_buckets collections, so a search only scans the vectors of one user (or bucket).
+    The user filter is still applied inside a collection, buckets hold several users.
+    Opened collections are kept in a LRU of max_open_collections handles. A NumpyVectorStore
+    keeps the collections it opened itself, an evicted handle is found there again.
+    """
+
+    def __init__(self, shared: Chroma, *,
+                 sharding: Optional[Literal["user", "bucket"]] = None,
+                 num_buckets: int = 64,
+                 max_open_collections: int = 128):
+        self.shared = shared
+        self.sharding = sharding
+        self.num_buckets = num_buckets
+        self.max_open_collections = max_open_collections
+        self._collections: "OrderedDict[str, Chroma]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, *, user: str) -> Chroma:
+        """Collection of user, opened (or created) on first use"""
+        if self.sharding is None: return self.shared
+        return self.get_collection(self.get_collection_name(user=user))
+
+    def get_collection(self, name: str) -> Chroma:
+        with self._lock:
+            client = self._collections.get(name)
+            if client is None:
+                if isinstance(self.shared, NumpyVectorStore):
+                    # the same store as before eviction, its chunks are only in its memory
+                    client = self.shared.open_collection(name)
+                else:
+                    # the handles share the chromadb client of the shared collection
+                    client = Chroma(collection_name=name, client=self.shared._client,
+                                    embedding_function=self.shared.embeddings)
+                self._collections[name] = client
+                while len(self._collections) > self.max_open_collections: self._collections.popitem(last=False)
+            self._collections.move_to_end(name)
+            return client
+
+    def get_collection_name(self, *, user: str) -> str:
+        """Stable collection name of user, always a valid chroma name (3-63 chars of [a-zA-Z0-9_-])"""
+        digest = hashlib.sha256(user.encode("utf-8")).hexdigest()
+        shard = f"b{int(digest, 16) % self.num_buckets}" if self.sharding == "bucket" else f"u{digest[:24]}"
+        return f"{self._get_prefix(shard)}-{shard}"
+
+    def is_routed(self, name: str) -> bool:
+        """Whether name is the shared collection or one of the collections it is sharded into"""
+        if name == get_collection_name(self.shared): return True
+        prefix, _, shard = name.rpartition("-")
+        return re.fullmatch(r"b\d+|u[0-9a-f]{24}", shard) is not None and prefix == self._get_prefix(shard)
+
+    def _get_prefix(self, shard: str) -> str:
+        return re.sub(r"[^a-zA-Z0-9_-]", "_", get_collection_name(self.shared))[:63 - len(shard) - 1]
+
+
+def migrate_to_shards(router: CollectionRouter, *, batch_size: int = 1000) -> int:
+    """Move the chunks of the shared collection to the collections of their users
+
+    Stored vectors, documents and metadata are copied as they are, nothing is embedded again.
+    The chunks are deleted from the shared collection once all of them are copied,
+    so an interrupted migration can simply be run again. Return the number of chunks moved.
+    """
+    if router.sharding is None: return 0
+    moved_ids = []
+    offset = 0
+    while True:
+        response = router.shared.get(limit=batch_size, offset=offset,
+                                     include=["embeddings", "metadatas", "documents"])
+        if len(response['ids']) == 0: break
+        offset += len(response['ids'])
+
+        by_collection: Dict[str, List[int]] = {}
+        for index, metadata in enumerate(response['metadatas']):
+            name = router.get_collection_name(user=metadata['user'])
+            by_collection.setdefault(name, []).append(index)
+        for name, indexes in by_collection.items():
+            upsert_embeddings(router.get_collection(name),
+                              ids=[response['ids'][index] for index in indexes],
+                              embeddings=[response['embeddings'][index] for index in indexes],
+                              metadatas=[response['metadatas'][index] for index in indexes],
+                              documents=[response['documents'][index] for index in indexes])
+        moved_ids += response['ids']
+
+    for start in range(0, len(moved_ids), batch_size):
+        router.shared.delete(ids=moved_ids[start:start + batch_size])
+    return len(moved_ids)
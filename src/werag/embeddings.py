@@ -0,0 +1,248 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+
+from langchain_community.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+from langchain_core.embeddings import Embeddings
+
+
+def embed_queries(embeddings: Embeddings, texts: List[str]) -> List[List[float]]:
+    """Query vectors of texts, with the batched query path of embeddings when it has one
+
+    embed_documents is not used, an asymmetric model embeds queries and documents differently.
+    """
+    embed = getattr(embeddings, "embed_queries", None)
+    if embed is not None: return embed(texts)
+    return [embeddings.embed_query(text) for text in texts]
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only embeds texts it has not seen before
+
+    Vectors are keyed by model id, kind (document or query) and a hash of the text,
+    kept in an in-memory LRU and, when cache_path is given, in a SQLite file
+    so the cache survives restarts and is shared between processes. Vectors are stored as
+    float32 and fresh vectors are rounded the same way, so a text embeds to the same vector
+    whether it came from the model, the memory or the file.
+    """
+
+    def __init__(self, embeddings: Embeddings, *,
+                 cache_path: Optional[str] = None,
+                 model_id: Optional[str] = None,
+                 max_memory_items: int = 10000):
+        self.embeddings = embeddings
+        self.model_id = model_id or self.get_model_id(embeddings)
+        self.max_memory_items = max_memory_items
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        if cache_path is not None:
+            self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._conn.commit()
+
+    @staticmethod
+    def get_model_id(embeddings: Embeddings) -> str:
+        """Best effort id of the model behind an embeddings object"""
+        for attr in ("model_name", "model", "deployment"):
+            value = getattr(embeddings, attr, None)
+            if isinstance(value, str) and value: return f"{type(embeddings).__name__}:{value}"
+        return type(embeddings).__name__
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, kind="document")
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], kind="query")[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """embed_query of many texts, sharing the query cache"""
+        return self._embed(texts, kind="query")
+
+    def stats(self) -> dict:
+        """Hit/miss counters, counted per text"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+            "memory_items": len(self._memory)
+        }
+
+    def _embed(self, texts: List[str], *, kind: str) -> List[List[float]]:
+        keys = [self._key(text, kind=kind) for text in texts]
+        found = self._lookup(keys)
+
+        # embed each missing text once, even if the batch repeats it
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found: missing[key] = text
+        if len(missing) > 0:
+            if kind == "query":
+                vectors = embed_queries(self.embeddings, list(missing.values()))
+            else:
+                vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = {key: array("f", vector).tolist() for key, vector in zip(missing.keys(), vectors)}
+            self._store(new_vectors)
+            found.update(new_vectors)
+
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        return [found[key] for key in keys]
+
+    def _key(self, text: str, *, kind: str) -> str:
+        key = json.dumps([self.model_id, kind, text], ensure_ascii=False)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+            disk_keys = list({key for key in keys if key not in found})
+            if self._conn is None or len(disk_keys) == 0: return found
+
+            # stay below sqlite's limit of host parameters
+            for start in range(0, len(disk_keys), 500):
+                batch = disk_keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f", blob).tolist()
+                    found[key] = vector
+                    self._remember(key, vector)
+        return found
+
+    def _store(self, vectors: Dict[str, List[float]]):
+        with self._lock:
+            for key, vector in vectors.items(): self._remember(key, vector)
+            if self._conn is None: return
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, array("f", vector).tobytes()) for key, vector in vectors.items()]
+                )
+
+    def _remember(self, key: str, vector: List[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items: self._memory.popitem(last=False)
+
+
+# model loaded once in each worker process of ParallelSentenceTransformerEmbeddings
+_worker_embeddings: Optional[Embeddings] = None
+_worker_ready_barrier = None  # shared by the workers of a pool, set by _init_worker
+
+
+def _init_worker(model_kwargs: dict, num_threads: Optional[int], ready):
+    global _worker_embeddings, _worker_ready_barrier
+    _worker_ready_barrier = ready
+    if num_threads is not None:
+        try:
+            import torch
+            torch.set_num_threads(num_threads)
+        except ImportError:
+            pass
+    _worker_embeddings = SentenceTransformerEmbeddings(**model_kwargs)
+
+
+def _embed_in_worker(texts: List[str]) -> List[List[float]]:
+    return _worker_embeddings.embed_documents(texts)
+
+
+def _worker_ready(timeout: Optional[float]) -> int:
+    # a worker waiting here cannot take another warm up task, so every worker answers once
+    _worker_ready_barrier.wait(timeout)
+    return os.getpid()
+
+
+class ParallelSentenceTransformerEmbeddings(Embeddings):
+    """Local sentence-transformer embeddings sharded over a pool of processes
+
+    Each worker process loads its own copy of the model when it starts, embed_documents
+    cuts the texts into shards of shard_size and returns the vectors in the order of the texts.
+    Batches shorter than min_parallel_size and queries are embedded in this process,
+    where sending them to a worker would cost more than it saves.
+    """
+
+    def __init__(self, *, model_name: str = "all-MiniLM-L6-v2",
+                 model_kwargs: Optional[dict] = None,
+                 encode_kwargs: Optional[dict] = None,
+                 num_workers: Optional[int] = None,
+                 threads_per_worker: Optional[int] = 1,
+                 shard_size: int = 64,
+                 min_parallel_size: int = 128,
+                 warm_up: bool = True,
+                 warm_up_timeout: Optional[float] = 600):
+        self.model_name = model_name
+        self.shard_size = shard_size
+        self.min_parallel_size = min_parallel_size
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self._model_kwargs = {"model_name": model_name,
+                              "model_kwargs": model_kwargs or {},
+                              "encode_kwargs": encode_kwargs or {}}
+        self._local: Optional[Embeddings] = None
+        self._local_lock = threading.Lock()
+        # spawn: forking a process that already holds a model (and torch threads) is unsafe
+        context = multiprocessing.get_context("spawn")
+        self._ready = context.Barrier(self.num_workers)
+        self._executor = ProcessPoolExecutor(max_workers=self.num_workers,
+                                             mp_context=context,
+                                             initializer=_init_worker,
+                                             initargs=(self._model_kwargs, threads_per_worker, self._ready))
+        if warm_up: self.warm_up(timeout=warm_up_timeout)
+
+    def warm_up(self, *, timeout: Optional[float] = 600) -> List[int]:
+        """Start every worker and wait until their models are loaded, return the worker pids
+
+        A loaded worker waits at most timeout seconds for the others, so a worker that cannot
+        load the model raises RuntimeError here instead of blocking the others forever.
+        """
+        futures = [self._executor.submit(_worker_ready, timeout) for _ in range(self.num_workers)]
+        try:
+            return [future.result() for future in futures]
+        except threading.BrokenBarrierError as e:
+            # every waiting task fails on the broken barrier, then it can be used again
+            wait(futures)
+            self._ready.reset()
+            raise RuntimeError(f"Not all of the {self.num_workers} embedding workers "
+                               f"started within {timeout} seconds") from e
+        except BrokenProcessPool as e:
+            raise RuntimeError("An embedding worker failed to start, see the error of the worker") from e
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if len(texts) < self.min_parallel_size: return self._local_embeddings().embed_documents(texts)
+        shards = [texts[start:start + self.shard_size] for start in range(0, len(texts), self.shard_size)]
+        vectors: List[List[float]] = []
+        # map yields the shards in submission order
+        for shard_vectors in self._executor.map(_embed_in_worker, shards):
+            vectors += shard_vectors
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._local_embeddings().embed_query(text)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _local_embeddings(self) -> Embeddings:
+        """In-process model, only loaded when a small batch or a query needs it"""
+        if self._local is None:
+            with self._local_lock:
+                if self._local is None: self._local = SentenceTransformerEmbeddings(**self._model_kwargs)
+        return self._local
@@ -0,0 +1,195 @@
+import codecs
+import mmap
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from .schema import IngestStats, StageStats
+from .utils import remove_none_from_dict
+
+# writer(ids=..., embeddings=..., metadatas=..., documents=...)
+Writer = Callable[..., None]
+
+
+def read_text_blocks(filepath: str | Path, *, block_size: int = 1 << 20, encoding: str = "utf-8") -> Iterator[str]:
+    """Read a text file block by block, memory mapped when possible
+
+    Multi-byte characters cut by a block boundary are decoded with the next block.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    with open(filepath, mode="rb") as f:
+        if os.fstat(f.fileno()).st_size == 0: return
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            data = None  # e.g. pipes or special files, read them normally
+        if data is None:
+            while block := f.read(block_size):
+                text = decoder.decode(block)
+                if text: yield text
+        else:
+            with data:
+                for start in range(0, len(data), block_size):
+                    text = decoder.decode(data[start:start + block_size])
+                    if text: yield text
+    tail = decoder.decode(b"", final=True)
+    if tail: yield tail
+
+
+def stream_documents(blocks: Iterable[str], *, metadata: dict, separator: str = "\n\n",
+                     max_size: int = 1 << 20) -> Iterator[Document]:
+    """Regroup text blocks into documents that end on separator
+
+    A document is cut at the last separator of the buffered text once it holds max_size
+    characters, so the splitter sees whole paragraphs and memory stays around max_size.
+    Text without any separator is cut at max_size.
+    """
+    buffer = ""
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= max_size:
+            cut = buffer.rfind(separator, 0, max_size)
+            cut = cut + len(separator) if cut > 0 else max_size
+            yield Document(page_content=buffer[:cut], metadata=dict(metadata))
+            buffer = buffer[cut:]
+    if buffer: yield Document(page_content=buffer, metadata=dict(metadata))
+
+
+class IngestPipeline:
+    """Split, embed and write chunks on overlapping stages
+
+    The thread calling run splits (consumes the chunk iterator) and puts batches of batch_size
+    on a bounded queue, an embedding thread embeds them and puts the vectors on a second bounded
+    queue, and a writer thread writes the precomputed vectors write_batch_size at a time.
+    The embedding model and the storage work at the same time instead of taking turns, and
+    the queues bound how far a fast stage can run ahead (and how much memory it holds).
+    """
+
+    def __init__(self, *, embedding_function: Optional[Embeddings], writer: Writer,
+                 batch_size: int = 256,
+                 write_batch_size: int = 1024,
+                 queue_size: int = 4):
+        self.embedding_function = embedding_function
+        self.writer = writer
+        self.batch_size = batch_size
+        self.write_batch_size = write_batch_size
+        self.queue_size = queue_size
+
+    def run(self, chunks: Iterable[Tuple[str, Document]]) -> IngestStats:
+        """Embed and write (id, chunk) pairs, return the statistics of every stage"""
+        stats = IngestStats()
+        started = time.perf_counter()
+        embed_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        write_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        failures: List[BaseException] = []
+        stages = [
+            threading.Thread(target=self._run_stage, name="werag-ingest-embed", daemon=True,
+                             args=(self._embed_stage, embed_queue, write_queue, stats.embed, stop, failures)),
+            threading.Thread(target=self._run_stage, name="werag-ingest-write", daemon=True,
+                             args=(self._write_stage, write_queue, None, stats.write, stop, failures)),
+        ]
+        for stage in stages: stage.start()
+        try:
+            self._split_stage(iter(chunks), embed_queue, stats.split, stop)
+        except BaseException as e:
+            failures.append(e)
+            stop.set()
+        finally:
+            self._put(embed_queue, None, stop)  # end of stream
+            for stage in stages: stage.join()
+        stats.seconds = time.perf_counter() - started
+        if len(failures) > 0: raise failures[0]
+        return stats
+
+    def _split_stage(self, chunks: Iterator[Tuple[str, Document]], output: queue.Queue,
+                     stats: StageStats, stop: threading.Event):
+        batch = []
+        while not stop.is_set():
+            started = time.perf_counter()
+            item = next(chunks, None)
+            stats.seconds += time.perf_counter() - started
+            if item is None: break
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                if not self._put(output, batch, stop): return
+                stats.items += len(batch)
+                stats.batches += 1
+                batch = []
+        if len(batch) > 0 and self._put(output, batch, stop):
+            stats.items += len(batch)
+            stats.batches += 1
+
+    def _embed_stage(self, batch: List[Tuple[str, Document]], output: queue.Queue,
+                     stats: StageStats, stop: threading.Event):
+        texts = [chunk.page_content for _, chunk in batch]
+        started = time.perf_counter()
+        embeddings = self.embedding_function.embed_documents(texts) if self.embedding_function is not None else None
+        stats.seconds += time.perf_counter() - started
+        stats.items += len(batch)
+        stats.batches += 1
+        self._put(output, (batch, embeddings), stop)
+
+    def _write_stage(self, item: Tuple[List[Tuple[str, Document]], Optional[List[List[float]]]],
+                     stats: StageStats, buffer: list):
+        """Collect embedded batches, write when write_batch_size is reached (item None flushes)"""
+        if item is not None: buffer.append(item)
+        size = sum(len(batch) for batch, _ in buffer)
+        if size == 0 or (item is not None and size < self.write_batch_size): return
+
+        ids, embeddings, metadatas, documents = [], [], [], []
+        for batch, batch_embeddings in buffer:
+            ids += [_id for _id, _ in batch]
+            metadatas += [remove_none_from_dict(dict(chunk.metadata)) for _, chunk in batch]
+            documents += [chunk.page_content for _, chunk in batch]
+            if batch_embeddings is not None: embeddings += batch_embeddings
+        buffer.clear()
+        started = time.perf_counter()
+        self.writer(ids=ids, embeddings=embeddings if self.embedding_function is not None else None,
+                    metadatas=metadatas, documents=documents)
+        stats.seconds += time.perf_counter() - started
+        stats.items += len(ids)
+        stats.batches += 1
+
+    def _run_stage(self, work: Callable, source: queue.Queue, output: Optional[queue.Queue],
+                   stats: StageStats, stop: threading.Event, failures: List[BaseException]):
+        """Feed the items of source to work until the end of stream, pass the end on"""
+        buffer: list = []
+        try:
+            while True:
+                item = self._get(source, stop)
+                if output is None:
+                    work(item, stats, buffer)
+                elif item is not None:
+                    work(item, output, stats, stop)
+                if item is None or stop.is_set(): break
+        except BaseException as e:
+            failures.append(e)
+            stop.set()
+        finally:
+            if output is not None: self._put(output, None, stop)
+
+    @staticmethod
+    def _put(output: queue.Queue, item, stop: threading.Event) -> bool:
+        """Put item, giving up if the pipeline is stopped (the consumer may be gone)"""
+        while True:
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if stop.is_set(): return False
+
+    @staticmethod
+    def _get(source: queue.Queue, stop: threading.Event):
+        """Get the next item, None once the pipeline is stopped"""
+        while True:
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set(): return None
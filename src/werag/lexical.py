@@ -0,0 +1,194 @@
+import math
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from langchain_chroma import Chroma
+
+from .db import get_collection_name
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-_.:/+][a-z0-9]+)*|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+_SEPARATOR_RE = re.compile(r"[-_.:/+]")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into terms for BM25, without a dictionary
+
+    Latin words, numbers and codes (a product code like "x-200" or a phone number like
+    "138-0013-8000", also indexed without separators) are whole terms, runs of Chinese
+    characters give their characters and their bigrams, which matches Chinese words of
+    any length reasonably without word segmentation.
+    """
+    terms = []
+    for token in _TOKEN_RE.findall(unicodedata.normalize("NFKC", text).lower()):
+        if token[0].isascii():
+            terms.append(token)
+            joined = _SEPARATOR_RE.sub("", token)
+            if joined != token: terms.append(joined)
+        else:
+            terms += token
+            terms += [token[index:index + 2] for index in range(len(token) - 1)]
+    return terms
+
+
+class LexicalIndex:
+    """BM25 inverted index of the chunks stored in chroma, in a SQLite file
+
+    Postings are added and removed with the chunks (see CRUDChroma), so the index is
+    updated incrementally and survives restarts. Statistics (document count, average
+    length, document frequency) are computed within the searched user (and content type),
+    so every tenant is scored as if it had its own index. A collection is built from chroma
+    the first time it is used.
+    """
+
+    def __init__(self, path: str = ":memory:", *, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS lexical_chunks (
+                    collection TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    user TEXT NOT NULL,
+                    content_type TEXT,
+                    length INTEGER NOT NULL,
+                    PRIMARY KEY (collection, id)
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS lexical_chunks_user ON lexical_chunks (collection, user, content_type)"
+            )
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS lexical_postings (
+                    collection TEXT NOT NULL,
+                    term TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    tf INTEGER NOT NULL,
+                    PRIMARY KEY (collection, term, id)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lexical_postings_id ON lexical_postings (collection, id)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS lexical_collections (
+                    collection TEXT PRIMARY KEY,
+                    built_at REAL NOT NULL
+                )
+            """)
+
+    def search(self, client: Chroma, *, query: str, user: str, content_type: Optional[str] = None,
+               limit: int = 4) -> List[Tuple[str, float]]:
+        """Ids and BM25 scores of the best chunks of user (and content type) for query"""
+        collection = self._ensure_built(client)
+        terms = list(set(tokenize(query)))
+        if len(terms) == 0: return []
+
+        scope = "c.user = ?"
+        params: List = [user]
+        if content_type is not None:
+            scope += " AND c.content_type = ?"
+            params.append(content_type)
+        with self._lock:
+            count, average_length = self._conn.execute(
+                f"SELECT COUNT(*), AVG(c.length) FROM lexical_chunks c WHERE c.collection = ? AND {scope}",
+                [collection, *params]
+            ).fetchone()
+            if count == 0: return []
+            rows = []
+            # stay below sqlite's limit of host parameters
+            for start in range(0, len(terms), 500):
+                batch = terms[start:start + 500]
+                rows += self._conn.execute(
+                    f"SELECT p.id, p.term, p.tf, c.length FROM lexical_postings p "
+                    f"JOIN lexical_chunks c ON c.collection = p.collection AND c.id = p.id "
+                    f"WHERE p.collection = ? AND p.term IN ({','.join('?' * len(batch))}) AND {scope}",
+                    [collection, *batch, *params]
+                ).fetchall()
+
+        document_frequency = Counter(term for _, term, _, _ in rows)
+        scores: Dict[str, float] = {}
+        for _id, term, tf, length in rows:
+            df = document_frequency[term]
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * length / (average_length or 1))
+            scores[_id] = scores.get(_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def add_chunks(self, client: Chroma, *, ids: List[str], metadatas: List[dict], documents: List[str]):
+        """Index chunks just written to client, in one transaction"""
+        collection = self._ensure_built(client)
+        self._insert(collection, ids=ids, metadatas=metadatas, documents=documents)
+
+    def remove_chunks(self, client: Chroma, *, ids: List[str]):
+        """Unindex chunks just deleted from client, in one transaction"""
+        collection = self._ensure_built(client)
+        with self._lock, self._conn:
+            self._delete(collection, ids)
+
+    def rebuild(self, client: Chroma, *, batch_size: int = 1000) -> int:
+        """Index again every chunk of client, return the number of chunks"""
+        collection = get_collection_name(client)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM lexical_postings WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM lexical_chunks WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM lexical_collections WHERE collection = ?", (collection,))
+        count, offset = 0, 0
+        while True:
+            response = client.get(limit=batch_size, offset=offset, include=["metadatas", "documents"])
+            if len(response['ids']) == 0: break
+            offset += len(response['ids'])
+            self._insert(collection, ids=response['ids'], metadatas=response['metadatas'],
+                         documents=response['documents'])
+            count += len(response['ids'])
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO lexical_collections VALUES (?, ?)", (collection, time.time()))
+        return count
+
+    def clear(self):
+        """Forget every collection, they are indexed again when used"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM lexical_postings")
+            self._conn.execute("DELETE FROM lexical_chunks")
+            self._conn.execute("DELETE FROM lexical_collections")
+
+    def _ensure_built(self, client: Chroma) -> str:
+        collection = get_collection_name(client)
+        with self._lock:
+            built = self._conn.execute(
+                "SELECT 1 FROM lexical_collections WHERE collection = ?", (collection,)
+            ).fetchone() is not None
+        if not built: self.rebuild(client)
+        return collection
+
+    def _insert(self, collection: str, *, ids: List[str], metadatas: List[dict], documents: List[str]):
+        chunks, postings = [], []
+        for _id, metadata, document in zip(ids, metadatas, documents):
+            terms = Counter(tokenize(document))
+            chunks.append((collection, _id, metadata['user'], metadata.get('content_type'), sum(terms.values())))
+            postings += [(collection, term, _id, tf) for term, tf in terms.items()]
+        with self._lock, self._conn:
+            # an upserted chunk replaces its previous postings
+            self._delete(collection, ids)
+            self._conn.executemany("INSERT INTO lexical_chunks VALUES (?, ?, ?, ?, ?)", chunks)
+            self._conn.executemany("INSERT INTO lexical_postings VALUES (?, ?, ?, ?)", postings)
+
+    def _delete(self, collection: str, ids: Sequence[str]):
+        """Delete the rows of ids, the caller holds the lock and the transaction"""
+        self._conn.executemany("DELETE FROM lexical_postings WHERE collection = ? AND id = ?",
+                               [(collection, _id) for _id in ids])
+        self._conn.executemany("DELETE FROM lexical_chunks WHERE collection = ? AND id = ?",
+                               [(collection, _id) for _id in ids])
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], *, k: int = 60) -> List[str]:
+    """Merge rankings of ids, each id scores 1 / (k + rank) in every ranking it appears in"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, _id in enumerate(ranking):
+            scores[_id] = scores.get(_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda _id: -scores[_id])
@@ -0,0 +1,160 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from langchain_chroma import Chroma
+
+from .db import get_collection_name
+from .utils import count_tokens_many
+
+Scope = Tuple[str, Optional[str]]  # (user, content_type)
+
+
+class ChunkManifest:
+    """Local index of the chunks stored in chroma, in a SQLite file
+
+    For every chunk it records the collection, user, content type, a hash of the text,
+    the token count and when it was written, so finding the chunks of a user does not need
+    a metadata scan of chroma. It is only correct if every write goes through it: a collection
+    is built from chroma the first time it is used, and check() rebuilds it if it drifted.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS manifest_chunks (
+                    collection TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    user TEXT NOT NULL,
+                    content_type TEXT,
+                    content_hash TEXT NOT NULL,
+                    token_count INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (collection, id)
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS manifest_chunks_user ON manifest_chunks (collection, user, content_type)"
+            )
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS manifest_collections (
+                    collection TEXT PRIMARY KEY,
+                    built_at REAL NOT NULL
+                )
+            """)
+
+    def get_ids(self, client: Chroma, *, user: str, content_type: Optional[str] = None) -> Set[str]:
+        """Ids under the filter of user (and content type), like get_user_content_filter"""
+        scopes = self.get_ids_by_scope(client, users=[user])
+        if content_type is None: return set().union(*scopes.values())
+        return scopes.get((user, content_type), set())
+
+    def get_ids_by_scope(self, client: Chroma, *, users: Iterable[str]) -> Dict[Scope, Set[str]]:
+        """Ids of all the content types of users, grouped by (user, content_type)"""
+        collection = self._ensure_built(client)
+        users = list(set(users))
+        scopes: Dict[Scope, Set[str]] = {}
+        with self._lock:
+            # stay below sqlite's limit of host parameters
+            for start in range(0, len(users), 500):
+                batch = users[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT user, content_type, id FROM manifest_chunks "
+                    f"WHERE collection = ? AND user IN ({','.join('?' * len(batch))})",
+                    [collection, *batch]
+                ).fetchall()
+                for user, content_type, _id in rows: scopes.setdefault((user, content_type), set()).add(_id)
+        return scopes
+
+    def exists(self, client: Chroma, *, user: str, content_type: Optional[str] = None) -> bool:
+        collection = self._ensure_built(client)
+        query = "SELECT 1 FROM manifest_chunks WHERE collection = ? AND user = ?"
+        params = [collection, user]
+        if content_type is not None:
+            query += " AND content_type = ?"
+            params.append(content_type)
+        with self._lock:
+            return self._conn.execute(query + " LIMIT 1", params).fetchone() is not None
+
+    def add_chunks(self, client: Chroma, *, ids: List[str], metadatas: List[dict], documents: List[str]):
+        """Record chunks just written to client, in one transaction"""
+        collection = self._ensure_built(client)
+        self._insert(collection, ids=ids, metadatas=metadatas, documents=documents)
+
+    def remove_chunks(self, client: Chroma, *, ids: List[str]):
+        """Forget chunks just deleted from client, in one transaction"""
+        collection = self._ensure_built(client)
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM manifest_chunks WHERE collection = ? AND id = ?",
+                                   [(collection, _id) for _id in ids])
+
+    def check(self, client: Chroma, *, repair: bool = True) -> dict:
+        """Compare the manifest of client with the ids stored in chroma, rebuild it if they differ"""
+        collection = self._ensure_built(client)
+        stored = set(client.get(include=[])['ids'])
+        with self._lock:
+            recorded = set(_id for _id, in self._conn.execute(
+                "SELECT id FROM manifest_chunks WHERE collection = ?", (collection,)
+            ).fetchall())
+        report = {"missing": len(stored - recorded), "extra": len(recorded - stored), "repaired": False}
+        if repair and (report["missing"] > 0 or report["extra"] > 0):
+            self.rebuild(client)
+            report["repaired"] = True
+        return report
+
+    def rebuild(self, client: Chroma, *, batch_size: int = 1000) -> int:
+        """Replace the manifest of client with what chroma stores, return the number of chunks"""
+        collection = get_collection_name(client)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM manifest_chunks WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM manifest_collections WHERE collection = ?", (collection,))
+        count, offset = 0, 0
+        while True:
+            response = client.get(limit=batch_size, offset=offset, include=["metadatas", "documents"])
+            if len(response['ids']) == 0: break
+            offset += len(response['ids'])
+            self._insert(collection, ids=response['ids'], metadatas=response['metadatas'],
+                         documents=response['documents'])
+            count += len(response['ids'])
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO manifest_collections VALUES (?, ?)", (collection, time.time()))
+        return count
+
+    def get_collections(self) -> List[str]:
+        """Names of the collections built in the manifest"""
+        with self._lock:
+            return [collection for collection, in self._conn.execute(
+                "SELECT collection FROM manifest_collections"
+            ).fetchall()]
+
+    def clear(self):
+        """Forget every collection, they are rebuilt from chroma when used again"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM manifest_chunks")
+            self._conn.execute("DELETE FROM manifest_collections")
+
+    def _ensure_built(self, client: Chroma) -> str:
+        collection = get_collection_name(client)
+        with self._lock:
+            built = self._conn.execute(
+                "SELECT 1 FROM manifest_collections WHERE collection = ?", (collection,)
+            ).fetchone() is not None
+        if not built: self.rebuild(client)
+        return collection
+
+    def _insert(self, collection: str, *, ids: List[str], metadatas: List[dict], documents: List[str]):
+        # chunks split by werag carry their token count, only the others are encoded
+        uncounted = [index for index, metadata in enumerate(metadatas) if metadata.get('token_count') is None]
+        token_counts = [metadata.get('token_count') for metadata in metadatas]
+        for index, token_count in zip(uncounted, count_tokens_many(documents[index] for index in uncounted)):
+            token_counts[index] = token_count
+        now = time.time()
+        rows = [(collection, _id, metadata['user'], metadata.get('content_type'),
+                 hashlib.sha256(document.encode("utf-8")).hexdigest(), token_count, now)
+                for _id, metadata, document, token_count in zip(ids, metadatas, documents, token_counts)]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO manifest_chunks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
@@ -0,0 +1,523 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Literal, Optional, Set, Tuple
+
+import numpy as np
+from langchain_chroma.vectorstores import maximal_marginal_relevance
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+_BLOCK_SIZE = 4096  # rows converted to float32 at once when searching quantized vectors
+_MATRIX_SUFFIXES = (".npy", ".scales.npy", ".full.npy")
+
+
+class _Tenant:
+    """Chunks of one user: a contiguous matrix of vectors, with ids, metadata and documents by row
+
+    With dtype int8 a row is stored as round(vector / scale) with one float32 scale per row,
+    with float16 it is simply cast. When keep_full is set the float32 vectors are kept too
+    (memory mapped once saved) to re-score the best candidates of the quantized search exactly.
+    """
+
+    def __init__(self, user: str, *, dtype: str, keep_full: bool = False):
+        self.user = user
+        self.dtype = dtype
+        self.keep_full = keep_full and dtype != "float32"
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.metadatas: List[dict] = []
+        self.documents: List[str] = []
+        self.vectors: Optional[np.ndarray] = None  # capacity x dimension, the first size rows are used
+        self.scales: Optional[np.ndarray] = None  # int8 only, scale of every row
+        self.full: Optional[np.ndarray] = None  # float32 rows for the exact re-score
+        self.version: Optional[str] = None  # version of the saved matrices, named in the .json file
+        self._norms: Optional[np.ndarray] = None  # squared norm of every stored row, computed on first use
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    @property
+    def dimension(self) -> int:
+        return self.vectors.shape[1]
+
+    def upsert(self, _id: str, vector: List[float], metadata: dict, document: str):
+        vector = np.asarray(vector, dtype=np.float32)
+        row = self.rows.get(_id)
+        if row is None:
+            row = self.size
+            self._reserve(row + 1, dimension=len(vector))
+            self.rows[_id] = row
+            self.ids.append(_id)
+            self.metadatas.append(metadata)
+            self.documents.append(document)
+        else:
+            self._reserve(self.size, dimension=len(vector))
+            self.metadatas[row] = metadata
+            self.documents[row] = document
+        if self.dtype == "int8":
+            scale = float(np.abs(vector).max()) / 127 or 1.0
+            self.vectors[row] = np.round(vector / scale)
+            self.scales[row] = scale
+        else:
+            self.vectors[row] = vector
+        if self.keep_full: self.full[row] = vector
+        stored = self.get_vector(row, exact=False)
+        self._norms[row] = float(stored @ stored)
+
+    def delete(self, _id: str):
+        """Remove a row by moving the last row into its place"""
+        row = self.rows.pop(_id)
+        last = self.size - 1
+        self._reserve(self.size, dimension=self.dimension)
+        if row != last:
+            for array in (self.vectors, self.scales, self.full, self._norms):
+                if array is not None: array[row] = array[last]
+            self.ids[row] = self.ids[last]
+            self.metadatas[row] = self.metadatas[last]
+            self.documents[row] = self.documents[last]
+            self.rows[self.ids[row]] = row
+        self.ids.pop()
+        self.metadatas.pop()
+        self.documents.pop()
+
+    def get_vector(self, row: int, *, exact: bool = True) -> np.ndarray:
+        """float32 vector of a row, the stored one unless exact and the full vectors are kept"""
+        if exact and self.full is not None: return np.asarray(self.full[row], dtype=np.float32)
+        vector = self.vectors[row].astype(np.float32)
+        return vector * self.scales[row] if self.scales is not None else vector
+
+    def search(self, vector: np.ndarray, *, k: int, mask: Optional[np.ndarray] = None,
+               rescore_factor: int = 1) -> List[Tuple[float, int]]:
+        """(squared l2 distance, row) of the k nearest rows, one matrix-vector product
+
+        The distances are computed on the stored vectors, with quantized vectors and full
+        vectors kept the best k * rescore_factor rows are then re-scored on the float32 vectors.
+        """
+        if self.size == 0 or self.dimension != len(vector): return []
+        distances = self.norms[:self.size] - 2 * self._dot(vector) + float(vector @ vector)
+        if mask is not None: distances = np.where(mask, distances, np.inf)
+        rescore = self.full is not None and rescore_factor > 1
+        top = self._top(distances, k * rescore_factor if rescore else k)
+        if rescore:
+            # exact distances of the candidates, only their rows of the full matrix are read
+            differences = np.asarray(self.full[np.sort(top)], dtype=np.float32) - vector
+            distances = np.full(self.size, np.inf, dtype=np.float32)
+            distances[np.sort(top)] = np.einsum("ij,ij->i", differences, differences)
+            top = self._top(distances, k)
+        return [(float(distances[row]), int(row)) for row in top]
+
+    @property
+    def norms(self) -> np.ndarray:
+        if self._norms is None:
+            self._norms = np.zeros(self.size, dtype=np.float32)
+            for start in range(0, self.size, _BLOCK_SIZE):
+                block = self.vectors[start:min(start + _BLOCK_SIZE, self.size)].astype(np.float32)
+                self._norms[start:start + len(block)] = np.einsum("ij,ij->i", block, block)
+            if self.scales is not None: self._norms *= np.square(self.scales[:self.size])
+        return self._norms
+
+    def _dot(self, vector: np.ndarray) -> np.ndarray:
+        """Stored vectors times vector, quantized rows are converted by blocks to bound the memory used"""
+        if self.dtype == "float32": return self.vectors[:self.size] @ vector
+        products = np.empty(self.size, dtype=np.float32)
+        for start in range(0, self.size, _BLOCK_SIZE):
+            block = self.vectors[start:min(start + _BLOCK_SIZE, self.size)]
+            products[start:start + len(block)] = block.astype(np.float32) @ vector
+        if self.scales is not None: products *= self.scales[:self.size]
+        return products
+
+    def _top(self, distances: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, self.size)
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top], kind="stable")]
+        return top[np.isfinite(distances[top])]
+
+    def _reserve(self, size: int, *, dimension: int):
+        """Make the first size rows writable in memory, growing the matrices geometrically"""
+        if self.vectors is not None: self.norms  # computed before the stored rows move
+        self.vectors = self._grow(self.vectors, size, (dimension,), self.dtype)
+        self._norms = self._grow(self._norms, size, (), np.float32)
+        if self.dtype == "int8": self.scales = self._grow(self.scales, size, (), np.float32)
+        if self.keep_full: self.full = self._grow(self.full, size, (dimension,), np.float32)
+
+    def _grow(self, array: Optional[np.ndarray], size: int, shape: tuple, dtype) -> np.ndarray:
+        """array if it has room for size rows and is not a read-only memory map, else a copy with room"""
+        if array is not None and size <= len(array) and array.flags.writeable: return array
+        if array is None:
+            capacity = max(size, 16)
+        else:
+            capacity = len(array) if size <= len(array) else max(size, 2 * len(array))
+        grown = np.zeros((capacity, *shape), dtype=dtype)
+        if array is not None: grown[:self.size] = array[:self.size]
+        return grown
+
+
+class NumpyVectorStore(VectorStore):
+    """Vector store keeping the chunks of every user in memory, searched exactly with NumPy
+
+    Meant for deployments where tenants are small (a few thousand chunks): a search is one
+    matrix-vector product over the rows of the user and an argpartition, with no index
+    to maintain. It answers the subset of the Chroma API used by werag (get, delete, search,
+    upsert and query with precomputed vectors) with the same where filters.
+    Vectors are stored as float32, float16 (half the memory) or int8 (a quarter). Quantized
+    searches re-score their best k * rescore_factor candidates on the float32 vectors, which
+    are then kept memory mapped, only the rows of the candidates are read (rescore_factor=1
+    drops them, without persist_directory they stay in memory). Each user is persisted in
+    persist_directory as .npy matrices and a .json file of ids, metadata and documents,
+    the matrices are memory mapped when the store is opened so a cold start reads nothing
+    until a user is searched. A save writes the matrices under a new version and then
+    replaces the .json file naming it, so a crash leaves the previous version whole.
+    Inside deferred_save the touched users are saved once, when the block ends.
+    """
+
+    def __init__(self, *, collection_name: str = "werag",
+                 persist_directory: Optional[str] = None,
+                 embedding_function: Embeddings,
+                 dtype: Literal["float32", "float16", "int8"] = "float32",
+                 rescore_factor: int = 4):
+        self.collection_name = collection_name
+        self.embedding_function = embedding_function
+        self.dtype = dtype
+        self.rescore_factor = rescore_factor
+        self.directory = None
+        if persist_directory is not None:
+            self.directory = os.path.join(persist_directory, f"{collection_name}_numpy")
+            os.makedirs(self.directory, exist_ok=True)
+        self._tenants: Dict[str, _Tenant] = {}
+        self._users: Dict[str, str] = {}  # id -> user
+        self._deferred: Dict[str, int] = {}  # user -> number of deferred_save blocks running
+        self._unsaved: Set[str] = set()  # users touched inside deferred_save blocks
+        self._lock = threading.RLock()
+        self._collections: Dict[str, "NumpyVectorStore"] = {}  # opened by open_collection
+        self._load()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding_function
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> "NumpyVectorStore":
+        ids = kwargs.pop("ids", None)
+        store = cls(embedding_function=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    def open_collection(self, collection_name: str) -> "NumpyVectorStore":
+        """Another collection next to this one, with the same settings
+
+        A collection is opened once and the same store is returned afterwards: the chunks live
+        in the memory of the store, a second one opened on the same files would diverge from it.
+        """
+        if collection_name == self.collection_name: return self
+        with self._lock:
+            store = self._collections.get(collection_name)
+            if store is None:
+                store = NumpyVectorStore(collection_name=collection_name,
+                                         persist_directory=os.path.dirname(self.directory) if self.directory else None,
+                                         embedding_function=self.embedding_function, dtype=self.dtype,
+                                         rescore_factor=self.rescore_factor)
+                self._collections[collection_name] = store
+            return store
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        self.upsert(ids=ids, embeddings=self.embedding_function.embed_documents(texts),
+                    metadatas=metadatas or [{} for _ in texts], documents=texts)
+        return ids
+
+    def upsert(self, *, ids: List[str], embeddings: List[List[float]], metadatas: List[dict], documents: List[str]):
+        with self._lock:
+            touched: Set[str] = set()
+            for _id, vector, metadata, document in zip(ids, embeddings, metadatas, documents):
+                user = metadata.get("user", "")
+                previous = self._users.get(_id)
+                if previous is not None and previous != user:
+                    self._tenants[previous].delete(_id)
+                    touched.add(previous)
+                self._tenant(user).upsert(_id, vector, dict(metadata), document)
+                self._users[_id] = user
+                touched.add(user)
+            self._save(touched)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> None:
+        with self._lock:
+            touched: Set[str] = set()
+            for _id in ids or []:
+                user = self._users.pop(_id, None)
+                if user is None: continue
+                self._tenants[user].delete(_id)
+                touched.add(user)
+            self._save(touched)
+
+    @contextmanager
+    def deferred_save(self, *, users: Iterable[str]):
+        """Save the tenants of users once when the block ends, instead of after every upsert or delete"""
+        users = set(users)
+        with self._lock:
+            for user in users: self._deferred[user] = self._deferred.get(user, 0) + 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                done = set()
+                for user in users:
+                    self._deferred[user] -= 1
+                    if self._deferred[user] == 0:
+                        del self._deferred[user]
+                        done.add(user)
+                touched = done & self._unsaved
+                self._unsaved -= touched
+                self._save(touched)
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[dict] = None,
+            limit: Optional[int] = None, offset: Optional[int] = None,
+            include: Optional[List[str]] = None, **kwargs: Any) -> dict:
+        """Same arguments and response as Chroma.get"""
+        include = ["metadatas", "documents"] if include is None else include
+        with self._lock:
+            rows = list(self._iter_rows(ids=ids, where=where))
+            rows = rows[offset or 0:]
+            if limit is not None: rows = rows[:limit]
+            response = {
+                "ids": [tenant.ids[row] for tenant, row in rows],
+                "metadatas": [dict(tenant.metadatas[row]) for tenant, row in rows] if "metadatas" in include else None,
+                "documents": [tenant.documents[row] for tenant, row in rows] if "documents" in include else None,
+                "embeddings": None
+            }
+            if "embeddings" in include:
+                response["embeddings"] = [tenant.get_vector(row).tolist() for tenant, row in rows]
+            return response
+
+    def query(self, *, embeddings: List[List[float]], k: int = 4,
+              where: Optional[dict] = None) -> List[List[Tuple[str, Document]]]:
+        """Exact k nearest chunks of each vector, as (id, document) pairs"""
+        with self._lock:
+            return [[(tenant.ids[row], self._get_document(tenant, row)) for _, tenant, row in candidates]
+                    for candidates in self._search(embeddings, k=k, where=where)]
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None,
+                          **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[dict] = None,
+                                    **kwargs: Any) -> List[Document]:
+        return [document for _, document in self.query(embeddings=[embedding], k=k, where=filter)[0]]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None,
+                                     **kwargs: Any) -> List[Tuple[Document, float]]:
+        """Nearest chunks with their squared l2 distance, the distance Chroma returns"""
+        with self._lock:
+            candidates = self._search([self.embedding_function.embed_query(query)], k=k, where=filter)[0]
+            return [(self._get_document(tenant, row), distance) for distance, tenant, row in candidates]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5,
+                                      filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(self.embedding_function.embed_query(query), k=k,
+                                                            fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter)
+
+    def max_marginal_relevance_search_by_vector(self, embedding: List[float], k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, filter: Optional[dict] = None,
+                                                **kwargs: Any) -> List[Document]:
+        """k chunks picked by maximal marginal relevance among the fetch_k nearest, as Chroma does"""
+        with self._lock:
+            candidates = self._search([embedding], k=fetch_k, where=filter)[0]
+            vectors = [tenant.get_vector(row) for _, tenant, row in candidates]
+            documents = [self._get_document(tenant, row) for _, tenant, row in candidates]
+        selected = maximal_marginal_relevance(np.asarray(embedding, dtype=np.float32), vectors,
+                                              k=k, lambda_mult=lambda_mult)
+        return [documents[index] for index in selected]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # the function Chroma uses for its default l2 space, so score thresholds mean the same on both stores
+        return self._euclidean_relevance_score_fn
+
+    def _search(self, embeddings: List[List[float]], *, k: int,
+                where: Optional[dict]) -> List[List[Tuple[float, _Tenant, int]]]:
+        """(squared l2 distance, tenant, row) of the k nearest rows of each vector, called holding the lock"""
+        results = []
+        tenants = self._get_tenants(where)
+        masks = {tenant.user: self._mask(tenant, where) for tenant in tenants}
+        for embedding in embeddings:
+            vector = np.asarray(embedding, dtype=np.float32)
+            candidates = [(distance, tenant, row) for tenant in tenants
+                          for distance, row in tenant.search(vector, k=k, mask=masks[tenant.user],
+                                                             rescore_factor=self.rescore_factor)]
+            candidates.sort(key=lambda candidate: candidate[0])
+            results.append(candidates[:k])
+        return results
+
+    @staticmethod
+    def _get_document(tenant: _Tenant, row: int) -> Document:
+        return Document(page_content=tenant.documents[row], metadata=dict(tenant.metadatas[row]))
+
+    def _tenant(self, user: str) -> _Tenant:
+        tenant = self._tenants.get(user)
+        if tenant is None:
+            tenant = self._new_tenant(user)
+            self._tenants[user] = tenant
+        return tenant
+
+    def _get_tenants(self, where: Optional[dict]) -> List[_Tenant]:
+        """Tenants the filter can match, every tenant unless it constrains the user"""
+        users = self._filter_users(where)
+        if users is None: return [self._tenants[user] for user in sorted(self._tenants)]
+        return [self._tenants[user] for user in sorted(users) if user in self._tenants]
+
+    def _iter_rows(self, *, ids: Optional[List[str]], where: Optional[dict]) -> Iterator[Tuple[_Tenant, int]]:
+        if ids is not None:
+            for _id in ids:
+                user = self._users.get(_id)
+                if user is None: continue
+                tenant = self._tenants[user]
+                row = tenant.rows[_id]
+                if not where or _match(tenant.metadatas[row], where): yield tenant, row
+            return
+        for tenant in self._get_tenants(where):
+            for row in range(tenant.size):
+                if not where or _match(tenant.metadatas[row], where): yield tenant, row
+
+    @classmethod
+    def _filter_users(cls, where: Optional[dict]) -> Optional[Set[str]]:
+        if not where: return None
+        users = None
+        for key, condition in where.items():
+            found = None
+            if key == "$and":
+                for clause in condition:
+                    clause_users = cls._filter_users(clause)
+                    if clause_users is not None: found = clause_users if found is None else found & clause_users
+            elif key == "user":
+                if not isinstance(condition, dict):
+                    found = {condition}
+                elif "$eq" in condition:
+                    found = {condition["$eq"]}
+                elif "$in" in condition:
+                    found = set(condition["$in"])
+            if found is not None: users = found if users is None else users & found
+        return users
+
+    @staticmethod
+    def _mask(tenant: _Tenant, where: Optional[dict]) -> Optional[np.ndarray]:
+        """Rows of tenant matching where, None when it only constrains the user"""
+        if not where or where == {"user": tenant.user}: return None
+        return np.array([_match(metadata, where) for metadata in tenant.metadatas], dtype=bool)
+
+    def _load(self):
+        if self.directory is None: return
+        referenced: Set[str] = set()
+        names = sorted(os.listdir(self.directory))
+        for name in names:
+            if not name.endswith(".json"): continue
+            path = os.path.join(self.directory, name)
+            with open(path, mode="r", encoding="utf-8") as f:
+                data = json.load(f)
+            prefix = self._version_prefix(path[:-len(".json")], data.get("version"))
+            tenant = _Tenant(data["user"], dtype=data.get("dtype", "float32"),
+                             keep_full=os.path.exists(prefix + ".full.npy"))
+            tenant.ids, tenant.metadatas, tenant.documents = data["ids"], data["metadatas"], data["documents"]
+            tenant.rows = {_id: row for row, _id in enumerate(tenant.ids)}
+            tenant.version = data.get("version")
+            if tenant.size > 0:
+                # read-only memory maps, copied to memory on the first write
+                tenant.vectors = np.load(prefix + ".npy", mmap_mode="r")
+                if tenant.dtype == "int8": tenant.scales = np.load(prefix + ".scales.npy", mmap_mode="r")
+                if tenant.keep_full: tenant.full = np.load(prefix + ".full.npy", mmap_mode="r")
+                for matrix in (tenant.vectors, tenant.scales, tenant.full):
+                    if matrix is not None and len(matrix) != tenant.size:
+                        raise ValueError(f"{prefix}: {len(matrix)} stored vectors for {tenant.size} ids")
+            referenced.update(os.path.basename(prefix) + suffix for suffix in _MATRIX_SUFFIXES)
+            if (tenant.dtype, tenant.keep_full) != (self.dtype, self._new_tenant(tenant.user).keep_full):
+                # stored with other settings, converted once
+                converted = self._new_tenant(tenant.user)
+                for row, _id in enumerate(tenant.ids):
+                    converted.upsert(_id, tenant.get_vector(row), tenant.metadatas[row], tenant.documents[row])
+                converted.version = tenant.version
+                tenant = converted
+                self._save_tenant(tenant)
+            self._tenants[tenant.user] = tenant
+            for _id in tenant.ids: self._users[_id] = tenant.user
+        # files written by a save that crashed before replacing its .json file
+        for name in names:
+            if name.endswith((".npy", ".tmp")) and name not in referenced:
+                os.remove(os.path.join(self.directory, name))
+
+    def _save(self, users: Set[str]):
+        """Write the files of the touched tenants, the users inside deferred_save are saved when it ends"""
+        if self.directory is None: return
+        for user in users:
+            if user in self._deferred:
+                self._unsaved.add(user)
+            else:
+                self._save_tenant(self._tenants[user])
+
+    def _save_tenant(self, tenant: _Tenant):
+        """Write the matrices under a new version, then switch to it by replacing the .json file"""
+        path = os.path.join(self.directory, hashlib.sha256(tenant.user.encode("utf-8")).hexdigest()[:32])
+        version = uuid.uuid4().hex[:16]
+        prefix = self._version_prefix(path, version)
+        if tenant.size > 0:
+            matrices = {".npy": tenant.vectors, ".scales.npy": tenant.scales, ".full.npy": tenant.full}
+            for suffix, matrix in matrices.items():
+                if matrix is None: continue
+                with open(prefix + suffix, mode="wb") as f:
+                    np.save(f, np.ascontiguousarray(matrix[:tenant.size]))
+            # the float32 vectors are only read to re-score, they go back to disk
+            if tenant.full is not None: tenant.full = np.load(prefix + ".full.npy", mmap_mode="r")
+        with open(path + ".json.tmp", mode="w", encoding="utf-8") as f:
+            json.dump({"user": tenant.user, "dtype": tenant.dtype, "version": version, "ids": tenant.ids,
+                       "metadatas": tenant.metadatas, "documents": tenant.documents}, f, ensure_ascii=False)
+        os.replace(path + ".json.tmp", path + ".json")
+
+        # nothing names the previous version any more
+        previous = self._version_prefix(path, tenant.version)
+        tenant.version = version
+        for suffix in _MATRIX_SUFFIXES:
+            try:
+                os.remove(previous + suffix)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _version_prefix(path: str, version: Optional[str]) -> str:
+        """Path of the matrices of a version, without suffix (stores saved before versions used path)"""
+        return f"{path}.{version}" if version is not None else path
+
+    def _new_tenant(self, user: str) -> _Tenant:
+        return _Tenant(user, dtype=self.dtype, keep_full=self.rescore_factor > 1)
+
+
+def _match(metadata: dict, where: dict) -> bool:
+    """Evaluate a chroma where filter on one metadata dict"""
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(_match(metadata, clause) for clause in condition): return False
+        elif key == "$or":
+            if not any(_match(metadata, clause) for clause in condition): return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if not _OPERATORS[operator](value, operand): return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+_OPERATORS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+}
@@ -4,12 +4,52 @@ from langchain_core.documents import Document
 from pydantic import BaseModel
 from typing import List, Optional
 
+
+class StageStats(BaseModel):
+    """Work done by one stage of the ingest pipeline"""
+    items: int = 0
+    batches: int = 0
+    seconds: float = 0.0  # time spent working, not waiting on the other stages
+
+    @property
+    def throughput(self) -> float:
+        """Items per second of work"""
+        return self.items / self.seconds if self.seconds > 0 else 0.0
+
+
+class IngestStats(BaseModel):
+    """Per-stage statistics of an ingest pipeline run"""
+    split: StageStats = StageStats()
+    embed: StageStats = StageStats()
+    write: StageStats = StageStats()
+    seconds: float = 0.0  # wall time of the whole run
+
+
+class ChunkDiff(BaseModel):
+    """Counts of chunks touched by an incremental save"""
+    added: int = 0
+    removed: int = 0
+    kept: int = 0
+    ingest_stats: Optional[IngestStats] = None
+
+
+class CrawlStats(BaseModel):
+    """Counts of pages seen by a crawl"""
+    fetched: int = 0  # pages whose body was downloaded
+    not_modified: int = 0  # 304 or same content hash as the last crawl
+    changed: int = 0  # new or changed pages, the only ones split and embedded
+    removed: int = 0  # pages of the last crawl that were not reached any more
+    failed: int = 0
+
+
 class UserContent(BaseModel):
     """Model for user content that stored in chroma database"""
     page_content: str
     content_type: Optional[str]
     user: str
     id: str
+    chunk_diff: Optional[ChunkDiff] = None  # only set on the object returned by a save
+    crawl_stats: Optional[CrawlStats] = None  # only set on the object returned by save_urls
 
     def to_document(self) -> Document:
         """convert object to langchain Document object (pydantic v1)"""
@@ -0,0 +1,160 @@
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+import tiktoken
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# process-wide encoders, loaded on first use
+_encodings: Dict[str, tiktoken.Encoding] = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    """Return the shared encoder for encoding_name, loading it on first use"""
+    encoding = _encodings.get(encoding_name)
+    if encoding is not None: return encoding
+    with _encodings_lock:
+        if encoding_name not in _encodings:
+            _encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+        return _encodings[encoding_name]
+
+
+def truncate_tokens(content: str, max_tokens: int, encoding_name: str = DEFAULT_ENCODING) -> str:
+    """Cut content down to at most max_tokens tokens, keeping its head
+
+    Only the head of the content that can matter is encoded, then cut on a token boundary
+    and decoded back, so the cost is linear and bounded by the budget rather than the content.
+    """
+    if max_tokens <= 0 or not content: return ""
+    encoding = get_encoding(encoding_name)
+    tokens = _encode_head(encoding, content, max_tokens)
+    if len(tokens) <= max_tokens: return content
+    return _decode_prefix(encoding, tokens, max_tokens)
+
+
+def pack_texts(texts: Sequence[str], max_tokens: int, separator: str = "\n",
+               encoding_name: str = DEFAULT_ENCODING) -> str:
+    """Join texts with separator, keeping the result within max_tokens tokens
+
+    Texts are taken in order and encoded one by one, the first text that no longer fits
+    is truncated on a token boundary and the rest are never encoded. The result is the same
+    prefix that truncating the joined string would give, without encoding the joined string.
+    """
+    if max_tokens <= 0: return ""
+    encoding = get_encoding(encoding_name)
+    separator_tokens = len(encoding.encode(separator)) if separator else 0
+
+    parts: List[str] = []
+    used = 0
+    for text in texts:
+        cost = separator_tokens if parts else 0
+        if used + cost >= max_tokens: break
+        tokens = _encode_head(encoding, text, max_tokens - used - cost)
+        if used + cost + len(tokens) <= max_tokens:
+            parts.append(text)
+            used += cost + len(tokens)
+            continue
+        # the text does not fit entirely, keep its head and stop
+        parts.append(_decode_prefix(encoding, tokens, max_tokens - used - cost))
+        break
+
+    packed = separator.join(parts)
+    # tokens may merge across the separator, so the sum of the parts is only an estimate;
+    # one encode of the (already bounded) result keeps the guarantee exact
+    if len(encoding.encode(packed)) > max_tokens:
+        return truncate_tokens(packed, max_tokens, encoding_name=encoding_name)
+    return packed
+
+
+def pack_chunks(texts: Sequence[str], token_counts: Sequence[int], max_tokens: int, separator: str = "\n",
+                encoding_name: str = DEFAULT_ENCODING) -> str:
+    """Join the whole texts that fit in max_tokens tokens, using their known token counts
+
+    Texts are taken in order, a text that does not fit is skipped and a later shorter one
+    may still be taken. Only the separator is encoded, the sum of the counts and separators
+    is an estimate of the tokens of the result: unlike pack_texts nothing is encoded again
+    to catch tokens merging across a separator. If not even one text fits, the head of the
+    first one is kept, as pack_texts would.
+    """
+    if max_tokens <= 0 or len(texts) == 0: return ""
+    separator_tokens = len(get_encoding(encoding_name).encode(separator)) if separator else 0
+    parts: List[str] = []
+    used = 0
+    for text, token_count in zip(texts, token_counts):
+        cost = token_count + (separator_tokens if parts else 0)
+        if used + cost > max_tokens: continue
+        parts.append(text)
+        used += cost
+    if len(parts) == 0: return truncate_tokens(texts[0], max_tokens, encoding_name=encoding_name)
+    return separator.join(parts)
+
+
+def split_tokens(text: str, *, max_tokens: int, overlap_tokens: int = 0, separator: str = "\n\n",
+                 encoding_name: str = DEFAULT_ENCODING) -> List[Tuple[str, int]]:
+    """Split text into chunks of at most max_tokens tokens, with the token count of each chunk
+
+    Like CharacterTextSplitter, the text is split on separator and the pieces are merged
+    while they fit, the last pieces of a chunk (up to overlap_tokens) start the next one.
+    A piece longer than max_tokens is cut on token boundaries. The returned counts are
+    exact, the chunks are encoded once more as a whole.
+    """
+    encoding = get_encoding(encoding_name)
+    paragraphs = [paragraph.strip() for paragraph in text.split(separator) if paragraph.strip()]
+    pieces: List[Tuple[str, int]] = []
+    for paragraph, tokens in zip(paragraphs, encoding.encode_batch(paragraphs)):
+        rest = paragraph
+        while len(tokens) > max_tokens:
+            # keep at least one character, a budget below one character must still progress
+            head = _decode_prefix(encoding, tokens, max_tokens) or rest[0]
+            rest = rest[len(head):].lstrip()
+            # a cut inside a run of spaces leaves blank heads
+            head = head.strip()
+            if head: pieces.append((head, len(encoding.encode(head))))
+            tokens = _encode_head(encoding, rest, max_tokens)
+        if rest: pieces.append((rest, len(tokens)))
+
+    separator_tokens = len(encoding.encode(separator)) if separator else 0
+    chunks: List[List[str]] = []
+    current: List[Tuple[str, int]] = []
+    used = 0
+    for piece, token_count in pieces:
+        if current and used + separator_tokens + token_count > max_tokens:
+            chunks.append([text for text, _ in current])
+            # drop pieces from the front until the rest is a short enough overlap and the piece fits
+            while current and (used > overlap_tokens or used + separator_tokens + token_count > max_tokens):
+                used -= current.pop(0)[1] + (separator_tokens if current else 0)
+        used += token_count + (separator_tokens if current else 0)
+        current.append((piece, token_count))
+    if current: chunks.append([text for text, _ in current])
+
+    texts = [separator.join(chunk) for chunk in chunks]
+    return [(chunk, len(tokens)) for chunk, tokens in zip(texts, encoding.encode_batch(texts))]
+
+
+def _encode_head(encoding: tiktoken.Encoding, content: str, max_tokens: int) -> List[int]:
+    """Encode content, or only enough of its head to hold more than max_tokens tokens
+
+    The window grows geometrically, so a short budget over a long text stays cheap
+    and the total work is still linear when the whole text fits.
+    """
+    window = max(max_tokens * 4, 256)
+    while window < len(content):
+        tokens = encoding.encode(content[:window])
+        if len(tokens) > max_tokens: return tokens
+        window *= 2
+    return encoding.encode(content)
+
+
+def _decode_prefix(encoding: tiktoken.Encoding, tokens: List[int], max_tokens: int) -> str:
+    """Decode the first max_tokens tokens, dropping a trailing partial utf-8 character
+
+    A token boundary can fall inside a multi-byte character (common for Chinese),
+    the incomplete bytes are dropped so the result is always a prefix of the original text.
+    Re-encoding a prefix may tokenize its tail differently, keep cutting until it fits.
+    """
+    while max_tokens > 0:
+        text = encoding.decode_bytes(tokens[:max_tokens]).decode("utf-8", errors="ignore")
+        if len(encoding.encode(text)) <= max_tokens: return text
+        max_tokens -= 1
+    return ""
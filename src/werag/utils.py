@@ -1,6 +1,6 @@
-from typing import List
+from typing import Iterable, List
 
-import tiktoken
+from .tokens import DEFAULT_ENCODING, get_encoding, truncate_tokens
 
 
 def remove_none_from_dict(d: dict) -> dict:
@@ -11,27 +11,32 @@ def remove_none_from_dict(d: dict) -> dict:
     return d
 
 
-def count_tokens(string: str, encoding_name: str = "cl100k_base") -> int:
+def count_tokens(string: str, encoding_name: str = DEFAULT_ENCODING) -> int:
     """Return numbers of token"""
     # https://stackoverflow.com/questions/75804599/openai-api-how-do-i-count-tokens-before-i-send-an-api-request
     # https://github.com/openai/tiktoken
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding(encoding_name)
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
 
+def count_tokens_many(strings: Iterable[str], encoding_name: str = DEFAULT_ENCODING,
+                      num_threads: int = 8) -> List[int]:
+    """Return numbers of token for each string, encoded in one batch
+
+    tiktoken encodes the batch on a thread pool (outside the GIL), which is much faster
+    than calling count_tokens in a python loop.
+    """
+    strings = list(strings)
+    if len(strings) == 0: return []
+    encoding = get_encoding(encoding_name)
+    return [len(tokens) for tokens in encoding.encode_batch(strings, num_threads=num_threads)]
+
+
 def split_string_into_slices(s, slice_size):
     return [s[i:i + slice_size] for i in range(0, len(s), slice_size)]
 
 
-def limit_tokens(content: str, max_token: int):
-    slice_size = 10
-    split_: List[str] = split_string_into_slices(content, slice_size)
-    last_string = ""
-    for sp in split_:
-        new_token = count_tokens(last_string + sp)
-        if new_token < max_token:
-            last_string += sp
-        else:
-            break
-    return last_string
+def limit_tokens(content: str, max_token: int) -> str:
+    """Return the head of content with fewer than max_token tokens"""
+    return truncate_tokens(content, max_tokens=max_token - 1)
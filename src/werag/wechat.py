@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Awaitable, Callable, Hashable, Optional, Tuple, TypeVar
+
+from wechatpy import WeChatClient
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class MessageSender(ABC):
+    """Deliver a text message to a wechat user outside of the passive reply"""
+
+    @abstractmethod
+    def send_text(self, *, openid: str, content: str):
+        ...
+
+
+class CustomerServiceSender(MessageSender):
+    """Send messages with the customer-service message API (客服消息)
+
+    see: https://developers.weixin.qq.com/doc/offiaccount/Message_Management/Service_Center_messages.html
+    """
+
+    def __init__(self, *, appid: str, secret: str, client: Optional[WeChatClient] = None):
+        self._client = client if client is not None else WeChatClient(appid, secret)
+
+    def send_text(self, *, openid: str, content: str):
+        self._client.message.send_text(openid, content)
+
+
+class DeferredReplier:
+    """Answer wechat messages in the background and deliver them with a MessageSender
+
+    WeChat drops a passive reply that takes more than ~5 seconds and retries the message,
+    so the passive reply is sent immediately and the RAG/LLM work runs on a bounded pool.
+    At most max_workers jobs run and max_queue_size wait, beyond that submit refuses new jobs.
+    When answer() raises, error_reply is sent instead (if not empty) and the job counts as failed.
+    """
+
+    def __init__(self, *, sender: MessageSender,
+                 max_workers: int = 4,
+                 max_queue_size: int = 100,
+                 thinking_reply: str = "",  # 立即回复的内容, 为空则不回复
+                 busy_reply: str = "系统繁忙，请稍后再试",
+                 error_reply: str = "系统出错了，没有得到任何回复。请联系管理员"):
+        self.sender = sender
+        self.thinking_reply = thinking_reply
+        self.busy_reply = busy_reply
+        self.error_reply = error_reply
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="werag-deferred")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue_size)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.running = 0
+        self.max_pending = 0
+        self._shutdown = False
+
+    def submit(self, *, openid: str, answer: Callable[[], str]) -> bool:
+        """Schedule answer() and send its result to openid, return False if the queue is full or shut down"""
+        if self._shutdown or not self._slots.acquire(blocking=False):
+            with self._lock: self.rejected += 1
+            logger.warning(f"Deferred reply queue is full or shut down, rejected message from {openid}")
+            return False
+        with self._lock:
+            self.submitted += 1
+            self.max_pending = max(self.max_pending, self.pending)
+        try:
+            self._executor.submit(self._run, openid, answer)
+        except RuntimeError:
+            # shut down after the check above, give the slot back
+            with self._lock:
+                self.submitted -= 1
+                self.rejected += 1
+            self._slots.release()
+            logger.warning(f"Deferred reply queue is shut down, rejected message from {openid}")
+            return False
+        return True
+
+    @property
+    def pending(self) -> int:
+        """Jobs submitted but not finished yet (running or waiting)"""
+        return self.submitted - self.completed - self.failed
+
+    def stats(self) -> dict:
+        """Backpressure metrics"""
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "running": self.running,
+                "queued": self.pending - self.running,
+                "max_pending": self.max_pending,
+                "capacity": self.max_workers + self.max_queue_size
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._shutdown = True
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, openid: str, answer: Callable[[], str]):
+        with self._lock: self.running += 1
+        succeeded = False
+        try:
+            try:
+                content = answer()
+                succeeded = True
+            except Exception as e:
+                logger.critical(f"Failed to answer deferred message from {openid}, exception: {e}")
+                if not self.error_reply: return
+                content = self.error_reply
+            self.sender.send_text(openid=openid, content=content)
+        except Exception as e:
+            succeeded = False
+            logger.critical(f"Failed to send deferred reply to {openid}, exception: {e}")
+        finally:
+            with self._lock:
+                self.running -= 1
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            self._slots.release()
+
+
+class SingleFlightCache:
+    """Share one computation between concurrent callers of the same key
+
+    Used to deduplicate wechat retries: a retry of a message that is still being answered
+    waits for the same result, a retry that arrives shortly after gets the stored result.
+    Results are kept for ttl seconds after they are computed, failures are not kept.
+    If the caller computing a key is cancelled, the callers waiting for it compute it again.
+    """
+
+    def __init__(self, *, ttl: float = 30, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # key -> (future, finished time or None while in flight)
+        self._entries: "OrderedDict[Hashable, Tuple[Future, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], T]) -> T:
+        while True:
+            future, owner = self._claim(key)
+            if owner:
+                try:
+                    future.set_result(compute())
+                except BaseException as e:
+                    future.set_exception(e)
+                self._finish(key, future)
+                return future.result()
+            try:
+                return future.result()
+            except CancelledError:
+                # the owner was cancelled, that is a miss: compute again
+                if not future.cancelled(): raise
+
+    async def aget_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[T]]) -> T:
+        while True:
+            future, owner = self._claim(key)
+            if owner:
+                try:
+                    future.set_result(await compute())
+                except asyncio.CancelledError:
+                    # the waiters compute again instead of being cancelled with the owner
+                    future.cancel()
+                    self._finish(key, future)
+                    raise
+                except BaseException as e:
+                    future.set_exception(e)
+                self._finish(key, future)
+                return future.result()
+            try:
+                # shielded, a cancelled waiter must not cancel the shared future
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except (asyncio.CancelledError, CancelledError):
+                if not future.cancelled(): raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _claim(self, key: Hashable) -> Tuple[Future, bool]:
+        """Return the future for key and whether the caller has to compute it"""
+        with self._lock:
+            self._evict(time.monotonic())
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[0], False
+            self.misses += 1
+            future = Future()
+            self._entries[key] = (future, None)
+            return future, True
+
+    def _finish(self, key: Hashable, future: Future):
+        with self._lock:
+            if future.cancelled() or future.exception() is not None:
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = (future, time.monotonic())
+                self._entries.move_to_end(key)
+
+    def _evict(self, now: float):
+        """Drop expired results, and the oldest results when over max_size (in-flight entries stay)"""
+        # finished entries are moved to the end, so they are ordered by finished time
+        expired = []
+        for key, (_, finished) in self._entries.items():
+            if finished is None: continue
+            if now - finished <= self.ttl and len(self._entries) - len(expired) <= self.max_size: break
+            expired.append(key)
+        for key in expired:
+            del self._entries[key]